@@ -0,0 +1,55 @@
+'''
+Benchmark and key check for photometry.calcache.MasterCache
+
+Checks that a cached master flat is not reused when only the flat
+headers change (EXPTIME scales each flat), then times building a
+master flat against reading it back from the cache. Usage:
+
+  python benchmarks/bench_calcache.py [nframes] [npix]
+'''
+import sys
+import time
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+
+from zeroflux.photometry.calcache import MasterCache
+from zeroflux.photometry.fitsphot import make_master_flat
+
+def flats(data, exptimes):
+    return [fits.PrimaryHDU(dat, header=fits.Header({'EXPTIME': t}))
+            for dat, t in zip(data, exptimes)]
+
+def check_headers(cache, rng, npix):
+    data = [rng.normal(1000., 30., (npix, npix)) for _ in range(3)]
+    mzro = np.zeros((npix, npix))
+
+    make_master_flat(flats(data, [1., 1., 1.]), mzro, cache=cache)
+    #same data, different EXPTIME
+    cached = make_master_flat(flats(data, [1., 10., 100.]), mzro, cache=cache)
+    direct = make_master_flat(flats(data, [1., 10., 100.]), mzro)
+    diff = np.abs(cached - direct).max()
+    print('EXPTIME 1/1/1 cached, then 1/10/100: max diff from uncached %.2e'
+          % diff)
+    if diff != 0.:
+        raise AssertionError('cache reused a master built from other headers')
+
+def main(nframes=10, npix=1024):
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = MasterCache(tmp)
+        check_headers(cache, rng, 64)
+
+        data = [rng.normal(1000., 30., (npix, npix)) for _ in range(nframes)]
+        hdus = flats(data, np.linspace(1., 10., nframes))
+        mzro = np.zeros((npix, npix))
+        print('\n%d flats of %dx%d' % (nframes, npix, npix))
+        for label in ('uncached', 'cache miss', 'cache hit'):
+            t0 = time.perf_counter()
+            make_master_flat(hdus, mzro,
+                             cache=None if label == 'uncached' else cache)
+            print('%-12s %8.3f s' % (label, time.perf_counter()-t0))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
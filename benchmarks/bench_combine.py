@@ -0,0 +1,50 @@
+'''
+Scaling benchmark for photometry.combine.combine_frames
+
+Writes synthetic bias frames to a temporary directory, then times a
+sigma-clipped combine with 1, 2, 4, ... worker processes up to the
+number of cores. Usage:
+
+  python benchmarks/bench_combine.py [nframes] [npix] [method]
+'''
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+
+from zeroflux.photometry.combine import combine_frames
+
+def main(nframes=20, npix=2048, method='sigclip'):
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for k in range(nframes):
+            path = os.path.join(tmp, 'bias%03d.fits' % k)
+            data = rng.normal(1000., 5., (npix, npix)).astype(np.float32)
+            fits.PrimaryHDU(data).writeto(path)
+            files.append(path)
+
+        ncores = os.cpu_count() or 1
+        nprocs = [1]
+        while nprocs[-1]*2 <= ncores:
+            nprocs.append(nprocs[-1]*2)
+        if nprocs[-1] != ncores:
+            nprocs.append(ncores)
+
+        print('%d frames of %dx%d, method=%s, %d cores'
+              % (nframes, npix, npix, method, ncores))
+        t1 = None
+        for nproc in nprocs:
+            t0 = time.perf_counter()
+            combine_frames(files, method=method, nproc=nproc, maxmem=64.)
+            dt = time.perf_counter()-t0
+            t1 = t1 or dt
+            print('nproc=%3d  %8.2f s  speedup %5.2f  efficiency %4.0f%%'
+                  % (nproc, dt, t1/dt, 100*t1/dt/nproc))
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(arg) for arg in args[:2]], *args[2:3])
@@ -0,0 +1,110 @@
+'''
+Accuracy and speed benchmark for astromath.coords
+
+Compares separations, position angles and frame transforms against
+astropy SkyCoord on random positions, in float64 and float32, then
+times both as the number of positions grows. Usage:
+
+  python benchmarks/bench_coords.py [max N]
+'''
+import sys
+import time
+
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+
+from zeroflux.astromath import coords
+
+def random_sky(rng, n):
+    ra = rng.uniform(0., 360., n)
+    dec = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+    return ra, dec
+
+def wrap(dlon):
+    '''
+    longitude differences in (-180, 180]
+    '''
+    return (dlon + 180.) % 360. - 180.
+
+def accuracy(rng, n=10**5):
+    ra1, dec1 = random_sky(rng, n)
+    ra2, dec2 = random_sky(rng, n)
+    #close pairs as well, where cosine formulas lose precision
+    ra3 = ra1 + rng.normal(0., 1e-4, n)
+    dec3 = np.clip(dec1 + rng.normal(0., 1e-4, n), -90., 90.)
+    c1 = SkyCoord(ra1*u.deg, dec1*u.deg)
+    c2 = SkyCoord(ra2*u.deg, dec2*u.deg)
+    c3 = SkyCoord(ra3*u.deg, dec3*u.deg)
+
+    print('max abs error vs astropy, arcsec')
+    print('%-24s %12s %12s' % ('', 'float64', 'float32'))
+    rows = [('angsep', lambda dt: coords.angsep(ra1, dec1, ra2, dec2, dtype=dt),
+             c1.separation(c2).deg, False),
+            ('angsep close pairs', lambda dt: coords.angsep(ra1, dec1, ra3, dec3,
+                                                            dtype=dt),
+             c1.separation(c3).deg, False),
+            ('posang', lambda dt: coords.posang(ra1, dec1, ra2, dec2, dtype=dt),
+             c1.position_angle(c2).deg, True),
+            ('angsep_pairs', lambda dt: coords.angsep_pairs(ra1[:500], dec1[:500],
+                                                            ra2[:500], dec2[:500],
+                                                            dtype=dt),
+             c1[:500, None].separation(c2[None, :500]).deg, False)]
+    for name, func, ref, angle in rows:
+        errs = []
+        for dtype in (np.float64, np.float32):
+            diff = func(dtype) - ref
+            errs.append(np.abs(wrap(diff) if angle else diff).max()*3600)
+        print('%-24s %12.2e %12.2e' % (name, *errs))
+
+    for frame, lon, lat in (('galactic', 'l', 'b'),
+                            ('barycentricmeanecliptic', 'lon', 'lat')):
+        ref = c1.transform_to(frame)
+        ref = getattr(ref, lon).deg, getattr(ref, lat).deg
+        name = frame if frame == 'galactic' else 'ecliptic'
+        errs = []
+        for dtype in (np.float64, np.float32):
+            lo, la = coords.transform(ra1, dec1, 'icrs', name, dtype=dtype)
+            #on-sky error, longitude scaled by cos(lat)
+            dl = wrap(lo - ref[0])*np.cos(np.radians(ref[1]))
+            errs.append(np.hypot(dl, la - ref[1]).max()*3600)
+        print('%-24s %12.2e %12.2e' % ('icrs -> '+name, *errs))
+
+def timing(rng, nmax):
+    print('\n%9s %11s %11s %11s %11s %11s %11s' %
+          ('N', 'sep astropy', 'sep f64', 'sep f32', 'gal astropy',
+           'gal f64', 'gal f32'))
+    n = 10**4
+    while n <= nmax:
+        ra1, dec1 = random_sky(rng, n)
+        ra2, dec2 = random_sky(rng, n)
+        times = []
+
+        t0 = time.perf_counter()
+        SkyCoord(ra1*u.deg, dec1*u.deg).separation(SkyCoord(ra2*u.deg, dec2*u.deg))
+        times.append(time.perf_counter()-t0)
+        for dtype in (np.float64, np.float32):
+            out = np.empty(n, dtype=dtype)
+            t0 = time.perf_counter()
+            coords.angsep(ra1, dec1, ra2, dec2, out=out, dtype=dtype)
+            times.append(time.perf_counter()-t0)
+
+        t0 = time.perf_counter()
+        SkyCoord(ra1*u.deg, dec1*u.deg).galactic
+        times.append(time.perf_counter()-t0)
+        for dtype in (np.float64, np.float32):
+            out = np.empty((2, n), dtype=dtype)
+            t0 = time.perf_counter()
+            coords.transform(ra1, dec1, 'icrs', 'galactic', out=out, dtype=dtype)
+            times.append(time.perf_counter()-t0)
+        print('%9d' % n + ''.join(' %11.4f' % t for t in times))
+        n *= 10
+
+def main():
+    nmax = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**7
+    rng = np.random.default_rng(0)
+    accuracy(rng)
+    timing(rng, nmax)
+
+if __name__ == '__main__':
+    main()
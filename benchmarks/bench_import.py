@@ -0,0 +1,60 @@
+'''
+Import time benchmark for zeroflux
+
+Times imports in fresh interpreters, as a short-lived worker would
+pay them, and lists which heavy dependencies each import loads.
+Usage:
+
+  python benchmarks/bench_import.py [N repeats]
+'''
+import subprocess
+import sys
+
+import numpy as np
+
+TARGETS = ['numpy',
+           'zeroflux',
+           'zeroflux.astromath.constants_cgs',
+           'zeroflux.astromath.stat',
+           'zeroflux.astromath.coords',
+           'zeroflux.spectroscopy.specutils',
+           'zeroflux.photometry.photcalc',
+           'zeroflux.ioastro.xmatch',
+           'zeroflux.spectroscopy.zfind',
+           'zeroflux.photometry.fitsphot']
+
+HEAVY = ['scipy', 'astropy', 'matplotlib']
+
+#imports, then reports the wall time and the heavy packages loaded
+SCRIPT = '''
+import sys, time
+t0 = time.perf_counter()
+import %s
+dt = time.perf_counter() - t0
+print(dt, ','.join(m for m in %r if m in sys.modules))
+'''
+
+def time_import(name, nrep):
+    times = []
+    for i in range(nrep):
+        res = subprocess.run([sys.executable, '-c', SCRIPT % (name, HEAVY)],
+                             capture_output=True, text=True)
+        if res.returncode != 0:
+            return None, res.stderr.strip().splitlines()[-1]
+        dt, loaded = res.stdout.split('\n')[0].split(' ')
+        times.append(float(dt))
+    return np.median(times), loaded or '-'
+
+def main():
+    nrep = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print('median of %d fresh interpreters' % nrep)
+    print('%-36s %10s  %s' % ('import', 'time [ms]', 'heavy packages loaded'))
+    for name in TARGETS:
+        dt, loaded = time_import(name, nrep)
+        if dt is None:
+            print('%-36s %10s  %s' % (name, 'failed', loaded))
+        else:
+            print('%-36s %10.1f  %s' % (name, 1e3*dt, loaded))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+'''
+Quantity vs plain-array benchmark for photcalc flux/magnitude conversions
+
+Times each conversion on a large catalog column through astropy
+Quantity inputs and through the plain-array fast path, with and without
+preallocated float32 out= buffers. Usage:
+
+  python benchmarks/bench_photcalc.py [nrows]
+'''
+import sys
+import time
+
+import numpy as np
+from astropy import units as u
+
+from zeroflux.photometry import photcalc
+
+def best(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-t0)
+    return min(times)
+
+def main(n=10**7):
+    rng = np.random.default_rng(0)
+    fnu = rng.uniform(1e-6, 1e-3, n)
+    mab = rng.uniform(15., 25., n)
+    lam = rng.uniform(3000., 10000., n)
+    flam = rng.uniform(1e-18, 1e-16, n)
+    fnu_q = fnu*u.Jy
+    flam_q = flam*u.erg/u.s/u.cm**2/u.AA
+    out32 = np.empty(n, dtype=np.float32)
+    fnu32 = fnu.astype(np.float32)
+    mab32 = mab.astype(np.float32)
+
+    cases = [
+        ('jy_to_mab', lambda: photcalc.jy_to_mab(fnu_q),
+         lambda: photcalc.jy_to_mab(fnu),
+         lambda: photcalc.jy_to_mab(fnu32, out=out32)),
+        ('jy_to_maggie', lambda: photcalc.jy_to_maggie(fnu_q),
+         lambda: photcalc.jy_to_maggie(fnu),
+         lambda: photcalc.jy_to_maggie(fnu32, out=out32)),
+        ('mab_to_jy', lambda: photcalc.mab_to_jy(mab),
+         lambda: photcalc.mab_to_jy(mab, unit=False),
+         lambda: photcalc.mab_to_jy(mab32, out=out32)),
+        ('flam_to_fnu', lambda: photcalc.flam_to_fnu(flam_q, lam),
+         lambda: photcalc.flam_to_fnu(flam, lam),
+         lambda: photcalc.flam_to_fnu(flam, lam, out=out32,
+                                      dtype=np.float32)),
+    ]
+
+    print('%d elements, best of 3 [ms]' % n)
+    print('%-14s %10s %10s %14s %8s' % ('conversion', 'quantity', 'array',
+                                        'float32 out=', 'speedup'))
+    for name, slow, fast, inplace in cases:
+        ts, tf, ti = best(slow), best(fast), best(inplace)
+        print('%-14s %10.1f %10.1f %14.1f %8.1f'
+              % (name, ts*1e3, tf*1e3, ti*1e3, ts/min(tf, ti)))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
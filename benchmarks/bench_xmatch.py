@@ -0,0 +1,74 @@
+'''
+Correctness and speed benchmark for ioastro.xmatch
+
+Checks xmatch and xmatch_all against brute-force pairwise separations
+on small random catalogs, then times both against brute force as the
+catalogs grow. Usage:
+
+  python benchmarks/bench_xmatch.py [nthreads]
+'''
+import sys
+import time
+
+import numpy as np
+
+from zeroflux.ioastro.xmatch import xmatch, xmatch_all
+
+def random_sky(rng, n, ra0=150., dec0=2., size=1.):
+    ra = ra0 + rng.uniform(-size, size, n)/np.cos(np.radians(dec0))
+    dec = dec0 + rng.uniform(-size, size, n)
+    return ra, dec
+
+def brute_sep(ra1, dec1, ra2, dec2):
+    '''
+    N x M separations in degrees, haversine formula
+    '''
+    ra1, dec1, ra2, dec2 = [np.radians(x) for x in (ra1, dec1, ra2, dec2)]
+    hav = (np.sin((dec2[None]-dec1[:, None])/2)**2 +
+           np.cos(dec1[:, None])*np.cos(dec2[None]) *
+           np.sin((ra2[None]-ra1[:, None])/2)**2)
+    return np.degrees(2*np.arcsin(np.sqrt(hav)))
+
+def check(rng, radius=30/3600.):
+    ra1, dec1 = random_sky(rng, 2000)
+    ra2, dec2 = random_sky(rng, 3000)
+    sep = brute_sep(ra1, dec1, ra2, dec2)
+
+    idx, s = xmatch(ra1, dec1, ra2, dec2, chunksize=500)
+    best = sep.argmin(axis=1)
+    print('nearest neighbor: idx agree %s, max sep error %.2e deg'
+          % (np.array_equal(idx, best),
+             np.abs(s-sep[np.arange(len(ra1)), best]).max()))
+
+    i1, i2, s = xmatch_all(ra1, dec1, ra2, dec2, radius, chunksize=500)
+    b1, b2 = np.nonzero(sep <= radius)
+    print('all within %.1f arcsec: %d pairs, pairs agree %s'
+          % (radius*3600, len(i1),
+             np.array_equal(i1, b1) and np.array_equal(i2, b2)))
+
+def timing(rng, nthreads):
+    print('%9s %12s %12s %12s' % ('N=M', 'brute [s]', 'xmatch [s]',
+                                   'xmatch_all [s]'))
+    for n in [1000, 4000, 16000, 10**5, 10**6]:
+        ra1, dec1 = random_sky(rng, n)
+        ra2, dec2 = random_sky(rng, n)
+        if n <= 16000:
+            t0 = time.perf_counter()
+            for i in range(0, n, 1000):
+                brute_sep(ra1[i:i+1000], dec1[i:i+1000], ra2, dec2).argmin(1)
+            tb = '%12.3f' % (time.perf_counter()-t0)
+        else:
+            tb = '%12s' % '-'
+        t0 = time.perf_counter()
+        xmatch(ra1, dec1, ra2, dec2, nthreads=nthreads)
+        tn = time.perf_counter()-t0
+        t0 = time.perf_counter()
+        xmatch_all(ra1, dec1, ra2, dec2, 5/3600., nthreads=nthreads)
+        ta = time.perf_counter()-t0
+        print('%9d %s %12.3f %12.3f' % (n, tb, tn, ta))
+
+if __name__ == '__main__':
+    nthreads = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    rng = np.random.default_rng(0)
+    check(rng)
+    timing(rng, nthreads)
@@ -4,7 +4,7 @@ setup
 with open("README.md", "r") as readme_file:
     readme = readme_file.read()
 
-requirements = ["astropy"]
+requirements = ["astropy", "scipy"]
 
 setup(
     name="zeroflux",
@@ -1,7 +1,14 @@
-#import sub-direcories 
+#sub-directories are imported on first access, e.g. zeroflux.photometry,
+#so import zeroflux does not load astropy, scipy or matplotlib
 
-from . import ioastro
-from . import spectroscopy
-from . import photometry
-from . import plotting
-from . import astromath
+import importlib
+
+__all__ = ["ioastro", "spectroscopy", "photometry", "plotting", "astromath"]
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.'+name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
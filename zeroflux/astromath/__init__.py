@@ -1,3 +1,14 @@
 #
 
-__all__ = ["constants_cgs", "stat", "funcs"]
+import importlib
+
+__all__ = ["constants_cgs", "stat", "funcs", "rebin", "coords"]
+
+def __getattr__(name):
+    #modules are imported on first access, e.g. zeroflux.astromath.stat
+    if name in __all__:
+        return importlib.import_module('.'+name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
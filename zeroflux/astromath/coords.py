@@ -0,0 +1,272 @@
+import numpy as np
+
+#J2000 mean obliquity of the ecliptic (IAU 2006), radians
+OBLIQUITY = np.radians(84381.406/3600.)
+
+#ICRS to galactic rotation (Hipparcos, ESA 1997 vol 1 sec 1.5.3)
+ICRS_TO_GAL = np.array([[-0.0548755604162154, -0.8734370902348850, -0.4838350155487132],
+                        [ 0.4941094278755837, -0.4448296299600112,  0.7469822444972189],
+                        [-0.8676661490190047, -0.1980763734312015,  0.4559837761750669]])
+
+#ICRS to mean ecliptic and equinox of J2000, frame bias neglected (~20 mas)
+ICRS_TO_ECL = np.array([[1., 0., 0.],
+                        [0., np.cos(OBLIQUITY), np.sin(OBLIQUITY)],
+                        [0., -np.sin(OBLIQUITY), np.cos(OBLIQUITY)]])
+
+FRAMES = {'icrs': np.eye(3), 'galactic': ICRS_TO_GAL, 'ecliptic': ICRS_TO_ECL}
+FRAMES['equatorial'] = FRAMES['icrs']
+
+def rotation_matrix(frame_in, frame_out):
+    '''
+    Description
+      .3 x 3 rotation of unit vectors from one frame to another
+      .frames: 'icrs' (or 'equatorial'), 'galactic', 'ecliptic'
+
+    Parameters
+      .frame_in: frame name of the input vectors
+      .frame_out: frame name of the output vectors
+
+    Returns
+      .3 x 3 array
+    '''
+    for frame in (frame_in, frame_out):
+        if frame not in FRAMES:
+            raise ValueError('unknown frame %r, use one of %s'
+                             % (frame, sorted(FRAMES)))
+    return FRAMES[frame_out] @ FRAMES[frame_in].T
+
+def lonlat_to_vec(lon, lat, out=None, dtype=np.float64):
+    '''
+    Description
+      .converts longitudes, latitudes to cartesian unit vectors
+
+    Parameters
+      .lon: longitude(s) (ra, l, ...), degrees
+      .lat: latitude(s) (dec, b, ...), degrees
+      .out: 3 x N array to write to, default None
+      .dtype: np.float64 or np.float32
+
+    Returns
+      .3 x N array of unit vectors (out, if given)
+    '''
+    lon = np.radians(np.ravel(lon), dtype=dtype)
+    lat = np.radians(np.ravel(lat), dtype=dtype)
+    if out is None:
+        out = np.empty((3, len(lon)), dtype=dtype)
+    coslat = np.cos(lat)
+    np.cos(lon, out=out[0])
+    out[0] *= coslat
+    np.sin(lon, out=out[1])
+    out[1] *= coslat
+    np.sin(lat, out=out[2])
+    return out
+
+def vec_to_lonlat(vec, out=None):
+    '''
+    Description
+      .converts cartesian vectors to longitudes, latitudes
+      .latitudes from arctan2, accurate to round-off at the poles
+
+    Parameters
+      .vec: 3 x N array of vectors, need not be unit length
+      .out: 2 x N array to write to, default None
+
+    Returns
+      .2 x N array of longitudes [0,360) and latitudes, degrees
+    '''
+    x, y, z = vec
+    if out is None:
+        out = np.empty((2, len(x)), dtype=np.result_type(vec, np.float32))
+    np.arctan2(y, x, out=out[0])
+    np.degrees(out[0], out=out[0])
+    out[0] %= 360.
+    np.arctan2(z, np.hypot(x, y), out=out[1])
+    np.degrees(out[1], out=out[1])
+    return out
+
+def rotate(vec, frame_in, frame_out, out=None):
+    '''
+    Description
+      .rotates unit vectors between frames, see rotation_matrix
+
+    Parameters
+      .vec: 3 x N array of unit vectors in frame_in
+      .frame_in, frame_out: frame names
+      .out: 3 x N array to write to (may be vec), default None
+
+    Returns
+      .3 x N array of unit vectors in frame_out (out, if given)
+    '''
+    vec = np.asarray(vec)
+    rot = rotation_matrix(frame_in, frame_out).astype(vec.dtype)
+    return np.matmul(rot, vec, out=out)
+
+def transform(lon, lat, frame_in, frame_out, out=None, dtype=np.float64,
+              chunksize=2**16):
+    '''
+    Description
+      .transforms sky positions between frames with a precomputed
+       rotation of unit vectors, chunk by chunk in scratch buffers
+      .a fixed rotation, so no precession, aberration or frame epochs;
+       agrees with astropy SkyCoord to tens of mas
+
+    Parameters
+      .lon, lat: positions in frame_in, degrees
+      .frame_in, frame_out: 'icrs' (or 'equatorial'), 'galactic',
+                            'ecliptic'
+      .out: 2 x N array to write to, default None
+      .dtype: np.float64 or np.float32 (~0.2 arcsec)
+      .chunksize: N positions per chunk
+
+    Returns
+      .2 x N array of longitudes [0,360) and latitudes in frame_out,
+       degrees (out, if given)
+    '''
+    lon = np.ravel(lon)
+    lat = np.ravel(lat)
+    n = len(lon)
+    if out is None:
+        out = np.empty((2, n), dtype=dtype)
+    rot = rotation_matrix(frame_in, frame_out).astype(dtype)
+    vec = np.empty((3, min(chunksize, n)), dtype=dtype)
+    for start in range(0, n, chunksize):
+        stop = min(start+chunksize, n)
+        v = lonlat_to_vec(lon[start:stop], lat[start:stop],
+                          out=vec[:, :stop-start], dtype=dtype)
+        np.matmul(rot, v, out=v)
+        vec_to_lonlat(v, out=out[:, start:stop])
+    return out
+
+def angsep(lon1, lat1, lon2, lat2, out=None, dtype=np.float64,
+           chunksize=2**16):
+    '''
+    Description
+      .great-circle separations of paired positions, Vincenty formula,
+       accurate at all separations
+      .inputs broadcast against each other, computed in chunks
+
+    Parameters
+      .lon1, lat1: first positions, degrees
+      .lon2, lat2: second positions, degrees
+      .out: array of the broadcast shape to write to, default None
+      .dtype: np.float64 or np.float32 (~0.2 arcsec)
+      .chunksize: N pairs per chunk
+
+    Returns
+      .separations, degrees (out, if given)
+    '''
+    return _paired(_vincenty, (lon1, lat1, lon2, lat2), out, dtype,
+                   chunksize)
+
+def posang(lon1, lat1, lon2, lat2, out=None, dtype=np.float64,
+           chunksize=2**16):
+    '''
+    Description
+      .position angles of the second positions from the first,
+       east of north, inputs broadcast against each other
+
+    Parameters
+      .lon1, lat1: first positions, degrees
+      .lon2, lat2: second positions, degrees
+      .out: array of the broadcast shape to write to, default None
+      .dtype: np.float64 or np.float32
+      .chunksize: N pairs per chunk
+
+    Returns
+      .position angles [0,360), degrees (out, if given)
+    '''
+    return _paired(_posang, (lon1, lat1, lon2, lat2), out, dtype,
+                   chunksize)
+
+def angsep_pairs(lon1, lat1, lon2, lat2, out=None, dtype=np.float64,
+                 chunksize=256):
+    '''
+    Description
+      .all-pairs great-circle separations, N x M
+      .from unit vectors, 2 arctan2(|v1-v2|, |v1+v2|), accurate at all
+       separations; computed for chunksize rows at a time, so memory
+       beyond out is about 3 x chunksize x M floats and out may be a
+       memmap for matrices larger than memory
+
+    Parameters
+      .lon1, lat1: N first positions, degrees
+      .lon2, lat2: M second positions, degrees
+      .out: N x M array to write to, default None
+      .dtype: np.float64 or np.float32
+      .chunksize: N rows per chunk
+
+    Returns
+      .N x M separations, degrees (out, if given)
+    '''
+    v1 = lonlat_to_vec(lon1, lat1, dtype=dtype)
+    v2 = lonlat_to_vec(lon2, lat2, dtype=dtype)
+    n, m = v1.shape[1], v2.shape[1]
+    if out is None:
+        out = np.empty((n, m), dtype=dtype)
+    rows = min(chunksize, n)
+    diff = np.empty((rows, m), dtype=dtype)
+    summ = np.empty((rows, m), dtype=dtype)
+    tmp = np.empty((rows, m), dtype=dtype)
+
+    for start in range(0, n, chunksize):
+        k = min(start+chunksize, n) - start
+        d, s, t = diff[:k], summ[:k], tmp[:k]
+        d[:] = 0.
+        s[:] = 0.
+        for a, b in zip(v1[:, start:start+k], v2):
+            np.subtract.outer(a, b, out=t)
+            t *= t
+            d += t
+            np.add.outer(a, b, out=t)
+            t *= t
+            s += t
+        np.sqrt(d, out=d)
+        np.sqrt(s, out=s)
+        np.arctan2(d, s, out=t)
+        np.multiply(t, 2*180./np.pi, out=out[start:start+k])
+    return out
+
+def _paired(func, args, out, dtype, chunksize):
+    '''
+    Description
+      .applies func(lon1, lat1, lon2, lat2) in radians to broadcast,
+       flattened inputs chunk by chunk, writing degrees into out
+    '''
+    shape = np.broadcast_shapes(*[np.shape(a) for a in args])
+    flat = [np.broadcast_to(a, shape).reshape(-1) for a in args]
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape or not out.flags.c_contiguous:
+        raise ValueError('out must be a contiguous array of shape %s'
+                         % (shape,))
+    res = out.reshape(-1)
+    for start in range(0, res.size, chunksize):
+        cut = slice(start, start+chunksize)
+        rad = [np.radians(a[cut], dtype=dtype) for a in flat]
+        np.degrees(func(*rad), out=res[cut])
+    return out
+
+def _vincenty(lon1, lat1, lon2, lat2):
+    '''
+    Description
+      .separation in radians, Vincenty formula for the sphere
+    '''
+    dlon = lon2 - lon1
+    sin1, cos1 = np.sin(lat1), np.cos(lat1)
+    sin2, cos2 = np.sin(lat2), np.cos(lat2)
+    sind, cosd = np.sin(dlon), np.cos(dlon)
+    num1 = cos2*sind
+    num2 = cos1*sin2 - sin1*cos2*cosd
+    den = sin1*sin2 + cos1*cos2*cosd
+    return np.arctan2(np.hypot(num1, num2), den)
+
+def _posang(lon1, lat1, lon2, lat2):
+    '''
+    Description
+      .position angle in radians [0,2pi), east of north
+    '''
+    dlon = lon2 - lon1
+    cos2 = np.cos(lat2)
+    num = cos2*np.sin(dlon)
+    den = np.cos(lat1)*np.sin(lat2) - np.sin(lat1)*cos2*np.cos(dlon)
+    return np.arctan2(num, den) % (2*np.pi)
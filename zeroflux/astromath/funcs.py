@@ -1,13 +1,13 @@
 import numpy as np
 
+from zeroflux.astromath.rebin import rebin
+
 def rebin2d(arr, new_shape, method='mean'):
     '''
-    Code adapted from:
-    https://scipython.com/blog/binning-a-2d-array-in-numpy/
-
     Description
       .Rebins 2D array using mean or sum
-      .new shape should consist of factors of old shape
+      .new shape need not divide the old shape,
+       see rebin.rebin for fractional factors, masks and chunking
 
     Parameters
       .arr: 2D numpy array or list
@@ -17,14 +17,7 @@ def rebin2d(arr, new_shape, method='mean'):
     Returns
       .rebinned 2d numpy array
     '''
-
-    highd_shape = (new_shape[0], np.shape(arr)[0] // new_shape[0],
-                   new_shape[1], np.shape(arr)[1] // new_shape[1])
-
-    if method == 'mean':
-        return np.reshape(arr, highd_shape).mean(-1).mean(1)
-    elif method == 'sum':
-        return np.reshape(arr, highd_shape).sum(-1).sum(1)
+    return rebin(np.asarray(arr), new_shape, method=method)
 
 def sphere_to_cart(rad,theta,phi):
     '''
@@ -61,12 +54,13 @@ def cart_to_sphere(x,y,z):
       .[r, theta, phi] array
        theta is polar angle [0,pi]
        phi is azimuthal angle [0,2pi]
+      .see coords for batched sky coordinate kernels
     '''
     #converts (x,y,z) to (rad,theta,phi)
     #theta->polar, phi->azimuthal
     rad = np.sqrt(x**2 + y**2 + z**2)
-    theta = np.arccos(z/r)
-    phi = np.arctan(y/x)
+    theta = np.arccos(z/rad)
+    phi = np.arctan2(y, x) % (2*np.pi)
     return np.array([rad, theta, phi])
 
 
@@ -75,6 +69,7 @@ def weighted_mean(x, sig=None, w=None, axis=0):
     Description
       .calculates weighted arithmetic mean along given axis
       .if weights not provided, uses inverse variance as weights
+      .see stat.WeightedStats to accumulate chunks of samples
       
     Parameters
       .x: array values 
@@ -87,17 +82,17 @@ def weighted_mean(x, sig=None, w=None, axis=0):
       .sigbar: weighted errors, only if provided
       
     '''
-    #normalize weights:
-    if weights is None:
-        w = 1./sig**2 #inverse variance weights
-    w = w/np.sum(w, axis=axis)
+    #inverse variance weights, or equal weights
+    if w is None:
+        w = 1./np.asarray(sig)**2 if sig is not None else np.ones(np.shape(x))
+    wsum = np.sum(w, axis=axis)
 
     #get weighted average
-    xbar = np.sum(x*w, axis=axis)
+    xbar = np.sum(x*w, axis=axis)/wsum
 
     #get weighted error
     if sig is not None:
-        sigbar = np.sqrt(np.sum(sig**2 * w**2, axis=axis))
+        sigbar = np.sqrt(np.sum(sig**2 * w**2, axis=axis))/wsum
         return xbar, sigbar
     
     else:
@@ -0,0 +1,161 @@
+import warnings
+
+import numpy as np
+
+def rebin(arr, new_shape=None, factor=None, method='mean', mask=None,
+          out=None, dtype=None, maxmem=256.):
+    '''
+    Description
+      .Rebins N-d array by integer or fractional factors per axis
+      .integer factors reduce each block in one pass over a reshaped view
+      .fractional factors share input pixels between output bins by
+       their overlap (cumulative sums interpolated at the bin edges),
+       conserving flux
+      .NaN and masked pixels are ignored; 'sum' is then the mean of
+       the good pixels times the bin area, so totals are conserved
+      .processed in strips along axis 0, so memory-mapped arrays
+       larger than memory can be rebinned into a memory-mapped out
+
+    Parameters
+      .arr: N-d array (may be a memmap)
+      .new_shape: output shape, default None (from factor)
+      .factor: binning factor(s), one value or one per axis
+               output size is floor(size/factor)
+      .method: 'mean', 'sum', 'median' or 'max'
+               median and max need integer factors
+      .mask: bool array like arr, True marks bad pixels, default None
+      .out: array of the output shape to write to, default None
+      .dtype: output dtype, default arr dtype if float, else float64
+      .maxmem: approx. memory budget per strip in MB
+
+    Returns
+      .rebinned array (out, if given)
+    '''
+    arr = np.asarray(arr)
+    shape = arr.shape
+    ndim = len(shape)
+    if new_shape is None:
+        factor = np.broadcast_to(np.asarray(factor, dtype=float), (ndim,))
+        new_shape = tuple(int(np.floor(n/f+1e-9)) for n, f in zip(shape, factor))
+    else:
+        new_shape = tuple(new_shape)
+        factor = np.array([n/m for n, m in zip(shape, new_shape)])
+    if len(new_shape) != ndim:
+        raise ValueError('new_shape must have one size per axis')
+
+    integer = np.abs(factor-np.round(factor)) < 1e-9
+    factor = np.where(integer, np.round(factor), factor)
+    if method in ('median', 'max') and not integer.all():
+        raise ValueError('median and max need integer factors')
+    if method not in ('mean', 'sum', 'median', 'max'):
+        raise ValueError("method must be 'mean', 'sum', 'median' or 'max'")
+
+    if dtype is None:
+        dtype = arr.dtype if arr.dtype.kind == 'f' else np.float64
+    if out is None:
+        out = np.empty(new_shape, dtype=dtype)
+
+    #output rows per strip, input strip and a few float64 work copies
+    rowsize = 8*4*np.prod(shape[1:], dtype=float)*factor[0]
+    nrows = max(int(maxmem*2**20 // max(rowsize, 1)), 1)
+
+    for j0 in range(0, new_shape[0], nrows):
+        j1 = min(j0+nrows, new_shape[0])
+        i0 = int(np.floor(j0*factor[0]+1e-9))
+        i1 = min(int(np.ceil(j1*factor[0]-1e-9)), shape[0])
+        strip = arr[i0:i1]
+        bad = None if mask is None else np.asarray(mask[i0:i1])
+        out[j0:j1] = _rebin_strip(strip, bad, (j0, j1), i0, new_shape,
+                                  factor, integer, method)
+    return out
+
+def _rebin_strip(strip, bad, rows, i0, new_shape, factor, integer, method):
+    '''
+    Description
+      .rebins one strip of input rows into output rows j0..j1
+    '''
+    j0, j1 = rows
+    if strip.dtype.kind == 'f':
+        nan = np.isnan(strip)
+        bad = nan if bad is None else bad | nan
+    if bad is not None and not bad.any():
+        bad = None
+
+    if integer.all():
+        #trim to whole blocks, then blocks as every other axis
+        f = factor.astype(int)
+        cut = tuple(slice(0, (j1-j0)*f[0] if k == 0 else n*f[k])
+                    for k, n in enumerate(new_shape))
+        strip = strip[cut]
+        bshape = []
+        for k, n in enumerate(new_shape):
+            bshape += [j1-j0 if k == 0 else n, f[k]]
+        axes = tuple(range(1, 2*len(new_shape), 2))
+        blocks = strip.reshape(bshape)
+
+        if bad is None:
+            if method == 'mean':
+                return blocks.mean(axis=axes)
+            if method == 'sum':
+                return blocks.sum(axis=axes)
+            if method == 'max':
+                return blocks.max(axis=axes)
+            return np.median(blocks, axis=axes)
+
+        bad = bad[cut].reshape(bshape)
+        if method in ('median', 'max'):
+            blocks = np.where(bad, np.nan, blocks)
+            #all-bad blocks give NaN without warnings
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                if method == 'max':
+                    return np.nanmax(blocks, axis=axes)
+                return np.nanmedian(blocks, axis=axes)
+        total = np.where(bad, 0., blocks).sum(axis=axes, dtype=float)
+        count = (~bad).sum(axis=axes)
+    else:
+        total = np.asarray(strip, dtype=float)
+        count = None if bad is None else (~bad).astype(float)
+        if bad is not None:
+            total = np.where(bad, 0., total)
+        for k, n in enumerate(new_shape):
+            lo, hi = (j0, j1) if k == 0 else (0, n)
+            start = i0 if k == 0 else 0
+            total = _axis_sum(total, k, factor[k], integer[k], lo, hi, start)
+            if count is not None:
+                count = _axis_sum(count, k, factor[k], integer[k], lo, hi,
+                                  start)
+        if count is None:
+            area = np.prod(factor)
+            return total if method == 'sum' else total/area
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total/count
+    if method == 'sum':
+        return mean*np.prod(factor)
+    return mean
+
+def _axis_sum(a, axis, f, integer, lo, hi, start):
+    '''
+    Description
+      .sums of a over output bins lo..hi along axis, bin j spanning
+       input pixels j*f to (j+1)*f, with a starting at input pixel start
+    '''
+    if integer:
+        f = int(f)
+        a = np.moveaxis(a, axis, 0)
+        off = lo*f - start
+        a = a[off:off+(hi-lo)*f]
+        a = a.reshape((hi-lo, f)+a.shape[1:]).sum(axis=1)
+        return np.moveaxis(a, 0, axis)
+
+    a = np.moveaxis(a, axis, 0)
+    n = len(a)
+    #cumulative sums at pixel edges, interpolated at the bin edges
+    csum = np.zeros((n+1,)+a.shape[1:])
+    np.cumsum(a, axis=0, out=csum[1:])
+    edges = np.arange(lo, hi+1)*f - start
+    k = np.clip(np.floor(edges).astype(np.intp), 0, n-1)
+    frac = (edges-k).reshape((-1,)+(1,)*(a.ndim-1))
+    at = csum[k] + frac*a[k]
+    return np.moveaxis(at[1:]-at[:-1], 0, axis)
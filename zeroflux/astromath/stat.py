@@ -31,3 +31,314 @@ def sample_sphere_theta(unif):
     #returns uniform theta (polar angle) distribution, [0,pi]
     ''' 
     return np.arccos(1. - 2.*unif)
+
+class WeightedStats:
+    '''
+    Description
+      .Online weighted mean, variance and counts
+      .chunks of samples are merged as they arrive with the pairwise
+       updates of Chan et al. (1979), weighted as in West (1979),
+       so samples never need to be held in memory together
+      .works for scalars or whole image planes (shape of one sample),
+       and accumulators from different processes can be merged
+      .with inverse variance weights, err is the error of the mean,
+       as from funcs.weighted_mean
+    '''
+
+    def __init__(self, shape=()):
+        '''
+        Parameters:
+          .shape: shape of one sample, () for scalars
+        '''
+        self.shape = tuple(shape)
+        self.n = np.zeros(self.shape, dtype=np.int64) #N samples
+        self.wsum = np.zeros(self.shape) #sum of weights
+        self.w2sum = np.zeros(self.shape) #sum of squared weights
+        self.mean = np.zeros(self.shape) #weighted mean
+        self.m2 = np.zeros(self.shape) #weighted sum of squared deviations
+
+    def update(self, x, sig=None, w=None, mask=None, axis=None):
+        '''
+        Description
+          .adds one sample, or a chunk of samples along axis
+          .NaN values, non-positive weights and masked values are skipped
+
+        Parameters:
+          .x: sample (shape), or chunk with samples along axis
+          .sig: errors like x, weights are 1/sig^2, default None
+          .w: weights like x, default None (equal weights unless sig)
+          .mask: bool like x, True marks values to skip, default None
+          .axis: axis of samples in x, default None (x is one sample)
+
+        Returns:
+          .self, so updates can be chained
+        '''
+        x = np.asarray(x, dtype=float)
+        if w is None:
+            w = 1./np.asarray(sig, dtype=float)**2 if sig is not None else 1.
+        w = np.broadcast_to(np.asarray(w, dtype=float), x.shape)
+        with np.errstate(invalid='ignore'):
+            good = np.isfinite(x) & (w > 0)
+        if mask is not None:
+            good &= ~np.asarray(mask, dtype=bool)
+        w = np.where(good, w, 0.)
+        x = np.where(good, x, 0.)
+
+        if axis is None:
+            #single sample, no spread
+            return self._merge(good.astype(np.int64), w, w*w, x,
+                               np.zeros(x.shape))
+
+        n = good.sum(axis=axis)
+        wsum = w.sum(axis=axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(wsum > 0, (w*x).sum(axis=axis)/wsum, 0.)
+        dev = x - np.expand_dims(mean, axis)
+        m2 = (w*dev*dev).sum(axis=axis)
+        return self._merge(n, wsum, (w*w).sum(axis=axis), mean, m2)
+
+    def merge(self, other):
+        '''
+        Description
+          .adds the samples of another accumulator, e.g. from a worker
+
+        Parameters:
+          .other: WeightedStats of the same shape
+
+        Returns:
+          .self
+        '''
+        return self._merge(other.n, other.wsum, other.w2sum, other.mean,
+                           other.m2)
+
+    def _merge(self, n, wsum, w2sum, mean, m2):
+        '''
+        Description
+          .Chan et al. update with the statistics of a batch of samples
+        '''
+        total = self.wsum + wsum
+        delta = mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(total > 0, wsum/total, 0.)
+        self.mean = self.mean + delta*frac
+        self.m2 = self.m2 + m2 + delta*delta*self.wsum*frac
+        self.n = self.n + n
+        self.wsum = total
+        self.w2sum = self.w2sum + w2sum
+        return self
+
+    @property
+    def err(self):
+        '''
+        error of the mean for inverse variance weights, 1/sqrt(sum w)
+        '''
+        with np.errstate(divide='ignore'):
+            return 1./np.sqrt(self.wsum)
+
+    @property
+    def var(self):
+        '''
+        weighted variance of the samples
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.m2/self.wsum
+
+    @property
+    def sample_var(self):
+        '''
+        unbiased weighted variance, for reliability weights
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.m2/(self.wsum - self.w2sum/self.wsum)
+
+    def result(self):
+        '''
+        Description
+          .mean and its error, NaN where no samples
+
+        Returns:
+          .mean, err
+        '''
+        empty = self.wsum == 0
+        return np.where(empty, np.nan, self.mean), np.where(empty, np.nan,
+                                                            self.err)
+
+class DirectionSampler:
+    '''
+    Description
+      .Batched sampler of unit vectors for Monte Carlo
+      .draws uniforms into scratch buffers and writes x, y, z straight
+       into a 3 x N buffer, chunk by chunk, without temporaries
+      .'random' draws from a numpy Generator, 'halton' from a randomly
+       shifted Halton sequence (bases 2, 3) for quasi-random sampling
+      .g != 0 samples Henyey-Greenstein scattering angles about +z or
+       about given directions
+      .spawn gives independent, reproducible streams for processes
+    '''
+
+    def __init__(self, seed=None, method='random', g=0., dtype=np.float64,
+                 chunksize=2**18):
+        '''
+        Parameters:
+          .seed: int, None or numpy SeedSequence
+          .method: 'random' or 'halton'
+          .g: Henyey-Greenstein asymmetry parameter, 0 is isotropic
+          .dtype: np.float64 or np.float32
+          .chunksize: N directions per chunk of scratch buffers
+        '''
+        if method not in ('random', 'halton'):
+            raise ValueError("method must be 'random' or 'halton'")
+        self.seq = (seed if isinstance(seed, np.random.SeedSequence)
+                    else np.random.SeedSequence(seed))
+        self.rng = np.random.default_rng(self.seq)
+        self.method = method
+        self.g = g
+        self.dtype = np.dtype(dtype)
+        self.chunksize = chunksize
+        #halton position and random (Cranley-Patterson) shift
+        self.index = 0
+        self.shift = self.rng.random(2)
+        self._u1 = np.empty(chunksize, dtype=self.dtype)
+        self._u2 = np.empty(chunksize, dtype=self.dtype)
+
+    def spawn(self, n):
+        '''
+        Description
+          .independent samplers with the same settings, one per process
+          .halton streams get independent random shifts
+
+        Parameters:
+          .n: N samplers
+
+        Returns:
+          .list of DirectionSampler
+        '''
+        return [DirectionSampler(seq, method=self.method, g=self.g,
+                                 dtype=self.dtype, chunksize=self.chunksize)
+                for seq in self.seq.spawn(n)]
+
+    def sample(self, n=None, out=None, axis=None):
+        '''
+        Description
+          .draws unit vectors
+
+        Parameters:
+          .n: N directions, default None (size of out)
+          .out: 3 x N buffer to fill, default None (new array)
+          .axis: scattering about this direction, 3 vector or 3 x N
+                 unit vectors, default None (+z)
+
+        Returns:
+          .3 x N array of unit vectors (out, if given)
+        '''
+        if out is None:
+            out = np.empty((3, n), dtype=self.dtype)
+        n = out.shape[1]
+        if axis is not None:
+            axis = np.asarray(axis, dtype=self.dtype)
+
+        for start in range(0, n, self.chunksize):
+            stop = min(start+self.chunksize, n)
+            block = out[:, start:stop]
+            if axis is None:
+                self._fill(block)
+            else:
+                part = axis if axis.ndim == 1 else axis[:, start:stop]
+                self._fill(block, part)
+        return out
+
+    def _uniforms(self, m):
+        '''
+        Description
+          .m pairs of uniforms in the scratch buffers
+        '''
+        u1 = self._u1[:m]
+        u2 = self._u2[:m]
+        if self.method == 'random':
+            self.rng.random(out=u1, dtype=self.dtype)
+            self.rng.random(out=u2, dtype=self.dtype)
+        else:
+            idx = np.arange(self.index+1, self.index+m+1)
+            for u, base, shift in ((u1, 2, self.shift[0]),
+                                   (u2, 3, self.shift[1])):
+                u[:] = _radical_inverse(idx, base) + shift
+                u -= np.floor(u)
+            self.index += m
+        return u1, u2
+
+    def _fill(self, block, axis=None):
+        '''
+        Description
+          .writes unit vectors into a 3 x m block
+        '''
+        x, y, z = block
+        u1, u2 = self._uniforms(block.shape[1])
+        g = self.g
+
+        #cos(theta) into z
+        if g == 0:
+            np.multiply(u1, -2., out=z)
+            z += 1.
+        else:
+            #Henyey-Greenstein inverse cdf
+            np.multiply(u1, 2*g, out=z)
+            z += 1.-g
+            np.divide(1.-g*g, z, out=z)
+            np.square(z, out=z)
+            np.subtract(1.+g*g, z, out=z)
+            z /= 2*g
+            np.clip(z, -1., 1., out=z)
+
+        #sin(theta) into u1, azimuth from u2
+        np.square(z, out=u1)
+        np.subtract(1., u1, out=u1)
+        np.sqrt(u1, out=u1)
+        u2 *= 2*pi
+        np.cos(u2, out=x)
+        np.sin(u2, out=y)
+
+        if axis is None:
+            x *= u1
+            y *= u1
+            return
+
+        #rotate from +z to the axis directions
+        ux, uy, uz = axis
+        mu = z.copy()
+        cphi, sphi = x*u1, y*u1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sq = np.sqrt(1.-uz*uz)
+            inv = np.where(sq > 1e-6, 1./sq, 0.)
+        pole = sq <= 1e-6
+        x[:] = np.where(pole, cphi, (ux*uz*cphi - uy*sphi)*inv + ux*mu)
+        y[:] = np.where(pole, sphi, (uy*uz*cphi + ux*sphi)*inv + uy*mu)
+        z[:] = np.where(pole, np.sign(uz)*mu, -sq*cphi + uz*mu)
+
+def sample_directions(n, seed=None, **kwargs):
+    '''
+    Description
+      .n unit vectors from a new DirectionSampler, see DirectionSampler
+
+    Parameters:
+      .n: N directions
+      .seed: int, None or numpy SeedSequence
+      .kwargs: DirectionSampler settings
+
+    Returns:
+      .3 x n array of unit vectors
+    '''
+    return DirectionSampler(seed, **kwargs).sample(n)
+
+def _radical_inverse(idx, base):
+    '''
+    Description
+      .radical inverse of integers in a base, the Halton coordinates
+    '''
+    idx = idx.copy()
+    inv = np.zeros(len(idx))
+    scale = 1./base
+    while idx.any():
+        inv += (idx % base)*scale
+        idx //= base
+        scale /= base
+    return inv
@@ -1,3 +1,14 @@
 #
 
-__all__ = ["makecat"]
+import importlib
+
+__all__ = ["makecat", "colcat", "xmatch", "specio"]
+
+def __getattr__(name):
+    #modules are imported on first access, e.g. zeroflux.ioastro.xmatch
+    if name in __all__:
+        return importlib.import_module('.'+name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,236 @@
+import os
+import json
+
+import numpy as np
+from astropy.table import Table
+
+from zeroflux.astromath.funcs import sphere_to_cart
+
+def write_colcat(path, cat, ra='ra', dec='dec', zone_height=0.1,
+                 chunksize=2**22):
+    '''
+    Description
+      writes a catalog in columnar, memory-mappable format
+      path is a directory with one .npy file per column
+      rows are sorted by declination zone, then by ra within zones,
+      so the sky index is a small table of zone start rows
+      (zones algorithm, Gray et al. 2006)
+
+    Parameters
+      path: directory to write to, created if needed
+      cat: astropy Table, dict of arrays or structured array
+      ra: name of ra column, degrees
+      dec: name of dec column, degrees
+      zone_height: declination zone height in degrees
+      chunksize: N rows copied at a time per column
+
+    Returns
+      ColCat of the written catalog
+    '''
+    names = list(cat.dtype.names) if hasattr(cat, 'dtype') else list(cat)
+    ras = np.asarray(cat[ra], dtype=float)
+    decs = np.asarray(cat[dec], dtype=float)
+    nzones = int(np.ceil(180./zone_height))
+
+    zone = _zone(decs, zone_height, nzones)
+    order = np.lexsort((ras, zone))
+    starts = np.searchsorted(zone[order], np.arange(nzones+1))
+
+    os.makedirs(path, exist_ok=True)
+    columns = {}
+    for name in names:
+        col = np.asarray(cat[name])
+        out = np.lib.format.open_memmap(os.path.join(path, name+'.npy'),
+                                        mode='w+', dtype=col.dtype,
+                                        shape=col.shape)
+        for i in range(0, len(order), chunksize):
+            out[i:i+chunksize] = col[order[i:i+chunksize]]
+        out.flush()
+        del out
+        columns[name] = col.dtype.str
+
+    np.save(os.path.join(path, 'zones.npy'), starts)
+    meta = dict(nrows=len(order), columns=columns, ra=ra, dec=dec,
+                zone_height=zone_height, nzones=nzones)
+    with open(os.path.join(path, 'meta.json'), 'w') as fobj:
+        json.dump(meta, fobj, indent=1)
+
+    return ColCat(path)
+
+class ColCat:
+    '''
+    Columnar catalog with a declination-zone sky index
+
+    Each column is a memory-mapped .npy file, read only where accessed.
+    Cone and box searches binary search ra within the few zones they
+    overlap, so they touch only the candidate rows, not the catalog.
+    '''
+
+    def __init__(self, path):
+        '''
+        Parameters
+          path: catalog directory written by write_colcat
+        '''
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as fobj:
+            self.meta = json.load(fobj)
+        self.colnames = list(self.meta['columns'])
+        self.zones = np.load(os.path.join(path, 'zones.npy'))
+        self._columns = {}
+
+    def __len__(self):
+        return self.meta['nrows']
+
+    def __getitem__(self, name):
+        '''
+        memory-mapped column
+        '''
+        if name not in self._columns:
+            self._columns[name] = np.load(os.path.join(self.path, name+'.npy'),
+                                          mmap_mode='r')
+        return self._columns[name]
+
+    def rows(self, idx, columns=None):
+        '''
+        Description
+          reads selected rows
+
+        Parameters
+          idx: row indices or slice
+          columns: list of column names, default None (all)
+
+        Returns
+          astropy Table
+        '''
+        if columns is None:
+            columns = self.colnames
+        return Table({name: self[name][idx] for name in columns})
+
+    def cone_rows(self, ra, dec, radius):
+        '''
+        Description
+          indices of rows within radius of (ra, dec)
+
+        Parameters
+          ra, dec: cone center, degrees
+          radius: cone radius, degrees
+
+        Returns
+          sorted array of row indices
+        '''
+        h = self.meta['zone_height']
+        zmin = _zone(max(dec-radius, -90.), h, self.meta['nzones'])
+        zmax = _zone(min(dec+radius, 90.), h, self.meta['nzones'])
+
+        #half-width in ra of the cone, all of ra near the poles
+        if abs(dec)+radius >= 90.:
+            alpha = 180.
+        else:
+            alpha = np.degrees(np.arcsin(np.sin(np.radians(radius)) /
+                                         np.cos(np.radians(dec))))
+        cand = self._ra_ranges(zmin, zmax, ra-alpha, ra+alpha)
+        if len(cand) == 0:
+            return cand
+
+        #exact test on unit vectors: dot product >= cos(radius)
+        x, y, z = _unitvec(self[self.meta['ra']][cand],
+                           self[self.meta['dec']][cand])
+        x0, y0, z0 = _unitvec(ra, dec)
+        inside = x*x0 + y*y0 + z*z0 >= np.cos(np.radians(radius))
+        return cand[inside]
+
+    def cone(self, ra, dec, radius, columns=None):
+        '''
+        Description
+          rows within radius of (ra, dec)
+
+        Parameters
+          ra, dec: cone center, degrees
+          radius: cone radius, degrees
+          columns: list of column names, default None (all)
+
+        Returns
+          astropy Table
+        '''
+        return self.rows(self.cone_rows(ra, dec, radius), columns=columns)
+
+    def box_rows(self, ramin, ramax, decmin, decmax):
+        '''
+        Description
+          indices of rows in an ra, dec box
+          ramin > ramax wraps through ra = 0
+
+        Parameters
+          ramin, ramax: ra limits, degrees
+          decmin, decmax: dec limits, degrees
+
+        Returns
+          sorted array of row indices
+        '''
+        h = self.meta['zone_height']
+        zmin = _zone(decmin, h, self.meta['nzones'])
+        zmax = _zone(decmax, h, self.meta['nzones'])
+        if ramin > ramax:
+            ramax += 360.
+        cand = self._ra_ranges(zmin, zmax, ramin, ramax)
+        decs = self[self.meta['dec']][cand]
+        return cand[(decs >= decmin) & (decs <= decmax)]
+
+    def box(self, ramin, ramax, decmin, decmax, columns=None):
+        '''
+        Description
+          rows in an ra, dec box, see box_rows
+
+        Returns
+          astropy Table
+        '''
+        return self.rows(self.box_rows(ramin, ramax, decmin, decmax),
+                         columns=columns)
+
+    def _ra_ranges(self, zmin, zmax, ralo, rahi):
+        '''
+        Description
+          candidate rows of zones zmin..zmax with ra in [ralo, rahi]
+          limits may extend below 0 or above 360 to wrap
+        '''
+        if rahi-ralo >= 360.:
+            ranges = [(0., 360.)]
+        elif ralo < 0.:
+            ranges = [(0., rahi), (ralo+360., 360.)]
+        elif rahi > 360.:
+            ranges = [(ralo, 360.), (0., rahi-360.)]
+        else:
+            ranges = [(ralo, rahi)]
+
+        ras = self[self.meta['ra']]
+        cand = []
+        for z in range(zmin, zmax+1):
+            start, stop = self.zones[z], self.zones[z+1]
+            if start == stop:
+                continue
+            #ra is sorted within each zone
+            zra = ras[start:stop]
+            for lo, hi in ranges:
+                i0 = np.searchsorted(zra, lo, side='left')
+                i1 = np.searchsorted(zra, hi, side='right')
+                if i1 > i0:
+                    cand.append(np.arange(start+i0, start+i1))
+        if not cand:
+            return np.zeros(0, dtype=np.intp)
+        return np.sort(np.concatenate(cand))
+
+def _zone(dec, height, nzones):
+    '''
+    Description
+      declination zone index
+    '''
+    zone = np.floor((np.asarray(dec)+90.)/height).astype(np.intp)
+    return np.clip(zone, 0, nzones-1)
+
+def _unitvec(ra, dec):
+    '''
+    Description
+      unit vectors of ra, dec in degrees
+    '''
+    return sphere_to_cart(1., np.radians(90.-np.asarray(dec)),
+                          np.radians(ra))
@@ -1,5 +1,299 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+from scipy import ndimage
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+
+#flag bits
+FLAG_EDGE = 1 #source touches the image edge
+FLAG_TILE = 2 #source touches a tile overlap edge, may be truncated
+
+def background(image, box=64, sigma=3., maxiters=3):
+    '''
+    Description
+      estimates background and rms on a mesh of box x box cells
+      using sigma-clipped median and standard deviation per cell
+      cells are processed one mesh row at a time
+      NaN pixels are ignored
+
+    Parameters
+      image: 2D array
+      box: cell size in pixels
+      sigma: clipping threshold in standard deviations
+      maxiters: max clipping iterations
+
+    Returns
+      bkg: mesh of background values, ceil(rows/box) x ceil(cols/box)
+      rms: mesh of background rms values
+    '''
+    ny, nx = image.shape
+    mx = -(-nx // box)
+    my = -(-ny // box)
+    bkg = np.empty((my, mx))
+    rms = np.empty((my, mx))
+
+    cells = np.full((box, mx*box), np.nan)
+    for j in range(my):
+        rows = image[j*box:(j+1)*box]
+        cells[:] = np.nan
+        cells[:len(rows), :nx] = rows
+        #cells x pixels in cell
+        vals = cells.reshape(box, mx, box).transpose(1, 0, 2).reshape(mx, -1)
+        for _ in range(maxiters):
+            med = np.nanmedian(vals, axis=1)[:, None]
+            std = np.nanstd(vals, axis=1)[:, None]
+            clip = np.abs(vals-med) > sigma*std
+            if not clip.any():
+                break
+            vals[clip] = np.nan
+        bkg[j] = np.nanmedian(vals, axis=1)
+        rms[j] = np.nanstd(vals, axis=1)
+
+    return bkg, rms
+
+def mesh_interp(mesh, box, y0, y1, x0, x1):
+    '''
+    Description
+      bilinear interpolation of a background mesh onto image pixels
+      mesh values sit at cell centers, constant beyond the outer centers
+
+    Parameters
+      mesh: mesh from background
+      box: cell size in pixels
+      y0, y1, x0, x1: image region to interpolate onto
+
+    Returns
+      array, (y1-y0) x (x1-x0)
+    '''
+    def weights(lo, hi, nmesh):
+        pos = np.clip((np.arange(lo, hi)+0.5)/box-0.5, 0, nmesh-1)
+        i0 = np.minimum(np.floor(pos).astype(np.intp), max(nmesh-2, 0))
+        i1 = np.minimum(i0+1, nmesh-1)
+        return i0, i1, pos-i0
+
+    j0, j1, fy = weights(y0, y1, mesh.shape[0])
+    i0, i1, fx = weights(x0, x1, mesh.shape[1])
+    rows = mesh[j0]*(1-fy[:, None]) + mesh[j1]*fy[:, None]
+    return rows[:, i0]*(1-fx) + rows[:, i1]*fx
+
+def extract(image, thresh=1.5, minarea=5, box=64, err=None, header=None,
+            nproc=1, tilesize=2048, overlap=64, connectivity=8):
+    '''
+    Description
+      builds a source catalog from a calibrated image
+      background subtracts, thresholds at thresh x background rms,
+      labels connected pixels and measures all sources at once
+      with array reductions (no per-source loops)
+      large images are split into overlapping tiles spread over
+      nproc worker processes; a source is kept by the tile that
+      contains its centroid, so overlap should exceed source sizes
+
+    Parameters
+      image: 2D array, hdu or fits file name
+             file names are read memory-mapped by each worker
+      thresh: detection threshold in units of background rms
+      minarea: min N connected pixels of a source
+      box: background mesh cell size in pixels
+      err: 2D array of pixel errors for flux errors, default None
+           (background rms is used)
+      header: header with WCS to add ra, dec columns, default None
+              (taken from the hdu or file, if given)
+      nproc: N worker processes, default 1 (no pool)
+      tilesize: tile size in pixels
+      overlap: tile overlap in pixels
+      connectivity: 4 or 8 connected pixels
+
+    Returns
+      astropy Table of sources, with columns
+      x, y: flux weighted centroid, pixels
+      flux, fluxerr: background subtracted sum and its error
+      npix: N pixels above threshold
+      peak: max background subtracted value
+      a, b, theta: second moment semi-axes (pixels) and angle (rad)
+      xmin, xmax, ymin, ymax: bounding box, pixels
+      flag: FLAG_EDGE, FLAG_TILE bits
+      ra, dec: degrees, if a WCS header is available
+    '''
+    data, hdr, hdul = _open_image(image)
+    try:
+        return _extract(data, hdr, image, thresh, minarea, box, err, header,
+                        nproc, tilesize, overlap, connectivity)
+    finally:
+        if hdul is not None:
+            hdul.close()
+
+def _extract(data, hdr, image, thresh, minarea, box, err, header, nproc,
+             tilesize, overlap, connectivity):
+    '''
+    Description
+      extract on opened image data, see extract
+    '''
+    if header is None:
+        header = hdr
+    ny, nx = data.shape
+
+    bkg, rms = background(data, box=box)
+    params = (bkg, rms, box, thresh, minarea, connectivity, (ny, nx))
+
+    tiles = []
+    for y0 in range(0, ny, tilesize):
+        for x0 in range(0, nx, tilesize):
+            tiles.append((y0, min(y0+tilesize, ny), x0, min(x0+tilesize, nx),
+                          overlap))
+
+    results = []
+    if nproc == 1:
+        for tile in tiles:
+            results.append(_extract_tile(_cutouts(data, err, tile), tile,
+                                         params))
+    else:
+        #workers read tiles of file names themselves,
+        #arrays are sent per tile
+        source = image if isinstance(image, (str, os.PathLike)) else None
+        with ProcessPoolExecutor(nproc) as pool:
+            pending = deque()
+            for i, tile in enumerate(tiles):
+                cuts = _cutouts(data, err, tile)
+                if source is not None:
+                    cuts = (None, cuts[1])
+                pending.append(pool.submit(_worker_tile, cuts, tile, params,
+                                           source))
+                #bound the number of tiles in flight
+                while len(pending) > 2*nproc or (pending and i == len(tiles)-1):
+                    results.append(pending.popleft().result())
+
+    cols = {name: np.concatenate([res[name] for res in results])
+            for name in results[0]}
+    cat = Table(cols)
+
+    if header is not None and WCS(header).has_celestial:
+        ra, dec = WCS(header).celestial.pixel_to_world_values(cat['x'], cat['y'])
+        cat['ra'] = ra
+        cat['dec'] = dec
+    return cat
+
+def _extract_tile(cuts, tile, params):
+    '''
+    Description
+      detects and measures the sources of one tile
+
+    Parameters
+      cuts: (image cutout, error cutout or None), padded by overlap
+      tile: (y0, y1, x0, x1, overlap), tile core in image pixels
+      params: (bkg, rms, box, thresh, minarea, connectivity, image shape)
+
+    Returns
+      dict of source columns, sources with centroids in the tile core
+    '''
+    cut, errcut = cuts
+    y0, y1, x0, x1, overlap = tile
+    bkg, rms, box, thresh, minarea, connectivity, (ny, nx) = params
+    py0, py1, px0, px1 = _padded(tile, (ny, nx))
+
+    sub = cut - mesh_interp(bkg, box, py0, py1, px0, px1)
+    noise = mesh_interp(rms, box, py0, py1, px0, px1)
+    det = sub > thresh*noise
+
+    if connectivity == 8:
+        structure = np.ones((3, 3), dtype=bool)
+    else:
+        structure = ndimage.generate_binary_structure(2, 1)
+    labels, nlab = ndimage.label(det, structure=structure)
+
+    #detected pixels sorted by label, for bulk per-source reductions
+    pix = np.flatnonzero(labels)
+    lab = labels.ravel()[pix]
+    order = np.argsort(lab, kind='stable')
+    pix = pix[order]
+    lab = lab[order]-1
+    val = sub.ravel()[pix]
+    yy = pix // sub.shape[1] + py0
+    xx = pix % sub.shape[1] + px0
+    if errcut is None:
+        var = noise.ravel()[pix]**2
+    else:
+        var = np.asarray(errcut, dtype=float).ravel()[pix]**2
+    #first pixel of each source
+    starts = np.flatnonzero(np.diff(lab, prepend=-1))
+
+    npix = np.bincount(lab, minlength=nlab)
+    flux = np.bincount(lab, weights=val, minlength=nlab)
+    fluxerr = np.sqrt(np.bincount(lab, weights=var, minlength=nlab))
+    x = np.bincount(lab, weights=val*xx, minlength=nlab)/flux
+    y = np.bincount(lab, weights=val*yy, minlength=nlab)/flux
+    #second moments about the centroid
+    dx = xx-x[lab]
+    dy = yy-y[lab]
+    x2 = np.bincount(lab, weights=val*dx*dx, minlength=nlab)/flux
+    y2 = np.bincount(lab, weights=val*dy*dy, minlength=nlab)/flux
+    xy = np.bincount(lab, weights=val*dx*dy, minlength=nlab)/flux
+    half = (x2+y2)/2
+    root = np.sqrt(((x2-y2)/2)**2 + xy**2)
+    a = np.sqrt(half+root)
+    b = np.sqrt(np.maximum(half-root, 0))
+    theta = 0.5*np.arctan2(2*xy, x2-y2)
+
+    peak = np.maximum.reduceat(val, starts)
+    xmin = np.minimum.reduceat(xx, starts)
+    xmax = np.maximum.reduceat(xx, starts)
+    ymin = np.minimum.reduceat(yy, starts)
+    ymax = np.maximum.reduceat(yy, starts)
+
+    flag = np.zeros(nlab, dtype=np.int16)
+    flag[(xmin == 0) | (ymin == 0) | (xmax == nx-1) | (ymax == ny-1)] |= FLAG_EDGE
+    flag[((xmin == px0) & (px0 > 0)) | ((ymin == py0) & (py0 > 0)) |
+         ((xmax == px1-1) & (px1 < nx)) | ((ymax == py1-1) & (py1 < ny))] |= FLAG_TILE
+
+    #keep sources found by this tile, unique across overlapping tiles
+    keep = ((npix >= minarea) & (flux > 0) &
+            (x >= x0-0.5) & (x < x1-0.5) & (y >= y0-0.5) & (y < y1-0.5))
+    cols = dict(x=x, y=y, flux=flux, fluxerr=fluxerr, npix=npix, peak=peak,
+                a=a, b=b, theta=theta, xmin=xmin, xmax=xmax,
+                ymin=ymin, ymax=ymax, flag=flag)
+    return {name: col[keep] for name, col in cols.items()}
+
+def _padded(tile, shape):
+    '''
+    Description
+      tile region extended by the overlap, clipped to the image
+    '''
+    y0, y1, x0, x1, overlap = tile
+    return (max(y0-overlap, 0), min(y1+overlap, shape[0]),
+            max(x0-overlap, 0), min(x1+overlap, shape[1]))
+
+def _cutouts(data, err, tile):
+    py0, py1, px0, px1 = _padded(tile, data.shape)
+    errcut = None if err is None else err[py0:py1, px0:px1]
+    return data[py0:py1, px0:px1], errcut
 
-def placeholder():
+def _open_image(image):
+    '''
+    Description
+      (data, header, HDUList to close when done or None) of an array,
+      hdu or memory-mapped fits file
+    '''
+    if isinstance(image, (str, os.PathLike)):
+        hdul = fits.open(image, memmap=True)
+        return hdul[0].data, hdul[0].header, hdul
+    if hasattr(image, 'header'):
+        return image.data, image.header, None
+    return np.asarray(image), None, None
 
-    return
+def _worker_tile(cuts, tile, params, source=None):
+    '''
+    Description
+      _extract_tile in a pool worker, reading the tile cutout
+      from the fits file source if the image cutout is None
+    '''
+    if cuts[0] is None:
+        with fits.open(source, memmap=True) as hdul:
+            data = hdul[0].data
+            py0, py1, px0, px1 = _padded(tile, data.shape)
+            cut = np.array(data[py0:py1, px0:px1])
+            del data
+        cuts = (cut, cuts[1])
+    return _extract_tile(cuts, tile, params)
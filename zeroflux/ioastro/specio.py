@@ -0,0 +1,370 @@
+import numpy as np
+from astropy import units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from zeroflux.ioastro.xmatch import build_tree, radec_to_unitvec
+from zeroflux.spectroscopy.specutils import Spectrum, SpectrumBatch
+
+#candidate column and extension names, lowercase
+WAV_NAMES = ('wav', 'wave', 'wavelength', 'lambda', 'loglam')
+FLUX_NAMES = ('flux', 'data', 'sci')
+ERR_NAMES = ('err', 'error', 'flux_err', 'sigma', 'noise')
+VAR_NAMES = ('var', 'variance', 'stat')
+IVAR_NAMES = ('ivar', 'invvar')
+RA_NAMES = ('ra', 'target_ra', 'plug_ra', 'ra_obj')
+DEC_NAMES = ('dec', 'target_dec', 'plug_dec', 'dec_obj')
+
+def read_spectrum(path, hdu=1, wav=None, flux=None, err=None, zred=0.0):
+    '''
+    Description
+      reads a 1D spectrum from a fits binary table
+      the needed columns are copied out of the memory-mapped file,
+      which is closed before returning; column names are found from
+      common names unless given; loglam columns are log10
+      wavelengths, ivar columns are converted to errors
+
+    Parameters
+      path: fits file name
+      hdu: table extension, index or name
+      wav, flux, err: column names, default None (found)
+      zred: redshift of the Spectrum
+
+    Returns
+      Spectrum owning copies of the columns
+    '''
+    with fits.open(path, memmap=True) as hdul:
+        data = hdul[hdu].data
+        names = {name.lower(): name for name in data.columns.names}
+
+        wname = wav or _find(names, WAV_NAMES)
+        fname = flux or _find(names, FLUX_NAMES)
+        wavs = np.array(data[wname])
+        if wname.lower() == 'loglam':
+            wavs = 10**wavs
+        fluxes = np.array(data[fname])
+
+        errs = None
+        ename = err or _find(names, ERR_NAMES+VAR_NAMES+IVAR_NAMES,
+                             required=False)
+        if ename is not None:
+            errs = _to_err(np.array(data[ename]), _errtype(ename))
+    return Spectrum(wavs, fluxes, err=errs, zred=zred, copy=False)
+
+class SpecFile:
+    '''
+    Multi-spectrum fits file, memory-mapped
+
+    Fluxes are an image extension of N spectra x N pixels, with
+    optional error, variance or inverse variance images and a table
+    of targets (ra, dec). Spectra are read only when accessed, by
+    index, slice, sky position, or streamed in chunks.
+    '''
+
+    def __init__(self, path, flux=None, err=None, wav=None, targets=None,
+                 errtype=None):
+        '''
+        Parameters
+          path: fits file name
+          flux: flux extension, index or name, default None (found,
+                else the primary hdu)
+          err: error extension, default None (found, if any)
+          wav: wavelength extension, default None (found, else
+               from the flux header: CRVAL1/CDELT1, or COEFF0/COEFF1
+               for log10 wavelengths)
+          targets: target table extension, default None (found, if any)
+          errtype: 'err', 'var' or 'ivar' for the err extension,
+                   default None (from its name)
+        '''
+        self.hdul = fits.open(path, memmap=True)
+        ext = {hdu.name.lower(): i for i, hdu in enumerate(self.hdul)}
+
+        iflux = _ext(ext, flux, FLUX_NAMES, default=0)
+        self.flux = self.hdul[iflux].data
+        ierr = _ext(ext, err, ERR_NAMES+VAR_NAMES+IVAR_NAMES)
+        self._err = None if ierr is None else self.hdul[ierr].data
+        self.errtype = errtype or (None if ierr is None else
+                                   _errtype(self.hdul[ierr].name))
+
+        iwav = _ext(ext, wav, WAV_NAMES)
+        if iwav is not None:
+            self.wav = self.hdul[iwav].data
+        else:
+            self.wav = _header_wav(self.hdul[iflux].header, self.flux.shape[-1])
+
+        self.targets = None
+        itab = _ext(ext, targets, ('fibermap', 'targets', 'plugmap'))
+        if itab is None:
+            itab = next((i for i, hdu in enumerate(self.hdul)
+                         if isinstance(hdu, fits.BinTableHDU)), None)
+        if itab is not None:
+            self.targets = self.hdul[itab].data
+        self._tree = None
+
+    def __len__(self):
+        return len(self.flux)
+
+    def __getitem__(self, idx):
+        '''
+        Spectrum for an integer, SpectrumBatch view for a slice
+        '''
+        if isinstance(idx, (int, np.integer)):
+            return Spectrum(self._wav(idx), self.flux[idx],
+                            err=self.err(idx), copy=False)
+        return SpectrumBatch(self._wav(idx), self.flux[idx], err=self.err(idx))
+
+    def __iter__(self):
+        return self.iter_spectra()
+
+    def err(self, idx):
+        '''
+        errors of spectra idx, converted from var or ivar if needed
+        '''
+        if self._err is None:
+            return None
+        return _to_err(self._err[idx], self.errtype)
+
+    def iter_spectra(self, start=0, stop=None):
+        '''
+        Description
+          generator of Spectrum views, one at a time
+
+        Parameters
+          start, stop: range of spectra, default all
+        '''
+        for i in range(start, len(self) if stop is None else stop):
+            yield self[i]
+
+    def iter_chunks(self, chunksize=1024, start=0, stop=None):
+        '''
+        Description
+          generator of (first index, SpectrumBatch) for chunks of spectra
+          memory use is bounded by the chunk size
+
+        Parameters
+          chunksize: N spectra per chunk
+          start, stop: range of spectra, default all
+        '''
+        stop = len(self) if stop is None else stop
+        for i in range(start, stop, chunksize):
+            yield i, self[i:min(i+chunksize, stop)]
+
+    def cone(self, ra, dec, radius):
+        '''
+        Description
+          indices of targets within radius of (ra, dec)
+          the target kd-tree is built on first use
+
+        Parameters
+          ra, dec: cone center, degrees
+          radius: cone radius, degrees
+
+        Returns
+          sorted array of spectrum indices
+        '''
+        tree = self._target_tree()
+        chord = 2*np.sin(np.radians(radius)/2)
+        idx = tree.query_ball_point(radec_to_unitvec(ra, dec), chord)
+        return np.sort(np.asarray(idx, dtype=np.intp))
+
+    def nearest(self, ra, dec):
+        '''
+        Description
+          index and Spectrum of the target nearest to (ra, dec)
+
+        Returns
+          index, separation in degrees, Spectrum
+        '''
+        chord, i = self._target_tree().query(radec_to_unitvec(ra, dec))
+        sep = np.degrees(2*np.arcsin(min(chord, 2.)/2))
+        return i, sep, self[int(i)]
+
+    def _target_tree(self):
+        if self._tree is None:
+            if self.targets is None:
+                raise ValueError('file has no target table with ra, dec')
+            names = {name.lower(): name for name in self.targets.columns.names}
+            self._tree = build_tree(self.targets[_find(names, RA_NAMES)],
+                                    self.targets[_find(names, DEC_NAMES)])
+        return self._tree
+
+    def _wav(self, idx):
+        '''
+        shared wavelengths, or rows of a wavelength image
+        '''
+        return self.wav if self.wav.ndim == 1 else self.wav[idx]
+
+    def close(self):
+        self.hdul.close()
+
+class Cube:
+    '''
+    IFU data cube, memory-mapped
+
+    The fits cube is N wavelengths x ny x nx; the spectrum of a spaxel
+    is a strided view, read only when used. Spaxels are accessed by
+    pixel or sky position, or streamed as blocks of cube rows, so a
+    cube larger than memory is processed with constant memory.
+    '''
+
+    def __init__(self, path, data=None, err=None, errtype=None):
+        '''
+        Parameters
+          path: fits file name
+          data: data extension, index or name, default None (found,
+                else the first 3D hdu)
+          err: error extension, default None (found, if any)
+          errtype: 'err', 'var' or 'ivar', default None (from its name)
+        '''
+        self.hdul = fits.open(path, memmap=True)
+        ext = {hdu.name.lower(): i for i, hdu in enumerate(self.hdul)}
+
+        idata = _ext(ext, data, FLUX_NAMES)
+        if idata is None:
+            idata = next(i for i, hdu in enumerate(self.hdul)
+                         if hdu.header.get('NAXIS') == 3)
+        self.data = self.hdul[idata].data
+        self.header = self.hdul[idata].header
+        ierr = _ext(ext, err, ERR_NAMES+VAR_NAMES+IVAR_NAMES)
+        self._err = None if ierr is None else self.hdul[ierr].data
+        self.errtype = errtype or (None if ierr is None else
+                                   _errtype(self.hdul[ierr].name))
+
+        self.wcs = WCS(self.header)
+        self.wav = _header_wav(self.header, self.data.shape[0], axis=3)
+        self.shape = self.data.shape[1:]
+
+    def __len__(self):
+        return self.shape[0]*self.shape[1]
+
+    def __getitem__(self, yx):
+        '''
+        Spectrum of spaxel (y, x)
+        '''
+        y, x = yx
+        return self.spaxel(y, x)
+
+    def spaxel(self, y, x):
+        '''
+        Description
+          Spectrum viewing one spaxel
+
+        Parameters
+          y, x: spaxel pixel indices
+
+        Returns
+          Spectrum
+        '''
+        err = None if self._err is None else _to_err(self._err[:, y, x],
+                                                     self.errtype)
+        return Spectrum(self.wav, self.data[:, y, x], err=err, copy=False)
+
+    def at_sky(self, ra, dec):
+        '''
+        Description
+          Spectrum of the spaxel containing (ra, dec)
+
+        Parameters
+          ra, dec: degrees
+
+        Returns
+          (y, x), Spectrum
+        '''
+        x, y = self.wcs.celestial.world_to_pixel_values(ra, dec)
+        x, y = int(np.floor(x+0.5)), int(np.floor(y+0.5))
+        if not (0 <= y < self.shape[0] and 0 <= x < self.shape[1]):
+            raise IndexError('position outside the cube')
+        return (y, x), self.spaxel(y, x)
+
+    def iter_spectra(self):
+        '''
+        Description
+          generator of ((y, x), Spectrum) for every spaxel
+        '''
+        for y in range(self.shape[0]):
+            for x in range(self.shape[1]):
+                yield (y, x), self.spaxel(y, x)
+
+    def iter_chunks(self, nrows=16):
+        '''
+        Description
+          generator of (y0, SpectrumBatch) for blocks of nrows cube rows
+          flux rows are spaxels y0.. in row-major order, views of the
+          memory-mapped cube; memory use is bounded by the block size
+
+        Parameters
+          nrows: N cube rows per block
+        '''
+        nwav, ny, nx = self.data.shape
+        for y0 in range(0, ny, nrows):
+            y1 = min(y0+nrows, ny)
+            flux = self.data[:, y0:y1].reshape(nwav, -1).T
+            err = None
+            if self._err is not None:
+                err = _to_err(self._err[:, y0:y1].reshape(nwav, -1).T,
+                              self.errtype)
+            yield y0, SpectrumBatch(self.wav, flux, err=err)
+
+    def close(self):
+        self.hdul.close()
+
+def _find(names, candidates, required=True):
+    '''
+    Description
+      actual name of the first candidate in names, a dict of
+      lowercase to actual names
+    '''
+    for name in candidates:
+        if name in names:
+            return names[name]
+    if required:
+        raise KeyError('none of %s found' % (candidates,))
+    return None
+
+def _ext(ext, given, candidates, default=None):
+    '''
+    Description
+      index of a given extension, or of the first candidate name
+    '''
+    if given is not None:
+        return ext[given.lower()] if isinstance(given, str) else given
+    for name in candidates:
+        if name in ext:
+            return ext[name]
+    return default
+
+def _errtype(name):
+    name = name.lower()
+    if name in VAR_NAMES:
+        return 'var'
+    if name in IVAR_NAMES:
+        return 'ivar'
+    return 'err'
+
+def _to_err(arr, errtype):
+    '''
+    Description
+      errors from an err, var or ivar array; err arrays pass as views
+    '''
+    if errtype == 'err':
+        return arr
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if errtype == 'var':
+            return np.sqrt(arr)
+        return np.where(arr > 0, 1./np.sqrt(arr), np.inf)
+
+def _header_wav(header, n, axis=1):
+    '''
+    Description
+      wavelengths in A of a header spectral axis, from SDSS style
+      COEFF0/COEFF1 (log10 A) or the WCS of the axis
+    '''
+    if axis == 1 and 'COEFF0' in header:
+        return 10**(header['COEFF0'] + header['COEFF1']*np.arange(n))
+
+    sub = WCS(header).sub([axis])
+    wav = sub.pixel_to_world_values(np.arange(n))
+    unit = sub.wcs.cunit[0]
+    if unit != '' and u.Unit(unit).is_equivalent(u.AA):
+        wav = (wav*u.Unit(unit)).to_value(u.AA)
+    return np.asarray(wav)
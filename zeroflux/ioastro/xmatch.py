@@ -0,0 +1,148 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from zeroflux.astromath.funcs import sphere_to_cart
+
+def radec_to_unitvec(ra, dec):
+    '''
+    Description
+      converts ra, dec to cartesian unit vectors
+
+    Parameters
+      ra: right ascension(s), degrees
+      dec: declination(s), degrees
+
+    Returns
+      N x 3 array of unit vectors
+    '''
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    return sphere_to_cart(1., np.radians(90.-dec), np.radians(ra)).T
+
+def build_tree(ra, dec):
+    '''
+    Description
+      kd-tree of unit vectors, reusable for many xmatch calls
+
+    Parameters
+      ra, dec: catalog coordinates, degrees
+
+    Returns
+      scipy.spatial.cKDTree
+    '''
+    return cKDTree(radec_to_unitvec(ra, dec))
+
+def xmatch(ra1, dec1, ra2, dec2, radius=None, nthreads=1, chunksize=2**18):
+    '''
+    Description
+      nearest neighbor in catalog 2 of each source in catalog 1
+      catalog 2 is held in a kd-tree of unit vectors, O(N log M)
+      catalog 1 is matched in chunks, nthreads chunks at a time,
+      so memory beyond the tree is bounded by the chunk size
+
+    Parameters
+      ra1, dec1: catalog 1 coordinates, degrees
+      ra2, dec2: catalog 2 coordinates, degrees, or tree from build_tree
+                 (pass tree as ra2 and None as dec2)
+      radius: max match separation in degrees, default None (any)
+      nthreads: N threads matching chunks, default 1
+      chunksize: N catalog 1 sources per chunk
+
+    Returns
+      idx: index in catalog 2 of each match, -1 if none within radius
+      sep: separation in degrees, inf if none within radius
+    '''
+    tree = ra2 if isinstance(ra2, cKDTree) else build_tree(ra2, dec2)
+    ra1 = np.asarray(ra1, dtype=float)
+    dec1 = np.asarray(dec1, dtype=float)
+    bound = np.inf if radius is None else _chord(radius)
+
+    idx = np.empty(len(ra1), dtype=np.intp)
+    sep = np.empty(len(ra1))
+
+    def work(start):
+        stop = start+chunksize
+        vec = radec_to_unitvec(ra1[start:stop], dec1[start:stop])
+        dist, i = tree.query(vec, distance_upper_bound=bound)
+        nomatch = ~np.isfinite(dist)
+        i[nomatch] = -1
+        idx[start:stop] = i
+        sep[start:stop] = _angle(dist)
+
+    _run_chunks(work, len(ra1), chunksize, nthreads)
+    return idx, sep
+
+def xmatch_all(ra1, dec1, ra2, dec2, radius, nthreads=1, chunksize=2**18):
+    '''
+    Description
+      all pairs of sources within radius of each other
+      each chunk of catalog 1 gets its own small kd-tree,
+      paired against the tree of catalog 2
+
+    Parameters
+      ra1, dec1: catalog 1 coordinates, degrees
+      ra2, dec2: catalog 2 coordinates, degrees, or tree from build_tree
+                 (pass tree as ra2 and None as dec2)
+      radius: match radius, degrees
+      nthreads: N threads matching chunks, default 1
+      chunksize: N catalog 1 sources per chunk
+
+    Returns
+      idx1: catalog 1 index of each pair
+      idx2: catalog 2 index of each pair
+      sep: separation of each pair, degrees
+      pairs sorted by idx1, then idx2
+    '''
+    tree = ra2 if isinstance(ra2, cKDTree) else build_tree(ra2, dec2)
+    ra1 = np.asarray(ra1, dtype=float)
+    dec1 = np.asarray(dec1, dtype=float)
+    chord = _chord(radius)
+    results = {}
+
+    def work(start):
+        stop = start+chunksize
+        sub = cKDTree(radec_to_unitvec(ra1[start:stop], dec1[start:stop]))
+        pairs = sub.sparse_distance_matrix(tree, chord, output_type='ndarray')
+        results[start] = (pairs['i']+start, pairs['j'], pairs['v'])
+
+    _run_chunks(work, len(ra1), chunksize, nthreads)
+
+    if not results:
+        return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp),
+                np.zeros(0))
+    idx1, idx2, dist = [np.concatenate(col) for col in
+                        zip(*[results[start] for start in sorted(results)])]
+    order = np.lexsort((idx2, idx1))
+    return idx1[order], idx2[order], _angle(dist[order])
+
+def _run_chunks(work, n, chunksize, nthreads):
+    '''
+    Description
+      calls work(start) for every chunk, in a thread pool if nthreads > 1
+      kd-tree queries release the GIL
+    '''
+    starts = range(0, n, chunksize)
+    if nthreads == 1:
+        for start in starts:
+            work(start)
+    else:
+        with ThreadPoolExecutor(nthreads) as pool:
+            list(pool.map(work, starts))
+
+def _chord(angle):
+    '''
+    Description
+      chord length between unit vectors separated by angle in degrees
+    '''
+    return 2*np.sin(np.radians(angle)/2)
+
+def _angle(chord):
+    '''
+    Description
+      angle in degrees of chord length(s), inf stays inf
+    '''
+    with np.errstate(invalid='ignore'):
+        angle = np.degrees(2*np.arcsin(np.minimum(chord, 2.)/2))
+    return np.where(np.isfinite(chord), angle, np.inf)
@@ -1,3 +1,16 @@
 #
 
-__all__ = ["fitsphot", "photcalc"]
+import importlib
+
+__all__ = ["fitsphot", "photcalc", "combine", "calcache",
+           "reprojplan", "coadd", "aperphot",
+           "synphot"]
+
+def __getattr__(name):
+    #modules are imported on first access, e.g. zeroflux.photometry.photcalc
+    if name in __all__:
+        return importlib.import_module('.'+name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
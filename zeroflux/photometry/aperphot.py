@@ -0,0 +1,230 @@
+from collections import OrderedDict
+
+import numpy as np
+
+#aperture masks by shape and quantized subpixel phase,
+#the maxmasks most recently used are kept (one shape has up to
+#nphase^2 masks)
+_mask_cache = OrderedDict()
+maxmasks = 4096
+
+def aperture_photometry(image, x, y, r, rin=None, rout=None, b=None,
+                        theta=0., method='exact', subpix=5, nphase=16,
+                        sky='median', chunksize=None, maxmem=256.):
+    '''
+    Description
+      circular or elliptical aperture photometry of many sources
+      in one vectorized pass, with sky from an annulus
+      all sources share one aperture shape; aperture masks are
+      cached by shape and subpixel phase of the source center
+      NaN pixels and pixels off the image get zero weight
+      outputs go straight into photcalc.SNR_count
+
+    Parameters
+      image: 2D array
+      x, y: source positions, pixels (0 at first pixel center)
+      r: aperture radius, or semi-major axis if b given, pixels
+      rin, rout: sky annulus radii (semi-major axes), default None (no sky)
+      b: semi-minor axis for elliptical apertures, default None (circle)
+      theta: ellipse angle from x axis, radians
+      method: 'exact' circle/pixel overlap, 'subpixel' sampling with
+              subpix x subpix points per pixel, or 'center'
+              ellipses always use 'subpixel' unless 'center'
+      subpix: subpixel sampling per axis, for 'subpixel'
+      nphase: positions quantized to 1/nphase pixel so masks can be
+              cached, default 16; None uses exact positions, no caching
+      sky: 'median' of annulus pixels mostly inside it, or weighted 'mean'
+      chunksize: N sources per vectorized chunk, default None
+                 (as many as fit in maxmem)
+      maxmem: approx. memory budget per chunk in MB, for the
+              stamp-sized arrays of a chunk
+
+    Returns
+      flux: sky subtracted source counts
+      sky: sky counts per pixel (0 without annulus), NaN where the
+           annulus has no usable pixels, and so NaN flux
+      npix: N pixels in aperture (overlap weighted)
+      nsky: N pixels in annulus (overlap weighted, 0 without annulus)
+    '''
+    x = np.atleast_1d(np.asarray(x, dtype=float))
+    y = np.atleast_1d(np.asarray(y, dtype=float))
+    nsrc = len(x)
+    ratio = 1. if b is None else b/r
+    if b is not None and method == 'exact':
+        method = 'subpixel'
+    outer = r if rout is None else max(r, rout)
+    half = int(np.ceil(outer))+1
+    if chunksize is None:
+        #about ten N x size x size float arrays are alive at once,
+        #plus subsampled grids when masks are not cached
+        size = 2*half+1
+        persrc = 10*8*size**2
+        if nphase is None and method == 'subpixel':
+            persrc += 3*8*(subpix*size)**2
+        chunksize = max(int(maxmem*2**20 // persrc), 1)
+
+    flux = np.empty(nsrc)
+    skyval = np.zeros(nsrc)
+    npix = np.empty(nsrc)
+    nsky = np.zeros(nsrc)
+
+    for start in range(0, nsrc, chunksize):
+        cut = slice(start, start+chunksize)
+        stamps, good, px, py = _stamps(image, x[cut], y[cut], half)
+
+        w = aperture_masks(px, py, r, ratio, theta, half, method=method,
+                           subpix=subpix, nphase=nphase)*good
+        npix[cut] = w.sum(axis=(1, 2))
+        total = np.einsum('nij,nij->n', w, stamps)
+
+        if rin is not None and rout is not None:
+            wsky = (aperture_masks(px, py, rout, ratio, theta, half,
+                                   method=method, subpix=subpix,
+                                   nphase=nphase) -
+                    aperture_masks(px, py, rin, ratio, theta, half,
+                                   method=method, subpix=subpix,
+                                   nphase=nphase))*good
+            nsky[cut] = wsky.sum(axis=(1, 2))
+            if sky == 'mean':
+                skyval[cut] = np.divide(np.einsum('nij,nij->n', wsky, stamps),
+                                        nsky[cut], out=np.full(len(wsky), np.nan),
+                                        where=nsky[cut] > 0)
+            else:
+                #median of sources with any pixel mostly inside the annulus
+                inside = wsky >= 0.5
+                has = inside.any(axis=(1, 2))
+                vals = np.where(inside[has], stamps[has], np.nan)
+                skyval[cut] = np.nan
+                skyval[cut][has] = np.nanmedian(vals.reshape(len(vals), -1),
+                                                axis=1)
+
+        flux[cut] = total - skyval[cut]*npix[cut]
+
+    return flux, skyval, npix, nsky
+
+def aperture_masks(px, py, r, ratio=1., theta=0., half=None, method='exact',
+                   subpix=5, nphase=16):
+    '''
+    Description
+      aperture overlap weights on square stamps around sources
+      stamps span pixels -half..half about the pixel nearest each source
+
+    Parameters
+      px, py: source offsets from stamp center pixel, in [-0.5, 0.5)
+      r: radius or semi-major axis, pixels
+      ratio: axis ratio b/a, 1 for circles
+      theta: ellipse angle from x axis, radians
+      half: stamp half-size in pixels, default ceil(r)+1
+      method: 'exact' (circles), 'subpixel' or 'center'
+      subpix: subpixel sampling per axis
+      nphase: phases quantized to 1/nphase pixel and masks cached,
+              None for exact phases without caching
+
+    Returns
+      array, N x (2 half+1) x (2 half+1)
+    '''
+    if half is None:
+        half = int(np.ceil(r))+1
+    px = np.asarray(px, dtype=float)
+    py = np.asarray(py, dtype=float)
+    if nphase is None:
+        return _masks(px, py, r, ratio, theta, half, method, subpix)
+
+    #phase bins, offsets snapped to bin centers
+    ix = np.clip(np.floor((px+0.5)*nphase), 0, nphase-1).astype(np.intp)
+    iy = np.clip(np.floor((py+0.5)*nphase), 0, nphase-1).astype(np.intp)
+    bins, inverse = np.unique(iy*nphase+ix, return_inverse=True)
+
+    shape = (r, ratio, theta, half, method, subpix, nphase)
+    missing = [k for k in bins if (shape, k) not in _mask_cache]
+    if missing:
+        missing = np.array(missing)
+        new = _masks((missing % nphase + 0.5)/nphase - 0.5,
+                     (missing // nphase + 0.5)/nphase - 0.5,
+                     r, ratio, theta, half, method, subpix)
+        for k, mask in zip(missing, new):
+            _mask_cache[(shape, k)] = mask
+
+    unique = []
+    for k in bins:
+        _mask_cache.move_to_end((shape, k))
+        unique.append(_mask_cache[(shape, k)])
+    while len(_mask_cache) > maxmasks:
+        _mask_cache.popitem(last=False)
+    return np.array(unique)[inverse.ravel()]
+
+def _masks(px, py, r, ratio, theta, half, method, subpix):
+    '''
+    Description
+      aperture weights for exact source offsets, vectorized over sources
+    '''
+    #pixel edges relative to each source center
+    edges = np.arange(-half-0.5, half+1)
+    if method == 'exact':
+        ex = edges[None]-px[:, None]
+        ey = edges[None]-py[:, None]
+        corner = _corner_area(ex[:, None, :], ey[:, :, None], r)
+        return (corner[:, 1:, 1:] - corner[:, :-1, 1:] -
+                corner[:, 1:, :-1] + corner[:, :-1, :-1])
+
+    if method == 'center':
+        subpix = 1
+    #subpixel sample offsets within a pixel
+    sub = (np.arange(subpix)+0.5)/subpix-0.5
+    grid = np.arange(-half, half+1)
+    gx = (grid[:, None]+sub[None]).ravel()
+    dx = gx[None]-px[:, None]
+    dy = gx[None]-py[:, None]
+    cos, sin = np.cos(theta), np.sin(theta)
+    u = dx[:, None, :]*cos + dy[:, :, None]*sin
+    v = -dx[:, None, :]*sin + dy[:, :, None]*cos
+    inside = (u/r)**2 + (v/(r*ratio))**2 <= 1
+    size = 2*half+1
+    return inside.reshape(len(px), size, subpix, size, subpix).mean(axis=(2, 4))
+
+def _corner_area(x, y, r):
+    '''
+    Description
+      signed area of the disk of radius r inside the rectangle
+      between the origin and corner (x, y)
+      rectangle overlaps follow by inclusion-exclusion of corners
+    '''
+    sx = np.sign(x)
+    sy = np.sign(y)
+    x = np.minimum(np.abs(x), r)
+    y = np.minimum(np.abs(y), r)
+    #x where the circle crosses height y
+    xc = np.sqrt(r*r - y*y)
+
+    def integral(t):
+        #integral of sqrt(r^2 - t^2) from 0 to t
+        return 0.5*(t*np.sqrt(np.maximum(r*r - t*t, 0)) +
+                    r*r*np.arcsin(np.minimum(t/r, 1.)))
+
+    area = np.where(x <= xc, x*y, y*xc + integral(x) - integral(xc))
+    return sx*sy*area
+
+def _stamps(image, x, y, half):
+    '''
+    Description
+      square cutouts around sources by a single fancy-index gather
+
+    Returns
+      stamps: N x size x size, 0 off the image and at NaN pixels
+      good: N x size x size, 1 for usable pixels, else 0
+      px, py: source offsets from stamp center pixels
+    '''
+    ny, nx = image.shape
+    cx = np.floor(x+0.5).astype(np.intp)
+    cy = np.floor(y+0.5).astype(np.intp)
+    grid = np.arange(-half, half+1)
+    ix = cx[:, None]+grid
+    iy = cy[:, None]+grid
+    inx = (ix >= 0) & (ix < nx)
+    iny = (iy >= 0) & (iy < ny)
+
+    stamps = image[np.clip(iy, 0, ny-1)[:, :, None],
+                   np.clip(ix, 0, nx-1)[:, None, :]].astype(float)
+    good = (iny[:, :, None] & inx[:, None, :]) & np.isfinite(stamps)
+    stamps[~good] = 0.
+    return stamps, good, x-cx, y-cy
@@ -0,0 +1,192 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+class MasterCache:
+    '''
+    Content-addressed on-disk cache for master calibration frames
+
+    Masters are keyed on the content hashes of their input frames
+    and the combine parameters, and stored as .npy files in cachedir.
+    When the cache grows past maxsize, least recently used masters
+    are evicted. File modification times serve as the LRU clock.
+
+    Hashes of input files are remembered by (path, size, mtime),
+    so unchanged raw frames are not re-read on reruns.
+    '''
+
+    def __init__(self, cachedir, maxsize=10.):
+        '''
+        Parameters
+          cachedir: directory to store cached masters in
+          maxsize: max total size of cached masters in GB
+        '''
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        os.makedirs(cachedir, exist_ok=True)
+        self._hashfile = os.path.join(cachedir, 'filehashes.json')
+        try:
+            with open(self._hashfile) as fobj:
+                self._filehashes = json.load(fobj)
+        except (OSError, ValueError):
+            self._filehashes = {}
+
+    def key(self, kind, frames, *args, **params):
+        '''
+        Description
+          content hash identifying a master product
+
+        Parameters
+          kind: string naming the product, e.g. 'bias'
+          frames: list of input hdus, arrays or fits file names
+          args: further inputs, e.g. master bias data
+          params: combine parameters, values may be arrays
+
+        Returns
+          hex digest string
+        '''
+        sha = hashlib.sha256(kind.encode())
+        for frame in frames:
+            sha.update(self.hash_frame(frame).encode())
+        for arg in args:
+            sha.update(_hash_value(arg).encode())
+        for name in sorted(params):
+            sha.update(name.encode())
+            sha.update(_hash_value(params[name]).encode())
+        self._save_hashes()
+        return sha.hexdigest()
+
+    def hash_frame(self, frame):
+        '''
+        Description
+          content hash of one input frame
+          hdus are hashed with their header, which builders read
+          keywords such as EXPTIME from, as files are hashed whole
+          file hashes are remembered until the file changes
+
+        Parameters
+          frame: hdu, array or fits file name
+
+        Returns
+          hex digest string
+        '''
+        if not isinstance(frame, (str, os.PathLike)):
+            header = getattr(frame, 'header', None)
+            digest = _hash_value(getattr(frame, 'data', frame))
+            if header is None:
+                return digest
+            return _hash_value((digest, header.tostring()))
+
+        path = os.path.abspath(frame)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        known = self._filehashes.get(path)
+        if known is not None and known[:2] == stamp:
+            return known[2]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fobj:
+            for block in iter(lambda: fobj.read(2**20), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        self._filehashes[path] = stamp + [digest]
+        return digest
+
+    def get(self, key):
+        '''
+        Description
+          cached master for key, marked as recently used
+
+        Parameters
+          key: from MasterCache.key
+
+        Returns
+          copy-on-write memory-mapped array, or None if not cached
+        '''
+        path = self._path(key)
+        try:
+            master = np.load(path, mmap_mode='c')
+        except (OSError, ValueError):
+            return None
+        os.utime(path)
+        return master
+
+    def put(self, key, master):
+        '''
+        Description
+          stores master under key, then evicts old entries
+          if the cache is larger than maxsize
+
+        Parameters
+          key: from MasterCache.key
+          master: master data array
+        '''
+        path = self._path(key)
+        #write under a temporary name so readers never see partial files
+        tmp = path+'.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as fobj:
+            np.save(fobj, np.asarray(master))
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self, maxsize=None):
+        '''
+        Description
+          removes least recently used masters until the
+          cache is at most maxsize GB
+
+        Parameters
+          maxsize: size limit in GB, default self.maxsize
+        '''
+        if maxsize is None:
+            maxsize = self.maxsize
+        entries = []
+        for name in os.listdir(self.cachedir):
+            if name.endswith('.npy'):
+                stat = os.stat(os.path.join(self.cachedir, name))
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= maxsize * 2**30:
+                break
+            os.remove(os.path.join(self.cachedir, name))
+            total -= size
+
+    def clear(self):
+        '''
+        Description
+          removes all cached masters and remembered file hashes
+        '''
+        self.evict(maxsize=0)
+        self._filehashes = {}
+        self._save_hashes()
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, key+'.npy')
+
+    def _save_hashes(self):
+        tmp = self._hashfile+'.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as fobj:
+            json.dump(self._filehashes, fobj)
+        os.replace(tmp, self._hashfile)
+
+def _hash_value(value):
+    '''
+    Description
+      content hash of an array or of the repr of any other value
+      lists and tuples are hashed element by element
+    '''
+    sha = hashlib.sha256()
+    if value is None or np.isscalar(value):
+        sha.update(repr(value).encode())
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            sha.update(_hash_value(item).encode())
+    else:
+        arr = np.ascontiguousarray(value)
+        sha.update(str((arr.dtype.str, arr.shape)).encode())
+        sha.update(memoryview(arr).cast('B'))
+    return sha.hexdigest()
@@ -0,0 +1,192 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from zeroflux.photometry.combine import _new_master, _open_frame
+from zeroflux.photometry.reprojplan import ReprojPlan
+
+def coadd(inputs, header, weights=None, outfile=None, weightfile=None,
+          nproc=1, tilesize=1024, dtype=np.float32):
+    '''
+    Description
+      weighted mean mosaic of many images on a shared output WCS
+      the output is split into tiles, each tile is reprojected
+      and accumulated by one of nproc worker processes
+      only the images overlapping a tile are reprojected onto it,
+      so memory is bounded by the tile size, not the mosaic size
+      outputs can be memory-mapped fits files, for mosaics larger than RAM
+
+    Parameters
+      inputs: list of hdus or fits file names
+              file names are opened by the workers for each tile and
+              only the pixels under the tile are read (section reads
+              for scaled files), then closed
+              hdu data is copied once to each worker
+      header: output header with celestial WCS and NAXIS1/NAXIS2
+      weights: list of per-image weights, default None (equal)
+      outfile: fits file for the coadded image, default None (in memory)
+      weightfile: fits file for the weight map, default None (in memory)
+      nproc: N worker processes, default 1 (no pool)
+      tilesize: output tile size in pixels, default 1024
+      dtype: output dtype, default np.float32
+
+    Returns
+      image: weighted mean, NaN where no input covers the output
+      weight: sum of weights of the inputs covering each pixel
+    '''
+    shape = (header['NAXIS2'], header['NAXIS1'])
+    wcs = WCS(header).celestial
+    if weights is None:
+        weights = np.ones(len(inputs))
+
+    #headers and shapes only, pixels are read by the workers
+    sources = [_source(inp) for inp in inputs]
+    boxes = [_bbox(WCS(hdr).celestial, shape, wcs)
+             for hdr, shape, _ in sources]
+
+    wcshdr = wcs.to_header()
+    image = _new_master(shape, dtype, outfile, header=wcshdr)
+    weight = _new_master(shape, dtype, weightfile, header=wcshdr)
+
+    #tiles and the inputs overlapping them
+    tasks = []
+    for y0 in range(0, shape[0], tilesize):
+        for x0 in range(0, shape[1], tilesize):
+            y1 = min(y0+tilesize, shape[0])
+            x1 = min(x0+tilesize, shape[1])
+            over = [k for k, (by0, by1, bx0, bx1) in enumerate(boxes)
+                    if by0 < y1 and by1 > y0 and bx0 < x1 and bx1 > x0]
+            tasks.append((y0, y1, x0, x1, over))
+
+    def write(task, result):
+        y0, y1, x0, x1, _ = task
+        image[y0:y1, x0:x1], weight[y0:y1, x0:x1] = result
+
+    if nproc == 1:
+        _init_worker(sources)
+        try:
+            for task in tasks:
+                write(task, _coadd_tile(wcs, task, weights, dtype))
+        finally:
+            _init_worker(None)
+    else:
+        #workers open files themselves, hdu data is sent once
+        with ProcessPoolExecutor(nproc, initializer=_init_worker,
+                                 initargs=(sources,)) as pool:
+            pending = deque()
+            for i, task in enumerate(tasks):
+                pending.append((task, pool.submit(_coadd_tile, wcs, task,
+                                                  weights, dtype)))
+                #bound the number of tiles in flight
+                while len(pending) > 2*nproc or (pending and i == len(tasks)-1):
+                    done, future = pending.popleft()
+                    write(done, future.result())
+
+    if outfile is not None:
+        image.flush()
+    if weightfile is not None:
+        weight.flush()
+    return image, weight
+
+def _coadd_tile(wcs, task, weights, dtype):
+    '''
+    Description
+      reprojects and accumulates the inputs overlapping one tile
+
+    Parameters
+      wcs: celestial WCS of the mosaic
+      task: (y0, y1, x0, x1, indices of overlapping inputs)
+      weights: per-input weights
+      dtype: output dtype
+
+    Returns
+      image and weight of tile
+    '''
+    y0, y1, x0, x1, over = task
+    tilewcs = wcs[y0:y1, x0:x1]
+    total = np.zeros((y1-y0, x1-x0))
+    wsum = np.zeros((y1-y0, x1-x0))
+
+    for k in over:
+        hdr, shape, inp = _worker_inputs[k]
+        wcs_in = WCS(hdr).celestial
+        #input pixels under the tile
+        ry0, ry1, rx0, rx1 = _bbox(tilewcs, (y1-y0, x1-x0), wcs_in)
+        ry0, rx0 = max(ry0, 0), max(rx0, 0)
+        ry1, rx1 = min(ry1, shape[0]), min(rx1, shape[1])
+        if ry1 <= ry0 or rx1 <= rx0:
+            continue
+        if isinstance(inp, np.ndarray):
+            pix, hdul = inp, None
+        else:
+            pix, _, hdul = _open_frame(inp)
+        try:
+            data = np.array(pix[ry0:ry1, rx0:rx1])
+        finally:
+            if hdul is not None:
+                hdul.close()
+        #one-off plan, not cached, so full-frame plans stay in get_plan
+        plan = ReprojPlan(wcs_in[ry0:ry1, rx0:rx1], data.shape, tilewcs,
+                          (y1-y0, x1-x0))
+        rep = plan.apply(data)
+        #NaN inputs and pixels outside the footprint get no weight
+        good = np.isfinite(rep)
+        total[good] += weights[k]*rep[good]
+        wsum[good] += weights[k]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tile = np.where(wsum > 0, total/wsum, np.nan)
+    return tile.astype(dtype), wsum.astype(dtype)
+
+#inputs of each pool worker, (header, shape, file name or hdu data)
+_worker_inputs = None
+
+def _init_worker(sources):
+    global _worker_inputs
+    _worker_inputs = sources
+
+def _source(inp):
+    '''
+    Description
+      (header, shape, file name or data) of an hdu or fits file,
+      reading only the header of files
+    '''
+    if isinstance(inp, (str, os.PathLike)):
+        with fits.open(inp, memmap=True) as hdul:
+            hdr = hdul[0].header.copy()
+        return hdr, (hdr['NAXIS2'], hdr['NAXIS1']), inp
+    return inp.header, inp.data.shape, inp.data
+
+def _bbox(wcs_from, shape, wcs, nedge=16):
+    '''
+    Description
+      bounding box of an image in the pixels of another WCS
+      from points sampled along its edges
+
+    Parameters
+      wcs_from: celestial WCS of the image
+      shape: image shape, rows x cols
+      wcs: celestial WCS of the box pixels
+      nedge: N points sampled per edge
+
+    Returns
+      y0, y1, x0, x1, empty box if the image does not project
+    '''
+    ny, nx = shape
+    xs = np.linspace(-0.5, nx-0.5, nedge)
+    ys = np.linspace(-0.5, ny-0.5, nedge)
+    x = np.concatenate([xs, xs, np.full(nedge, -0.5), np.full(nedge, nx-0.5)])
+    y = np.concatenate([np.full(nedge, -0.5), np.full(nedge, ny-0.5), ys, ys])
+
+    sky = wcs_from.pixel_to_world(x, y)
+    xo, yo = wcs.world_to_pixel(sky)
+    good = np.isfinite(xo) & np.isfinite(yo)
+    if not good.any():
+        return 0, 0, 0, 0
+    #one pixel margin for curvature between the sampled points
+    return (int(np.floor(yo[good].min()))-1, int(np.ceil(yo[good].max()))+2,
+            int(np.floor(xo[good].min()))-1, int(np.ceil(xo[good].max()))+2)
@@ -0,0 +1,300 @@
+import os
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+def combine_stack(stack, method='median', sigma=3., maxiters=5,
+                  nlow=1, nhigh=1):
+    '''
+    Description
+      combines a stack of frames along its first axis
+      NaN values are treated as masked and ignored
+      stack is used as scratch space and is modified
+
+    Parameters
+      stack: array, nframes x rows x cols
+      method: 'median', 'mean', 'sigclip' or 'minmax'
+              sigclip: mean after iterative clipping about the median
+              minmax: mean after rejecting nlow lowest, nhigh highest
+      sigma: clipping threshold in standard deviations, for sigclip
+      maxiters: max clipping iterations, for sigclip
+      nlow: N lowest values rejected per pixel, for minmax
+      nhigh: N highest values rejected per pixel, for minmax
+
+    Returns
+      combined array, rows x cols
+      NaN where every frame was masked or rejected
+    '''
+    masked = stack.dtype.kind == 'f' and np.isnan(stack).any()
+
+    with warnings.catch_warnings():
+        #fully masked pixels give all-NaN slices, left as NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        if method == 'median':
+            if masked:
+                return np.nanmedian(stack, axis=0, overwrite_input=True)
+            return np.median(stack, axis=0, overwrite_input=True)
+
+        elif method == 'mean':
+            if masked:
+                return np.nanmean(stack, axis=0)
+            return np.mean(stack, axis=0)
+
+        elif method == 'sigclip':
+            for _ in range(maxiters):
+                center = np.nanmedian(stack, axis=0)
+                std = np.nanstd(stack, axis=0)
+                clip = np.abs(stack-center) > sigma*std
+                if not clip.any():
+                    break
+                stack[clip] = np.nan
+            return np.nanmean(stack, axis=0)
+
+        elif method == 'minmax':
+            #NaNs sort to the end, so valid values are first ngood
+            ngood = stack.shape[0] - np.isnan(stack).sum(axis=0)
+            stack.sort(axis=0)
+            rank = np.arange(stack.shape[0]).reshape((-1,)+(1,)*(stack.ndim-1))
+            keep = (rank >= nlow) & (rank < ngood-nhigh)
+            return np.nanmean(np.where(keep, stack, np.nan), axis=0)
+
+    raise ValueError("method must be 'median', 'mean', 'sigclip' or 'minmax'")
+
+def combine_frames(frames, method='median', offset=None, scales=None,
+                   masks=None, sigma=3., maxiters=5, nlow=1, nhigh=1,
+                   nproc=1, maxmem=256., outfile=None):
+    '''
+    Description
+      combines calibration frames tile by tile
+      tiles are strips of rows, spread over a pool of nproc processes
+      each frame is offset subtracted then divided by its scale,
+      (frame - offset)/scale, before combining
+      fits file names are read memory-mapped by each worker
+
+    Parameters
+      frames: list of hdus or fits file names
+      method: 'median', 'mean', 'sigclip' or 'minmax', see combine_stack
+      offset: array or value subtracted from each frame, e.g. master bias
+      scales: list of values each frame is divided by, e.g. exposure times
+      masks: list of bool arrays (or None entries), True marks bad pixels
+      sigma, maxiters, nlow, nhigh: rejection parameters, see combine_stack
+      nproc: N worker processes, default 1 (no pool)
+      maxmem: approx. memory budget per tile stack in MB
+      outfile: fits file to write combined frame to tile by tile
+               default None (in memory)
+
+    Returns
+      combined data array, memory-mapped from outfile if given
+    '''
+    nframes = len(frames)
+    if scales is not None:
+        scales = [float(scale) for scale in scales]
+    if masks is None:
+        masks = [None]*nframes
+
+    opened = [_open_frame(frame) for frame in frames]
+    try:
+        ny, nx = opened[0][0].shape
+        #stack dtype, as np.array of the processed frames would give
+        dtype = np.result_type(*[_prep(pix[0:1], k, 0, 1, offset, scales)
+                                 for k, (pix, _, _) in enumerate(opened)])
+        #masking and rejection need a float stack
+        if dtype.kind != 'f' and (method != 'median' or
+                                  any(mask is not None for mask in masks)):
+            dtype = np.dtype(np.float64)
+
+        nrows = int(maxmem * 2**20 // (nframes * nx * dtype.itemsize))
+        if nrows < 1:
+            raise ValueError('maxmem too small for a single row of %d frames'
+                             % nframes)
+        if nproc > 1:
+            #several tiles per worker to balance the load
+            nrows = min(nrows, -(-ny // (4*nproc)))
+        nrows = min(nrows, ny)
+        params = (dtype, method, sigma, maxiters, nlow, nhigh)
+
+        master = None
+        if nproc == 1:
+            for y0 in range(0, ny, nrows):
+                y1 = min(y0+nrows, ny)
+                tiles = [pix[y0:y1] for pix, _, _ in opened]
+                med = _combine_tile(tiles, _tile_args(y0, y1, offset, scales,
+                                                      masks), params)
+                if master is None:
+                    master = _new_master((ny, nx), med.dtype, outfile)
+                master[y0:y1] = med
+
+        else:
+            #files are opened by the workers, hdu data is sent per tile
+            paths = [frame if hdul is not None else None
+                     for frame, (_, _, hdul) in zip(frames, opened)]
+            with ProcessPoolExecutor(nproc, initializer=_init_worker,
+                                     initargs=(paths,)) as pool:
+                pending = deque()
+                for y0 in range(0, ny, nrows):
+                    y1 = min(y0+nrows, ny)
+                    tiles = [None if hdul is not None else pix[y0:y1]
+                             for pix, _, hdul in opened]
+                    pending.append((y0, y1, pool.submit(
+                        _worker_tile, tiles, y0, y1,
+                        _tile_args(y0, y1, offset, scales, masks), params)))
+                    #bound the number of tiles in flight
+                    while len(pending) > 2*nproc or (pending and y1 == ny):
+                        t0, t1, future = pending.popleft()
+                        med = future.result()
+                        if master is None:
+                            master = _new_master((ny, nx), med.dtype, outfile)
+                        master[t0:t1] = med
+    finally:
+        for _, _, hdul in opened:
+            if hdul is not None:
+                hdul.close()
+
+    if outfile is not None:
+        master.flush()
+    return master
+
+def _prep(pix, k, y0, y1, offset, scales):
+    '''
+    Description
+      offset subtracts and scales one tile of frame k
+
+    Parameters
+      pix: tile of frame k
+      k: frame index
+      y0, y1: tile rows
+      offset: array or value subtracted from frame, or None
+      scales: list of values frames are divided by, or None
+
+    Returns
+      processed tile
+    '''
+    if offset is not None:
+        if np.ndim(offset) == 2:
+            pix = pix - offset[y0:y1]
+        else:
+            pix = pix - offset
+    if scales is not None:
+        pix = pix/scales[k]
+    return pix
+
+def _tile_args(y0, y1, offset, scales, masks):
+    '''
+    Description
+      cuts the per-pixel inputs of one tile
+
+    Returns
+      (offset, scales, masks) for tile, rows renumbered from 0
+    '''
+    if np.ndim(offset) == 2:
+        offset = offset[y0:y1]
+    masks = [None if mask is None else mask[y0:y1] for mask in masks]
+    return offset, scales, masks
+
+def _combine_tile(tiles, args, params):
+    '''
+    Description
+      fills and combines the stack of one tile
+
+    Parameters
+      tiles: list of frame tiles
+      args: (offset, scales, masks) from _tile_args
+      params: (dtype, method, sigma, maxiters, nlow, nhigh)
+
+    Returns
+      combined tile
+    '''
+    offset, scales, masks = args
+    dtype, method, sigma, maxiters, nlow, nhigh = params
+
+    ny = tiles[0].shape[0]
+    stack = np.empty((len(tiles),)+tiles[0].shape, dtype=dtype)
+    for k, (tile, mask) in enumerate(zip(tiles, masks)):
+        stack[k] = _prep(tile, k, 0, ny, offset, scales)
+        if mask is not None:
+            stack[k][mask] = np.nan
+
+    return combine_stack(stack, method=method, sigma=sigma,
+                         maxiters=maxiters, nlow=nlow, nhigh=nhigh)
+
+#frames opened by each pool worker, indexed as in combine_frames
+_worker_frames = None
+
+def _init_worker(paths):
+    global _worker_frames
+    _worker_frames = [None if path is None else _open_frame(path)
+                      for path in paths]
+
+def _worker_tile(tiles, y0, y1, args, params):
+    tiles = [tile if tile is not None else frame[0][y0:y1]
+             for tile, frame in zip(tiles, _worker_frames)]
+    return _combine_tile(tiles, args, params)
+
+def _open_frame(frame):
+    '''
+    Description
+      access a calibration frame without reading all of its pixels
+      fits file names are opened memory-mapped
+      scaled integer files (BZERO/BSCALE) are read through hdu.section,
+      which applies the same scaling as hdu.data one strip at a time
+
+    Parameters
+      frame: hdu or fits file name
+
+    Returns
+      pix: array-like supporting row slicing, pix[y0:y1]
+      header: fits header of frame
+      hdul: opened HDUList to close when done, None for hdus
+    '''
+    if not isinstance(frame, (str, os.PathLike)):
+        return frame.data, frame.header, None
+
+    hdul = fits.open(frame, memmap=True)
+    hdu = hdul[0]
+    scaled = any(key in hdu.header for key in ('BZERO', 'BSCALE', 'BLANK'))
+    if scaled:
+        #memory-mapped scaling is not allowed, reopen for section reads
+        hdul.close()
+        hdul = fits.open(frame, memmap=False)
+        hdu = hdul[0]
+        return hdu.section, hdu.header, hdul
+    return hdu.data, hdu.header, hdul
+
+def _new_master(shape, dtype, outfile=None, header=None):
+    '''
+    Description
+      allocates master frame, in memory or as memory-mapped fits file
+
+    Parameters
+      shape: image shape, rows x cols
+      dtype: numpy dtype of master
+      outfile: fits file name, default None (in memory)
+      header: extra header cards for outfile, e.g. WCS, default None
+
+    Returns
+      writeable array of given shape and dtype
+    '''
+    if outfile is None:
+        return np.empty(shape, dtype=dtype)
+
+    #write header only, then extend the file to its full padded size
+    extra = header
+    header = fits.PrimaryHDU(data=np.zeros((1, 1), dtype=dtype)).header
+    header['NAXIS1'] = shape[1]
+    header['NAXIS2'] = shape[0]
+    if extra is not None:
+        header.update(extra)
+    header.tofile(outfile, overwrite=True)
+    offset = len(header.tostring())
+    nbytes = shape[0]*shape[1]*np.dtype(dtype).itemsize
+    with open(outfile, 'rb+') as fobj:
+        fobj.seek(offset + nbytes + (-nbytes % 2880) - 1)
+        fobj.write(b'\0')
+
+    #fits data are big-endian
+    return np.memmap(outfile, dtype=np.dtype(dtype).newbyteorder('>'),
+                     mode='r+', offset=offset, shape=shape)
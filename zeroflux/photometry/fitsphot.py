@@ -1,45 +1,152 @@
+import os
+import glob
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+from astropy.io import fits
 from astropy.wcs import WCS
 
+from zeroflux.photometry.combine import combine_frames
+from zeroflux.photometry.reprojplan import get_plan
+
 try:
     from reproject import reproject_interp
-except ModuleNotFoundError
+except ModuleNotFoundError:
     print('Warning: reproject package not installed')
 
-def calibrate_sci(sci, flt, zro, exptime=True):
+def calibrate_sci(sci, flt, zro, exptime=True, dtype=None):
     '''
     Description
       subtracts bias and flat fields science image
+      works on one copy of the data, all steps are in place
       
     Parameters
       sci: science hdu
       flt: master flat hdu
       zro: master bias hdu
       exptime: bool, divide sci by exposure time
+      dtype: dtype of calibrated data, e.g. np.float32
+             default None, float type of sci, flt and zro combined
       
     Returns
       None
     '''
     
-    bias_sub = sci.data-zro.data
-    flat_fielded = bias_sub/flt.data
-    if exptime:
-        #divide by exposure time
-        flat_fielded /= sci.header['EXPTIME']
-    sci.data = flat_fielded
+    sci.data = _calibrate(sci.data, sci.header, flt.data, zro.data,
+                          exptime=exptime, dtype=dtype)
                   
     return
 
+def calibrate_batch(scis, flt, zro, outdir=None, exptime=True,
+                    dtype=np.float32, nthreads=4, suffix='_cal',
+                    overwrite=False):
+    '''
+    Description
+      calibrates many science frames with the same master frames
+      masters are read once and shared by a pool of threads
+      each frame is calibrated in place, see calibrate_sci
+      numpy and fits i/o release the GIL, so threads run concurrently
+      
+    Parameters
+      scis: directory of fits files, or list of fits file names
+      flt: master flat hdu, data array or fits file name
+      zro: master bias hdu, data array or fits file name
+      outdir: directory to write calibrated frames to
+              default None, return hdus in memory instead
+      exptime: bool, divide sci by exposure time
+      dtype: dtype of calibrated data, default np.float32
+             float32 halves memory traffic compared to float64
+      nthreads: N worker threads, default 4
+      suffix: appended to file names of calibrated frames
+      overwrite: bool, overwrite existing calibrated files
+      
+    Returns
+      list of calibrated file names, or of hdus if outdir is None
+      in the order of scis
+    '''
+    if isinstance(scis, (str, os.PathLike)):
+        scis = sorted(glob.glob(os.path.join(scis, '*.fits')))
+
+    #load and convert masters once, shared read-only by all threads
+    flt = _master_data(flt, dtype)
+    zro = _master_data(zro, dtype)
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+
+    def work(path):
+        with fits.open(path) as hdul:
+            header = hdul[0].header.copy()
+            data = _calibrate(hdul[0].data, header, flt, zro,
+                              exptime=exptime, dtype=dtype)
+        #scaling keywords no longer apply to calibrated floats
+        for key in ('BZERO', 'BSCALE', 'BLANK'):
+            header.remove(key, ignore_missing=True)
+        hdu = fits.PrimaryHDU(data=data, header=header)
+        if outdir is None:
+            return hdu
+        root, ext = os.path.splitext(os.path.basename(path))
+        outfile = os.path.join(outdir, root+suffix+ext)
+        hdu.writeto(outfile, overwrite=overwrite)
+        return outfile
+
+    with ThreadPoolExecutor(nthreads) as pool:
+        return list(pool.map(work, scis))
+
+def _calibrate(sci, header, flt, zro, exptime=True, dtype=None):
+    '''
+    Description
+      bias subtracts, flat fields and divides by exposure time
+      one copy of sci is made in dtype, then modified in place
+      
+    Parameters
+      sci: science data array
+      header: science header, for EXPTIME
+      flt: master flat data
+      zro: master bias data
+      exptime: bool, divide by exposure time
+      dtype: output dtype, default None (float type of inputs)
+      
+    Returns
+      calibrated data array
+    '''
+    if dtype is None:
+        dtype = np.result_type(sci, zro, flt)
+        if dtype.kind != 'f':
+            dtype = np.dtype(np.float64)
+
+    data = np.array(sci, dtype=dtype)
+    np.subtract(data, zro, out=data)
+    np.divide(data, flt, out=data)
+    if exptime:
+        #divide by exposure time
+        data /= header['EXPTIME']
+    return data
+
+def _master_data(master, dtype):
+    '''
+    Description
+      master frame data from hdu, array or fits file name, in dtype
+    '''
+    if isinstance(master, (str, os.PathLike)):
+        master = fits.getdata(master)
+    elif hasattr(master, 'data'):
+        master = master.data
+    return np.asarray(master, dtype=dtype)
 
-def reproj(base, rep):
+
+def reproj(base, rep, plan=False):
     '''
     Description
       reproject one image onto another, update wcs
-      uses interpolation from reproject package
+      uses interpolation from reproject package, or a cached
+      bilinear reprojplan.ReprojPlan if plan is True
+      plans make repeated reprojections between the same
+      pair of grids cost one WCS solve in total
       
     Parameters
       base: hdu of image to project on to
       rep: hdu of image to be reprojected
+      plan: bool, use a cached reprojection plan, default False
       
     Returns
       None
@@ -48,7 +155,11 @@ def reproj(base, rep):
     #get wcs of base image
     wcs_b = WCS(base.header)
     #perform reprojection
-    array, footprint = reproject_interp(rep, base.header)
+    if plan:
+        array = get_plan(rep.header, base.header,
+                         shape_in=rep.data.shape).apply(rep.data)
+    else:
+        array, footprint = reproject_interp(rep, base.header)
     #replace rep data with reprojected data
     rep.data = array
     #update rep header to include base wcs
@@ -56,18 +167,53 @@ def reproj(base, rep):
     
     return
 
-def make_master_flat(hdus, mzro):
+def make_master_flat(hdus, mzro, method='median', masks=None, nproc=1,
+                     maxmem=None, outfile=None, cache=None, **kwargs):
     '''
     Description
       uses median of flats to make master flat data
+      other combine methods, masks, process pools and
+      memory-bounded strip combining use combine.combine_frames
       
     Parameters
-      hdus: list of hdus for flats
+      hdus: list of hdus or fits file names for flats
+            file names are read memory-mapped
       mzro: master bias data
+      method: 'median', 'mean', 'sigclip' or 'minmax'
+      masks: list of bool arrays, True marks bad pixels, default None
+      nproc: N processes to combine tiles with, default 1
+      maxmem: memory budget in MB per tile, default None
+              None stacks all flats in memory at once, unless
+              file names or another option require combine_frames (256 MB)
+      outfile: fits file to write master flat to tile by tile
+               default None
+      cache: calcache.MasterCache, default None
+             reuse the master if flats, mzro and parameters are unchanged
+      kwargs: rejection parameters passed to combine_frames
       
     Returns
       master flat data array
+      memory-mapped from outfile or cache, if given
     '''
+    if cache is not None:
+        key = cache.key('flat', hdus, mzro, method=method, masks=masks,
+                        **kwargs)
+        return _cached(cache, key, outfile, lambda: make_master_flat(
+            hdus, mzro, method=method, masks=masks, nproc=nproc,
+            maxmem=maxmem, outfile=outfile, **kwargs))
+
+    if _use_engine(hdus, method, masks, nproc, maxmem, outfile):
+        exptimes = [float(_header(hdu)['EXPTIME']) for hdu in hdus]
+        med_flt = combine_frames(hdus, method=method, offset=mzro,
+                                 scales=exptimes, masks=masks, nproc=nproc,
+                                 maxmem=maxmem or 256., outfile=outfile,
+                                 **kwargs)
+        #normalize in place, memmap pages are written back to outfile
+        med_flt /= np.nanmean(med_flt)
+        if outfile is not None:
+            med_flt.flush()
+        return med_flt
+
     #subtract master bias individually
     data = np.array([hdu.data-mzro for hdu in hdus])
     #convert to counts/s
@@ -77,18 +223,76 @@ def make_master_flat(hdus, mzro):
     #return normalized master flat
     return med_flt/np.mean(med_flt)
 
-def make_master_bias(hdus):
+def make_master_bias(hdus, method='median', masks=None, nproc=1,
+                     maxmem=None, outfile=None, cache=None, **kwargs):
     '''
     Description
       uses median of bias frames to make master bias data
+      other combine methods, masks, process pools and
+      memory-bounded strip combining use combine.combine_frames
       
     Parameters
-      hdus: list of hdus for bias frames
+      hdus: list of hdus or fits file names for bias frames
+            file names are read memory-mapped
+      method: 'median', 'mean', 'sigclip' or 'minmax'
+      masks: list of bool arrays, True marks bad pixels, default None
+      nproc: N processes to combine tiles with, default 1
+      maxmem: memory budget in MB per tile, default None
+              None stacks all frames in memory at once, unless
+              file names or another option require combine_frames (256 MB)
+      outfile: fits file to write master bias to tile by tile
+               default None
+      cache: calcache.MasterCache, default None
+             reuse the master if frames and parameters are unchanged
+      kwargs: rejection parameters passed to combine_frames
       
     Returns
       master bias data array
+      memory-mapped from outfile or cache, if given
     '''
-    
+    if cache is not None:
+        key = cache.key('bias', hdus, method=method, masks=masks, **kwargs)
+        return _cached(cache, key, outfile, lambda: make_master_bias(
+            hdus, method=method, masks=masks, nproc=nproc,
+            maxmem=maxmem, outfile=outfile, **kwargs))
+
+    if _use_engine(hdus, method, masks, nproc, maxmem, outfile):
+        return combine_frames(hdus, method=method, masks=masks, nproc=nproc,
+                              maxmem=maxmem or 256., outfile=outfile,
+                              **kwargs)
+
     data = np.array([hdu.data for hdu in hdus])
     #return median in each pixel
     return np.median(data, axis=0) 
+
+def _use_engine(hdus, method, masks, nproc, maxmem, outfile):
+    '''
+    Description
+      whether a master needs combine_frames rather than an in-memory median
+    '''
+    return (method != 'median' or masks is not None or nproc > 1 or
+            maxmem is not None or outfile is not None or
+            any(isinstance(hdu, (str, os.PathLike)) for hdu in hdus))
+
+def _cached(cache, key, outfile, make):
+    '''
+    Description
+      master from cache, or made and stored if not cached
+      cached masters are still written to outfile, if given
+    '''
+    master = cache.get(key)
+    if master is None:
+        master = make()
+        cache.put(key, master)
+    elif outfile is not None:
+        fits.writeto(outfile, master, overwrite=True)
+    return master
+
+def _header(hdu):
+    '''
+    Description
+      header of an hdu or fits file name, without reading data
+    '''
+    if hasattr(hdu, 'header'):
+        return hdu.header
+    return fits.getheader(hdu)
@@ -1,5 +1,8 @@
 import numpy as np
-from zeroflux.astromath.constants_cgs import c
+
+#exact speed of light in A/s, as in astropy, so plain arrays
+#and quantities convert identically
+c_AA = 2.99792458e18
 
 def SNR_rate(time, source, sky, npix, nsky, dark=0, rn=0):
     '''
@@ -42,91 +45,266 @@ def SNR_count(source, sky, npix, nsky, dark=0, rn=0):
     
     return (source) / np.sqrt(source + npix*(1+(npix/nsky))*(sky+dark+rn**2))
 
-def jy_to_mab(fnu):
+def exptime_for_snr(snr, source, sky, npix, nsky, dark=0, rn=0):
+    '''
+    Description
+      Calculate exposure time needed to reach SNR given count rates
+      Inverts SNR_rate in closed form (positive root of a quadratic)
+      All parameters broadcast, so whole grids are solved at once,
+      e.g. with np.meshgrid or arrays shaped (N,1,1), (1,M,1), ...
+      Assumes electrons, not ADU
+      
+    Parameters
+      snr: target SNR
+      source: count rate of source
+      sky: count rate of sky/background
+      npix: N pixels used to measure source flux
+      nsky: N pixels used to measure background flux
+      dark: count rate from dark current
+      rn: read noise, gets squared
+      
+    Returns
+      exposure time, single value or array (inf for zero source)
+    '''
+    #snr^2 (s t + k (b t + d t + rn^2)) = s^2 t^2
+    k = npix*(1+(npix/nsky))
+    snr2 = np.square(snr)
+    lin = snr2*(source + k*(sky+dark))
+    const = snr2*k*np.square(rn)
+    src2 = np.square(source)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        time = (lin + np.sqrt(lin**2 + 4*src2*const))/(2*src2)
+    return np.where(src2 > 0, time, np.inf)
+
+def rate_for_snr(time, snr, sky, npix, nsky, dark=0, rn=0):
+    '''
+    Description
+      Calculate source count rate that reaches SNR in a given time
+      Inverts SNR_rate in closed form for the source rate
+      All parameters broadcast, see exptime_for_snr
+      Assumes electrons, not ADU
+      
+    Parameters
+      time: exposure time
+      snr: target SNR
+      sky: count rate of sky/background
+      npix: N pixels used to measure source flux
+      nsky: N pixels used to measure background flux
+      dark: count rate from dark current
+      rn: read noise, gets squared
+      
+    Returns
+      source count rate, single value or array
+    '''
+    #(s t)^2 - snr^2 (s t) - snr^2 k (b t + d t + rn^2) = 0
+    k = npix*(1+(npix/nsky))
+    snr2 = np.square(snr)
+    noise2 = k*((sky+dark)*time + np.square(rn))
+    counts = (snr2 + np.sqrt(snr2**2 + 4*snr2*noise2))/2
+    return counts/time
+
+def limiting_mab(time, snr, sky, npix, nsky, cps_per_jy, dark=0, rn=0):
+    '''
+    Description
+      Calculate AB magnitude reaching SNR in a given time
+      Broadcasts over parameter grids, e.g. for limiting magnitude maps
+      with time or sky given per pixel or per field
+      
+    Parameters
+      time: exposure time
+      snr: target SNR
+      sky: count rate of sky/background
+      npix: N pixels used to measure source flux
+      nsky: N pixels used to measure background flux
+      cps_per_jy: source count rate (e/s) of a 1 Jy source
+      dark: count rate from dark current
+      rn: read noise, gets squared
+      
+    Returns
+      limiting AB mag, single value or array
+    '''
+    rate = rate_for_snr(time, snr, sky, npix, nsky, dark=dark, rn=rn)
+    return jy_to_mab(rate/cps_per_jy)
+
+def exptime_for_mab(mab, snr, sky, npix, nsky, cps_per_jy, dark=0, rn=0):
+    '''
+    Description
+      Calculate exposure time for a source of given AB magnitude
+      to reach SNR, source rate from mab_to_jy
+      Broadcasts over parameter grids, see exptime_for_snr
+      
+    Parameters
+      mab: AB magnitude of source
+      snr: target SNR
+      sky: count rate of sky/background
+      npix: N pixels used to measure source flux
+      nsky: N pixels used to measure background flux
+      cps_per_jy: source count rate (e/s) of a 1 Jy source
+      dark: count rate from dark current
+      rn: read noise, gets squared
+      
+    Returns
+      exposure time, single value or array
+    '''
+    source = mab_to_jy(mab, unit=False)*cps_per_jy
+    return exptime_for_snr(snr, source, sky, npix, nsky, dark=dark, rn=rn)
+
+def jy_to_mab(fnu, out=None, dtype=None):
     '''
     Description
       converts fluxes from Jy to AB magnitudes
       can handle quantity objects
+      plain arrays skip astropy units entirely,
+      and out/dtype allow in-place, float32 conversion
 
     Parameters
       fnu: single value or list of flux density 
       if no unit given, assumes Jy
+      out: array to write mags to, default None
+      dtype: computation dtype, e.g. np.float32, default None
 
     Returns
       single value or list of AB mags
       
     '''
-    try:
-        fnu.unit
-    except AttributeError:
-        fnu*=u.Jy
-    else:
-        fnu = fnu.to(u.Jy)
-    
-    return -2.5*np.log10(fnu.value) + 8.90
+    fnu = _value(fnu, 'Jy', dtype)
+    mab = np.log10(fnu, out=out)
+    mab *= -2.5
+    mab += 8.90
+    return mab
 
-def jy_to_maggie(fnu):
+def jy_to_maggie(fnu, out=None, dtype=None):
     '''
     Description
       converts fluxes from Jy to maggies
       1 maggie = 3631 Jy
       can handle quantity objects
+      plain arrays skip astropy units entirely
 
     Parameters
       fnu: single value or list of flux density 
       if no unit given, assumes Jy
+      out: array to write maggies to, default None
+      dtype: computation dtype, e.g. np.float32, default None
 
     Returns:
       single value or list of maggies
       
     '''
-    
-    try:
-        fnu.unit
-    except AttributeError:
-        fnu*=u.Jy
-    else:
-        fnu = fnu.to(u.Jy)
-    
-    return fnu.to(u.maggy).
+    fnu = _value(fnu, 'Jy', dtype)
+    return np.divide(fnu, 3631., out=out)
 
-def mab_to_jy(mab):
+def mab_to_jy(mab, unit=True, out=None, dtype=None):
     '''
     Description
       converts fluxes from AB magnitudes to Jy
+      unit=False (or out given) returns a plain array,
+      skipping astropy units entirely
 
     Parameters
-      mab: AB mags, single value or list
+      mab: AB mags, single value or list, or mag or ABmag quantity
+      unit: bool, attach Jy unit to result, default True
+      out: array to write fluxes to, default None
+      dtype: computation dtype, e.g. np.float32, default None
 
     Returns
-      single value or list of fluxes with Jy units
+      single value or list of fluxes with Jy units,
+      or without units if unit is False or out is given
     '''
-    
-    return 3631. * 10**(-0.4*mab) *u.Jy
+    mab = _value(mab, 'mag', dtype)
+    #3631 10^(-0.4 mab), as exp to allow out
+    fnu = np.multiply(mab, float(-0.4*np.log(10.)), out=out)
+    fnu = np.exp(fnu, out=out)
+    fnu *= 3631.
+    if unit and out is None:
+        from astropy import units as u
+        return fnu << u.Jy
+    return fnu
 
-def flam_to_fnu(lam0):
+def flam_to_fnu(flam, lam0, out=None, dtype=None):
     '''
     Description
       converts from wavelength flux density
-      to frequency flux density
+      to frequency flux density, fnu = flam lam^2/c
+      quantity flam returns a quantity, via astropy equivalencies
       
     Parameters
+      flam: flux density, erg/s/cm^2/A if no unit given
+      lam0: wavelength(s), A if no unit given
+      out: array to write fnu to, default None
+      dtype: computation dtype, e.g. np.float32, default None
     
     Returns
-
+      fnu in erg/s/cm^2/Hz, single value or array
 
     '''
-    return
+    if hasattr(flam, 'unit'):
+        from astropy import units as u
+        if not hasattr(lam0, 'unit'):
+            lam0 = lam0*u.AA
+        return flam.to(u.erg/u.s/u.cm**2/u.Hz, u.spectral_density(lam0))
+
+    flam = _value(flam, None, dtype)
+    lam0 = _value(lam0, 'AA', dtype, spectral=True)
+    fnu = np.multiply(flam, lam0, out=out)
+    fnu *= lam0
+    fnu /= c_AA
+    return fnu
 
-def fnu_to_flam(nu0, freq=True):
+def fnu_to_flam(fnu, nu0, freq=True, out=None, dtype=None):
     '''
     Description
       converts from frequency flux density
-      to wavelength flux density
+      to wavelength flux density, flam = fnu nu^2/c = fnu c/lam^2
+      quantity fnu returns a quantity, via astropy equivalencies
       
     Parameters
+      fnu: flux density, erg/s/cm^2/Hz if no unit given
+      nu0: frequency(s) in Hz if freq, else wavelength(s) in A
+           if no unit given
+      freq: bool, nu0 is a frequency, default True
+      out: array to write flam to, default None
+      dtype: computation dtype, e.g. np.float32, default None
     
     Returns
+      flam in erg/s/cm^2/A, single value or array
+
+    '''
+    if hasattr(fnu, 'unit'):
+        from astropy import units as u
+        if not hasattr(nu0, 'unit'):
+            nu0 = nu0*(u.Hz if freq else u.AA)
+        return fnu.to(u.erg/u.s/u.cm**2/u.AA, u.spectral_density(nu0))
 
+    fnu = _value(fnu, None, dtype)
+    nu0 = _value(nu0, 'Hz' if freq else 'AA', dtype, spectral=True)
+    if freq:
+        flam = np.multiply(fnu, nu0, out=out)
+        flam *= nu0
+        flam /= c_AA
+    else:
+        flam = np.divide(fnu, nu0, out=out)
+        flam /= nu0
+        flam *= c_AA
+    return flam
+
+def _value(x, unit=None, dtype=None, spectral=False):
+    '''
+    Description
+      plain values of x, converted to unit (a unit name) if x is
+      a quantity; astropy units are imported only for quantities
+      'mag' accepts mag and ABmag quantities
+      integer values are converted to float64 unless dtype is given
     '''
-    return
+    if hasattr(x, 'unit'):
+        from astropy import units as u
+        if (unit == 'mag' and isinstance(x.unit, u.MagUnit) and
+                x.unit.physical_unit == u.AB):
+            x = x.value
+        else:
+            x = x.to_value(None if unit is None else u.Unit(unit),
+                           u.spectral() if spectral else [])
+    x = np.asarray(x, dtype=dtype)
+    if dtype is None and x.dtype.kind not in 'fc':
+        x = x.astype(np.float64)
+    return x
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+
+import numpy as np
+from astropy.wcs import WCS
+
+class ReprojPlan:
+    '''
+    Precomputed bilinear reprojection from one image grid onto another
+
+    The output -> input pixel mapping is solved once through the WCS.
+    The four interpolation indices and weights of every output pixel
+    are stored, so reprojecting an image, or a stack of images on the
+    same input grid, is a single vectorized gather. Indices are int32
+    (for inputs under 2^31 pixels) and weights float32, about 37 bytes
+    per output pixel.
+    '''
+
+    def __init__(self, wcs_in, shape_in, wcs_out, shape_out):
+        '''
+        Parameters
+          wcs_in: WCS (or header) of images to be reprojected
+          shape_in: shape of images to be reprojected, rows x cols
+          wcs_out: WCS (or header) to reproject onto
+          shape_out: shape of reprojected images, rows x cols
+        '''
+        wcs_in = _celestial(wcs_in)
+        wcs_out = _celestial(wcs_out)
+        self.shape_in = tuple(shape_in)
+        self.shape_out = tuple(shape_out)
+        ny, nx = self.shape_in
+
+        #output pixel centers -> sky -> input pixels, one WCS solve
+        yout, xout = np.indices(self.shape_out)
+        sky = wcs_out.pixel_to_world(xout, yout)
+        xin, yin = wcs_in.world_to_pixel(sky)
+        del yout, xout, sky
+
+        #pixels within half a pixel of the input edges are covered
+        footprint = ((xin >= -0.5) & (xin <= nx-0.5) &
+                     (yin >= -0.5) & (yin <= ny-0.5))
+        #int32 indices where they fit, halves the plan size
+        itype = np.int32 if max(ny*nx, footprint.size) < 2**31 else np.intp
+        self.footprint = footprint
+        self.outidx = np.flatnonzero(footprint).astype(itype)
+        xin = np.clip(xin.ravel()[self.outidx], 0, nx-1)
+        yin = np.clip(yin.ravel()[self.outidx], 0, ny-1)
+
+        #lower-left neighbor, kept one pixel inside the upper edges
+        x0 = np.minimum(np.floor(xin).astype(np.intp), max(nx-2, 0))
+        y0 = np.minimum(np.floor(yin).astype(np.intp), max(ny-2, 0))
+        fx = xin-x0
+        fy = yin-y0
+        x1 = np.minimum(x0+1, nx-1)
+        y1 = np.minimum(y0+1, ny-1)
+
+        self.idx = np.array([y0*nx+x0, y0*nx+x1, y1*nx+x0, y1*nx+x1],
+                            dtype=itype)
+        self.weights = np.array([(1-fx)*(1-fy), fx*(1-fy),
+                                 (1-fx)*fy, fx*fy], dtype=np.float32)
+
+    @property
+    def nbytes(self):
+        '''
+        memory held by the plan arrays, bytes
+        '''
+        return (self.idx.nbytes + self.weights.nbytes +
+                self.outidx.nbytes + self.footprint.nbytes)
+
+    def apply(self, data, out=None, fill=np.nan):
+        '''
+        Description
+          reprojects image(s) on the input grid
+
+        Parameters
+          data: array, rows x cols, or stack, N x rows x cols
+          out: output array of shape data.shape[:-2]+shape_out, optional
+          fill: value outside the footprint, default NaN
+
+        Returns
+          reprojected array(s)
+        '''
+        data = np.asarray(data)
+        lead = data.shape[:-2]
+        flat = data.reshape(lead+(-1,))
+        if out is None:
+            dtype = np.result_type(data.dtype, np.float32)
+            out = np.empty(lead+self.shape_out, dtype=dtype)
+        outflat = out.reshape(lead+(-1,))
+
+        #single gather of the four neighbors for every image
+        vals = flat[..., self.idx[0]]*self.weights[0]
+        for k in range(1, 4):
+            vals += flat[..., self.idx[k]]*self.weights[k]
+
+        outflat[...] = fill
+        outflat[..., self.outidx] = vals
+        return out
+
+#plans kept by get_plan, most recently used last,
+#up to maxbytes of plan arrays in total
+_plans = OrderedDict()
+maxbytes = 2**30
+
+def get_plan(header_in, header_out, shape_in=None, shape_out=None):
+    '''
+    Description
+      cached ReprojPlan for a pair of image headers
+      plans are keyed on the celestial WCS of both headers and the
+      image shapes; the most recently used are kept, up to maxbytes
+      of plan arrays in total (a plan larger than that is not kept)
+
+    Parameters
+      header_in: header of images to be reprojected
+      header_out: header to reproject onto
+      shape_in: input image shape, default from NAXIS keywords
+      shape_out: output image shape, default from NAXIS keywords
+
+    Returns
+      ReprojPlan
+    '''
+    if shape_in is None:
+        shape_in = (header_in['NAXIS2'], header_in['NAXIS1'])
+    if shape_out is None:
+        shape_out = (header_out['NAXIS2'], header_out['NAXIS1'])
+    wcs_in = _celestial(header_in)
+    wcs_out = _celestial(header_out)
+
+    key = (wcs_in.to_header_string(relax=True), tuple(shape_in),
+           wcs_out.to_header_string(relax=True), tuple(shape_out))
+    plan = _plans.get(key)
+    if plan is None:
+        plan = ReprojPlan(wcs_in, shape_in, wcs_out, shape_out)
+        _plans[key] = plan
+        while sum(p.nbytes for p in _plans.values()) > maxbytes:
+            _plans.popitem(last=False)
+    else:
+        _plans.move_to_end(key)
+    return plan
+
+def _celestial(wcs):
+    '''
+    Description
+      celestial WCS from a WCS or header
+    '''
+    if not isinstance(wcs, WCS):
+        wcs = WCS(wcs)
+    return wcs.celestial
@@ -0,0 +1,138 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from zeroflux.photometry.photcalc import c_AA, jy_to_mab
+
+class FilterSet:
+    '''
+    Set of filter bandpasses for batched synthetic photometry
+
+    For a given wavelength grid, the filters are turned into one
+    response matrix, cached per grid, so AB magnitudes of N spectra
+    through M filters are a single N x L by L x M matrix product.
+    The maxmatrices most recently used matrices are kept.
+    '''
+
+    maxmatrices = 8
+
+    def __init__(self, filters, names=None):
+        '''
+        Parameters
+          filters: list of (wav, response) pairs, wav in A
+                   response is photon counting (QE x transmission)
+          names: list of filter names, default None
+        '''
+        self.filters = [(np.asarray(wav, dtype=float),
+                         np.asarray(resp, dtype=float))
+                        for wav, resp in filters]
+        self.names = names
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.filters)
+
+    def matrix(self, wav, fnu=False, dtype=np.float64):
+        '''
+        Description
+          response matrix of the filters on a wavelength grid
+          rows give the mean fnu through each filter as a
+          weighted sum over the spectrum pixels
+          cached per (grid, fnu, dtype), least recently used
+          matrices are evicted past maxmatrices
+
+        Parameters
+          wav: wavelength grid of spectra, A
+          fnu: bool, spectra are fnu (erg/s/cm^2/Hz), default flam
+          dtype: matrix dtype
+
+        Returns
+          array, N filters x N wavelengths
+        '''
+        wav = np.ascontiguousarray(wav, dtype=float)
+        key = (hashlib.sha1(memoryview(wav).cast('B')).hexdigest(),
+               fnu, np.dtype(dtype).str)
+        mat = self._cache.get(key)
+        if mat is not None:
+            self._cache.move_to_end(key)
+            return mat
+
+        #trapezoid weights of the grid
+        dwav = np.zeros_like(wav)
+        dwav[1:] += np.diff(wav)/2
+        dwav[:-1] += np.diff(wav)/2
+
+        resp = np.array([np.interp(wav, fwav, fresp, left=0., right=0.)
+                         for fwav, fresp in self.filters])
+        #photon counting mean fnu
+        norm = (resp*dwav/wav).sum(axis=1)
+        if fnu:
+            mat = resp*dwav/wav
+        else:
+            mat = resp*dwav*wav/c_AA
+        mat = (mat/norm[:, None]).astype(dtype)
+        self._cache[key] = mat
+        while len(self._cache) > self.maxmatrices:
+            self._cache.popitem(last=False)
+        return mat
+
+def synth_mab(wav, spectra, filters, fnu=False, chunksize=65536,
+              dtype=np.float64, out=None):
+    '''
+    Description
+      AB magnitudes of many spectra through many filters
+      spectra are streamed in chunks of rows, each chunk is one
+      matrix product with the cached FilterSet response matrix
+
+    Parameters
+      wav: shared wavelength grid, A
+           ignored (may be None) for Spectrum and SpectrumBatch inputs
+      spectra: 2D flux array, N spectra x N wavelengths (may be a memmap),
+               SpectrumBatch with a shared wavelength grid,
+               or list of Spectrum objects on one wavelength grid
+      filters: FilterSet, or list of (wav, response) pairs
+      fnu: bool, fluxes are fnu (erg/s/cm^2/Hz), default flam (erg/s/cm^2/A)
+      chunksize: N spectra per matrix product
+      dtype: computation dtype, np.float32 halves memory traffic
+      out: array, N spectra x N filters, to write mags to, default None
+
+    Returns
+      array of AB mags, N spectra x N filters
+      NaN or inf where the mean flux in a filter is not positive
+    '''
+    if not isinstance(filters, FilterSet):
+        filters = FilterSet(filters)
+
+    if hasattr(spectra, 'wavscale'):
+        #SpectrumBatch, flux matrix on one grid
+        if not spectra.shared:
+            raise ValueError('spectra must share one wavelength grid')
+        wav = spectra.wav
+        spectra = spectra.flux
+
+    if not hasattr(spectra, 'shape'):
+        if wav is None:
+            wav = spectra[0].wav
+        for spec in spectra:
+            if not np.array_equal(spec.wav, wav):
+                raise ValueError('spectra must share one wavelength grid')
+        rows = lambda start, stop: np.array([spec.flux for spec in
+                                             spectra[start:stop]], dtype=dtype)
+    else:
+        rows = lambda start, stop: np.asarray(spectra[start:stop], dtype=dtype)
+
+    mat = filters.matrix(wav, fnu=fnu, dtype=dtype)
+    nspec = len(spectra)
+    if out is None:
+        out = np.empty((nspec, len(filters)), dtype=dtype)
+
+    for start in range(0, nspec, chunksize):
+        stop = min(start+chunksize, nspec)
+        block = out[start:stop]
+        np.matmul(rows(start, stop), mat.T, out=block)
+        #mean fnu in cgs to Jy, then AB mag in place
+        block *= 1e23
+        with np.errstate(divide='ignore', invalid='ignore'):
+            jy_to_mab(block, out=block)
+    return out
@@ -3,8 +3,15 @@
 #                     showds9)
 #test backup 
 
-__all__ = ["visfits", "visspec", "plotutils"]
-
+import importlib
 
+__all__ = ["visfits", "visspec", "plotutils"]
 
+def __getattr__(name):
+    #modules are imported on first access, e.g. zeroflux.plotting.visspec
+    if name in __all__:
+        return importlib.import_module('.'+name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
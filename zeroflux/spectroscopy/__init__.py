@@ -1,3 +1,15 @@
 #
 
-__all__ = ["linefitting", "specutils"]
+import importlib
+
+__all__ = ["linefitting", "specutils", "resample", "linesearch",
+           "zfind"]
+
+def __getattr__(name):
+    #modules are imported on first access, e.g. zeroflux.spectroscopy.specutils
+    if name in __all__:
+        return importlib.import_module('.'+name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
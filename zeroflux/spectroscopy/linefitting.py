@@ -1,5 +1,650 @@
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+from astropy.table import Table
+
+#speed of light, km/s, exact as in photcalc.c_AA
+c_kms = 299792.458
+
+class LineModel:
+    '''
+    Gaussian emission lines on a linear continuum
+
+    Each kinematic component has one velocity and one velocity
+    dispersion shared by all lines; every line has an integrated flux
+    per component, free or tied to another line by a fixed ratio
+    (doublets such as [NII] 6548/6583). Model and Jacobian are
+    evaluated for many spectra at once.
+    '''
+
+    def __init__(self, lines, ncomp=1, ties=None, sigma0=100., sigmin=1.,
+                 sigmax=3000., names=None):
+        '''
+        Parameters
+          lines: rest wavelengths of the lines, A
+          ncomp: N kinematic components
+          ties: dict {line index: (reference line index, ratio)},
+                line flux = ratio x reference line flux, default None
+          sigma0: initial velocity dispersion, km/s
+                  component k starts at sigma0 x 3^k
+          sigmin, sigmax: allowed velocity dispersion range, km/s
+          names: line names for result columns, default line indices
+        '''
+        self.lines = np.asarray(lines, dtype=float)
+        self.ncomp = ncomp
+        self.ties = {} if ties is None else dict(ties)
+        self.free = [i for i in range(len(self.lines)) if i not in self.ties]
+        for ref, _ in self.ties.values():
+            if ref not in self.free:
+                raise ValueError('lines can only be tied to free lines')
+        self.sigma0 = sigma0
+        self.sigmin = sigmin
+        self.sigmax = sigmax
+        self.linenames = ([str(i) for i in range(len(self.lines))]
+                          if names is None else list(names))
+
+        self.nparams = 2 + 2*ncomp + len(self.free)*ncomp
+        self.names = ['cont', 'slope']
+        for k in range(ncomp):
+            self.names += ['v%d' % k, 'sigma%d' % k]
+        for i in self.free:
+            self.names += ['flux%s_%d' % (self.linenames[i], k)
+                           for k in range(ncomp)]
+
+    def flux_index(self, line, k=0):
+        '''
+        parameter index of the flux of a free line in component k
+        '''
+        return 2 + 2*self.ncomp + self.free.index(line)*self.ncomp + k
+
+    def evaluate(self, params, wav, z=0., jac=False):
+        '''
+        Description
+          model spectra, and optionally their Jacobian
+
+        Parameters
+          params: N spectra x N params
+          wav: observed wavelengths, N pixels or N spectra x N pixels
+          z: redshift(s) of the line rest wavelengths
+          jac: bool, also return the Jacobian
+
+        Returns
+          model, N spectra x N pixels
+          Jacobian, N spectra x N pixels x N params, if jac
+        '''
+        params = np.atleast_2d(params)
+        nspec = len(params)
+        lam = np.atleast_2d(wav)
+        z1 = 1. + np.broadcast_to(z, (nspec,))[:, None]
+        #continuum slope about the mean line wavelength
+        dlam = lam - self.lines.mean()*z1
+
+        model = params[:, 0:1] + params[:, 1:2]*dlam
+        if jac:
+            J = np.zeros(model.shape+(self.nparams,))
+            J[..., 0] = 1.
+            J[..., 1] = dlam
+
+        norm = 1./np.sqrt(2*np.pi)
+        for k in range(self.ncomp):
+            iv, isig = 2+2*k, 3+2*k
+            v = params[:, iv:iv+1]
+            sig = params[:, isig:isig+1]
+            for line, lam0 in enumerate(self.lines):
+                ref, ratio = self.ties.get(line, (line, 1.))
+                iflux = self.flux_index(ref, k)
+                dmu_dv = lam0*z1/c_kms
+                mu = dmu_dv*(c_kms+v)
+                s = mu*sig/c_kms
+                u = (lam-mu)/s
+                #unit flux profile, then the line
+                g = norm/s*np.exp(-0.5*u*u)
+                prof = params[:, iflux:iflux+1]*ratio*g
+                model += prof
+                if jac:
+                    dp_dmu = prof*u/s
+                    dp_ds = prof*(u*u-1.)/s
+                    J[..., iflux] += ratio*g
+                    J[..., iv] += (dp_dmu + dp_ds*sig/c_kms)*dmu_dv
+                    J[..., isig] += dp_ds*mu/c_kms
+
+        if jac:
+            return model, J
+        return model
+
+    def guess(self, wav, flux, z=0.):
+        '''
+        Description
+          initial parameters from the data: median continuum,
+          line fluxes from the continuum subtracted flux at line centers
+
+        Parameters
+          wav: observed wavelengths, N pixels or N spectra x N pixels
+          flux: N spectra x N pixels, NaN for unused pixels
+          z: redshift(s)
+
+        Returns
+          params, N spectra x N params
+        '''
+        flux = np.atleast_2d(flux)
+        nspec, npix = flux.shape
+        lam = np.atleast_2d(wav)
+        z1 = 1. + np.broadcast_to(z, (nspec,))
+        params = np.zeros((nspec, self.nparams))
+        cont = np.nanmedian(flux, axis=1)
+        params[:, 0] = np.where(np.isfinite(cont), cont, 0.)
+
+        rows = np.arange(nspec)
+        for k in range(self.ncomp):
+            params[:, 3+2*k] = np.clip(self.sigma0*3**k, self.sigmin,
+                                       self.sigmax)
+        for line in self.free:
+            center = self.lines[line]*z1
+            pix = np.clip(_nearest(lam, center), 0, npix-1)
+            peak = np.nan_to_num(flux[rows, pix] - params[:, 0])
+            for k in range(self.ncomp):
+                #peak split evenly over components
+                s = center*params[:, 3+2*k]/c_kms
+                params[:, self.flux_index(line, k)] = (
+                    peak*np.sqrt(2*np.pi)*s/self.ncomp)
+        return params
+
+    def line_fluxes(self, params):
+        '''
+        Description
+          integrated flux of every line, ties included
+
+        Parameters
+          params: N spectra x N params
+
+        Returns
+          array, N spectra x N lines x N components
+        '''
+        params = np.atleast_2d(params)
+        out = np.empty((len(params), len(self.lines), self.ncomp))
+        for line in range(len(self.lines)):
+            ref, ratio = self.ties.get(line, (line, 1.))
+            for k in range(self.ncomp):
+                out[:, line, k] = ratio*params[:, self.flux_index(ref, k)]
+        return out
+
+def fit_lines(wav, flux, model, err=None, z=0., mask=None, p0=None,
+              maxiter=100, tol=1e-6, chunksize=2048, nproc=1):
+    '''
+    Description
+      least-squares fits of a LineModel to many spectra at once
+      Levenberg-Marquardt with analytic Jacobians, vectorized over
+      spectra: each iteration is one batched linear solve per chunk,
+      and spectra drop out of the iteration as they converge
+      chunks are spread over nproc worker processes
+
+    Parameters
+      wav: observed wavelengths, N pixels or N spectra x N pixels
+           usually only a window around the lines
+      flux: N pixels or N spectra x N pixels (may be a memmap)
+      model: LineModel, or list of rest wavelengths for a single
+             component model without ties
+      err: flux errors like flux, default None (unit weights,
+           parameter errors scaled by the reduced chi2)
+      z: redshift(s) of the lines, one value or one per spectrum
+      mask: bool array like flux, True marks bad pixels, default None
+            NaN flux or non-positive errors are also ignored
+      p0: initial parameters, N params or N spectra x N params,
+          default None (LineModel.guess)
+      maxiter: max iterations
+      tol: convergence tolerance on the relative chi2 decrease
+      chunksize: N spectra per chunk
+      nproc: N worker processes, default 1 (no pool)
+
+    Returns
+      astropy Table, one row per spectrum, with columns
+      model parameters (see LineModel.names), their errors (name_err),
+      chi2, dof, niter and converged
+    '''
+    if not isinstance(model, LineModel):
+        model = LineModel(model)
+    flux = np.atleast_2d(flux)
+    wav = np.asarray(wav, dtype=float)
+    nspec = len(flux)
+    z = np.broadcast_to(np.asarray(z, dtype=float), (nspec,))
+    if p0 is not None:
+        p0 = np.broadcast_to(np.asarray(p0, dtype=float),
+                             (nspec, model.nparams))
+
+    def chunk_args(start):
+        return _chunk_args(start, chunksize, wav, flux, err, mask, z, p0)
+
+    opts = (maxiter, tol)
+    tasks = ((model, chunk_args(start), opts)
+             for start in range(0, nspec, chunksize))
+    results = _map_chunks(_fit_chunk, tasks, nproc)
+
+    params, perr, chi2, dof, niter, conv = [np.concatenate(col) for col
+                                            in zip(*results)]
+    cols = {}
+    for i, name in enumerate(model.names):
+        cols[name] = params[:, i]
+    for i, name in enumerate(model.names):
+        cols[name+'_err'] = perr[:, i]
+    cols.update(chi2=chi2, dof=dof, niter=niter, converged=conv)
+    return Table(cols)
+
+def sample_lines(wav, flux, model, err=None, z=0., mask=None, p0=None,
+                 nwalkers=None, nsteps=5000, check=100, ntau=20., a=2.,
+                 chunksize=32, nproc=1, seed=None):
+    '''
+    Description
+      posterior sampling of LineModel parameters for many spectra
+      affine-invariant ensemble sampler (stretch move, Goodman & Weare
+      2010, as in emcee), vectorized over spectra and walkers: each
+      half-step is one likelihood call for all walkers of a chunk
+      every check steps the autocorrelation time tau is estimated and
+      spectra stop once run longer than ntau x tau with a stable tau
+      walkers start spread by the least-squares errors, so burn-in is
+      short; tau is typically 50-70 steps for a few lines, so spectra
+      converge after about 1000-1500 steps at the defaults
+      spectra that reach nsteps first are returned with converged
+      False and a RuntimeWarning; their percentiles come from chains
+      that may not have converged, check tau against nsteps or rerun
+      with larger nsteps
+      the likelihood sums only pixels within 8 sigma of the lines,
+      with the continuum terms precomputed
+      chunks are spread over nproc worker processes
+      flat priors, dispersion limited to the LineModel range
+
+    Parameters
+      wav, flux, model, err, z, mask: see fit_lines
+               without err, errors are the rms of the best-fit residuals
+      p0: starting parameters, default None (fit_lines in each chunk)
+          walkers start in a small ball around them
+      nwalkers: N walkers per spectrum, even, default max(32, 4 x N params)
+      nsteps: max N steps
+      check: N steps between autocorrelation estimates
+      ntau: chains are converged when longer than ntau x tau
+            (about ntau x N walkers independent samples)
+      a: stretch move scale
+      chunksize: N spectra per chunk
+      nproc: N worker processes, default 1 (no pool)
+      seed: random seed, results do not depend on nproc
+
+    Returns
+      astropy Table, one row per spectrum, with columns
+      model parameters (see LineModel.names), the median of the samples,
+      name_lo, name_hi: 16th and 84th percentiles,
+      name_err: half the 16th to 84th percentile range,
+      tau: max autocorrelation time, nsteps, acceptance and converged
+      samples after a burn-in of 2 tau, thinned by tau/2
+    '''
+    if not isinstance(model, LineModel):
+        model = LineModel(model)
+    if nwalkers is None:
+        nwalkers = max(32, 4*model.nparams)
+    nwalkers += nwalkers % 2
+    flux = np.atleast_2d(flux)
+    wav = np.asarray(wav, dtype=float)
+    nspec = len(flux)
+    z = np.broadcast_to(np.asarray(z, dtype=float), (nspec,))
+    if p0 is not None:
+        p0 = np.broadcast_to(np.asarray(p0, dtype=float),
+                             (nspec, model.nparams))
+
+    starts = range(0, nspec, chunksize)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    opts = (nwalkers, nsteps, check, ntau, a)
+    tasks = ((model, _chunk_args(start, chunksize, wav, flux, err, mask, z,
+                                 p0), opts, sseq)
+             for start, sseq in zip(starts, seeds))
+    results = _map_chunks(_sample_chunk, tasks, nproc)
+
+    med, lo, hi, tau, nrun, accept, conv = [np.concatenate(col) for col
+                                            in zip(*results)]
+    cols = {}
+    for i, name in enumerate(model.names):
+        cols[name] = med[:, i]
+    for i, name in enumerate(model.names):
+        cols[name+'_lo'] = lo[:, i]
+        cols[name+'_hi'] = hi[:, i]
+        cols[name+'_err'] = (hi[:, i]-lo[:, i])/2
+    cols.update(tau=tau, nsteps=nrun, acceptance=accept, converged=conv)
+    if not conv.all():
+        warnings.warn('%d of %d spectra did not converge in %d steps '
+                      '(ntau x tau > nsteps), see the converged and tau '
+                      'columns' % ((~conv).sum(), nspec, nsteps),
+                      RuntimeWarning)
+    return Table(cols)
+
+def autocorr_time(chain, c=5.):
+    '''
+    Description
+      integrated autocorrelation time of ensemble chains
+      autocorrelation functions from FFTs along the steps, averaged
+      over walkers, summed up to the automatic window of Sokal (1997)
+      with window size c
+
+    Parameters
+      chain: array, N steps x ... x N walkers x N params
+
+    Returns
+      array of tau, ... x N params
+    '''
+    chain = np.asarray(chain, dtype=float)
+    nsteps = len(chain)
+    nfft = 2**int(np.ceil(np.log2(2*nsteps)))
+    dev = chain - chain.mean(axis=0)
+    power = np.fft.rfft(dev, n=nfft, axis=0)
+    acf = np.fft.irfft(power*power.conj(), n=nfft, axis=0)[:nsteps]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        acf = (acf/acf[0]).mean(axis=-2)
+    taus = 2*np.cumsum(acf, axis=0) - 1
+    #first lag m >= c tau(m), else the last lag
+    lags = np.arange(nsteps).reshape((-1,)+(1,)*(taus.ndim-1))
+    window = lags >= c*taus
+    m = np.where(window.any(axis=0), window.argmax(axis=0), nsteps-1)
+    return np.take_along_axis(taus, m[None], axis=0)[0]
+
+def _fit_chunk(model, args, opts):
+    '''
+    Description
+      Levenberg-Marquardt fit of one chunk of spectra
+
+    Returns
+      params, perr, chi2, dof, niter, converged
+    '''
+    wav, flux, err, mask, z, p0 = args
+    maxiter, tol = opts
+    nspec, npix = flux.shape
+
+    f, w = _weights(flux, err, mask)
+
+    p = (model.guess(wav, np.where(w > 0, flux, np.nan), z) if p0 is None
+         else np.array(p0))
+    dof = (w > 0).sum(axis=1) - model.nparams
+    lam = np.full(nspec, 1e-3)
+    niter = np.zeros(nspec, dtype=int)
+    conv = np.zeros(nspec, dtype=bool)
+    #spectra with too few pixels are not fitted
+    done = dof <= 0
+
+    m, J = model.evaluate(p, wav, z, jac=True)
+    r = (f-m)*w
+    chi2 = (r*r).sum(axis=1)
+    diag = np.arange(model.nparams)
+    sigs = [3+2*k for k in range(model.ncomp)]
+
+    for _ in range(maxiter):
+        act = np.flatnonzero(~done)
+        if len(act) == 0:
+            break
+        Jw = J[act]*w[act][:, :, None]
+        A = np.matmul(Jw.transpose(0, 2, 1), Jw)
+        g = np.matmul(Jw.transpose(0, 2, 1), r[act][..., None])[..., 0]
+        #Marquardt scaling, floored so unconstrained parameters stay solvable
+        scale = A[:, diag, diag]
+        scale = np.maximum(scale, 1e-12*scale.max(axis=1, keepdims=True)+1e-300)
+        A[:, diag, diag] += lam[act, None]*scale
+        step = np.linalg.solve(A, g[..., None])[..., 0]
+
+        ptry = p[act]+step
+        ptry[:, sigs] = np.clip(ptry[:, sigs], model.sigmin, model.sigmax)
+        wa = wav if wav.ndim == 1 else wav[act]
+        mtry, Jtry = model.evaluate(ptry, wa, z[act], jac=True)
+        rtry = (f[act]-mtry)*w[act]
+        chi2try = (rtry*rtry).sum(axis=1)
+
+        better = chi2try < chi2[act]
+        acc = act[better]
+        rel = (chi2[acc]-chi2try[better])/np.maximum(chi2[acc], 1e-300)
+        p[acc] = ptry[better]
+        J[acc] = Jtry[better]
+        r[acc] = rtry[better]
+        chi2[acc] = chi2try[better]
+        lam[acc] = np.maximum(lam[acc]/10., 1e-12)
+        rej = act[~better]
+        lam[rej] *= 10.
+        niter[act] += 1
+
+        #converged on small improvements, or when no step improves
+        stop = np.concatenate([acc[rel < tol], rej[lam[rej] > 1e10]])
+        conv[stop] = True
+        done[stop] = True
+
+    #parameter errors from the curvature matrix
+    Jw = J*w[:, :, None]
+    cov = np.linalg.pinv(np.matmul(Jw.transpose(0, 2, 1), Jw))
+    var = cov[:, diag, diag]
+    if err is None:
+        var = var*chi2[:, None]/np.maximum(dof, 1)[:, None]
+    perr = np.sqrt(np.maximum(var, 0.))
+    return p, perr, chi2, dof, niter, conv
+
+def _sample_chunk(model, args, opts, sseq):
+    '''
+    Description
+      ensemble sampling of one chunk of spectra
+
+    Returns
+      median, 16th, 84th percentiles, tau, N steps, acceptance, converged
+    '''
+    wav, flux, err, mask, z, p0 = args
+    nwalkers, nsteps, check, ntau, a = opts
+    rng = np.random.default_rng(sseq)
+    f, w = _weights(flux, err, mask)
+
+    if p0 is None:
+        p0, perr, chi2, dof = _fit_chunk(model, args, (100, 1e-6))[:4]
+    else:
+        p0 = np.array(p0)
+        perr = np.full_like(p0, np.nan)
+        r = (f-model.evaluate(p0, wav, z))*w
+        chi2, dof = (r*r).sum(axis=1), (w > 0).sum(axis=1)-model.nparams
+    if err is None:
+        #unit weights scaled to the rms of the residuals
+        w = w*np.sqrt(np.maximum(dof, 1)/np.maximum(chi2, 1e-300))[:, None]
+    stats = _chi2_stats(model, wav, f, w, z)
+
+    nspec, npar = p0.shape
+    half = nwalkers//2
+    sigs = [3+2*k for k in range(model.ncomp)]
+    #walkers start spread like the posterior where the errors are known,
+    #so little burn-in is needed, else in a small ball
+    ball = np.where(np.isfinite(perr) & (perr > 0), perr,
+                    1e-4*np.abs(p0)+1e-8)
+    X = p0[:, None, :] + ball[:, None, :]*rng.standard_normal(
+        (nspec, nwalkers, npar))
+    X[..., sigs] = np.clip(X[..., sigs], model.sigmin, model.sigmax)
+    lnp = _lnprob(model, X, wav, f, w, z, stats)
+
+    #chain grows as spectra keep running, most converge well before nsteps
+    chain = np.empty((min(nsteps, 4*check), nspec, nwalkers, npar),
+                     dtype=np.float32)
+    nrun = np.zeros(nspec, dtype=int)
+    naccept = np.zeros(nspec)
+    tau = np.full(nspec, np.inf)
+    active = (w > 0).sum(axis=1) > npar
+    conv = np.zeros(nspec, dtype=bool)
+    halves = (np.arange(half), np.arange(half, nwalkers))
+
+    for step in range(nsteps):
+        act = np.flatnonzero(active)
+        if len(act) == 0:
+            break
+        wa = wav if wav.ndim == 1 else wav[act]
+        sa = {k: v[act] for k, v in stats.items()}
+        for move, other in (halves, halves[::-1]):
+            rows = np.ix_(act, move)
+            Xs = X[rows]
+            Xo = X[np.ix_(act, other)]
+            #stretch factors and partners from the other half
+            zz = ((a-1.)*rng.random((len(act), half))+1.)**2/a
+            partner = rng.integers(0, half, (len(act), half))
+            Xp = np.take_along_axis(Xo, partner[..., None], axis=1)
+            Y = Xp + zz[..., None]*(Xs-Xp)
+            lnpY = _lnprob(model, Y, wa, f[act], w[act], z[act], sa)
+            lnq = (npar-1)*np.log(zz) + lnpY - lnp[rows]
+            acc = np.log(rng.random((len(act), half))) < lnq
+            X[rows] = np.where(acc[..., None], Y, Xs)
+            lnp[rows] = np.where(acc, lnpY, lnp[rows])
+            naccept[act] += acc.sum(axis=1)
+
+        if step == len(chain):
+            grown = np.empty((min(nsteps, 2*step),)+chain.shape[1:],
+                             dtype=chain.dtype)
+            grown[:step] = chain
+            chain = grown
+        chain[step, act] = X[act]
+        nrun[act] += 1
+        if (step+1) % check == 0:
+            new = autocorr_time(chain[:step+1, act]).max(axis=-1)
+            #long enough and tau stable to 1 percent
+            done = (ntau*new < step+1) & (np.abs(tau[act]-new) < 0.01*new)
+            tau[act] = new
+            conv[act[done]] = True
+            active[act[done]] = False
+
+    qs = np.full((3, nspec, npar), np.nan)
+    for i in range(nspec):
+        n = nrun[i]
+        if n < 2:
+            continue
+        tau[i] = autocorr_time(chain[:n, i]).max()
+        if np.isfinite(tau[i]) and 2*tau[i] < n:
+            burn, thin = int(2*tau[i]), max(int(tau[i]/2), 1)
+        else:
+            burn, thin = n//2, 1
+        samples = chain[burn:n:thin, i].reshape(-1, npar)
+        qs[:, i] = np.percentile(samples, [50., 16., 84.], axis=0)
+
+    accept = naccept/np.maximum(nrun*nwalkers, 1)
+    return qs[0], qs[1], qs[2], tau, nrun, accept, conv
+
+def _chi2_stats(model, wav, f, w, z):
+    '''
+    Description
+      per-spectrum weighted sums of the continuum terms of chi2,
+      so _lnprob only evaluates lines near their centers
+      d is the continuum wavelength offset of LineModel.evaluate
+
+    Returns
+      dict of sums over pixels of w^2 x (1, d, d^2, f, f d, f^2),
+      and d, N spectra x N pixels
+    '''
+    lam = np.atleast_2d(wav)
+    d = lam - model.lines.mean()*(1.+z)[:, None]
+    d = np.broadcast_to(d, f.shape)
+    w2 = w*w
+    return dict(s1=w2.sum(axis=1), sd=(w2*d).sum(axis=1),
+                sdd=(w2*d*d).sum(axis=1), sf=(w2*f).sum(axis=1),
+                sfd=(w2*f*d).sum(axis=1), sff=(w2*f*f).sum(axis=1), d=d)
+
+def _lnprob(model, X, wav, f, w, z, stats):
+    '''
+    Description
+      log posterior of walkers X, N spectra x N walkers x N params
+      gaussian likelihood, flat priors with dispersion limits
+      chi2 = sum w^2 (f-C)^2 - 2 sum w^2 (f-C) L + sum w^2 L^2 for
+      continuum C and lines L; the first term from the sums in stats,
+      the others over the pixels within 8 sigma of the lines of any
+      walker of each spectrum
+    '''
+    nspec, nwalk, npar = X.shape
+    sigs = [3+2*k for k in range(model.ncomp)]
+    sig = X[..., sigs]
+    bad = ((sig < model.sigmin) | (sig > model.sigmax)).any(axis=-1)
+
+    #pixel window of each spectrum, one width for all
+    lam = np.broadcast_to(np.atleast_2d(wav), f.shape)
+    npix = lam.shape[1]
+    z1 = (1.+z)[:, None, None, None]
+    with np.errstate(all='ignore'):
+        mu = model.lines*z1*(1.+X[..., [2+2*k for k in range(model.ncomp)],
+                                   None]/c_kms)
+        half = 8*mu*np.clip(sig, model.sigmin, model.sigmax)[..., None]/c_kms
+        lo = np.where(bad[..., None, None], np.inf, mu-half)
+        hi = np.where(bad[..., None, None], -np.inf, mu+half)
+    lo = np.nan_to_num(lo.min(axis=(1, 2, 3)), nan=-np.inf)
+    hi = np.nan_to_num(hi.max(axis=(1, 2, 3)), nan=np.inf)
+    i0 = np.array([np.searchsorted(row, l) for row, l in zip(lam, lo)])
+    i1 = np.array([np.searchsorted(row, h) for row, h in zip(lam, hi)])
+    width = max(int((i1-i0).max(initial=0)), 1)
+    i0 = np.clip(i0, 0, max(npix-width, 0))
+    cols = i0[:, None] + np.arange(min(width, npix))
+    rows = np.arange(nspec)[:, None]
+    lamw, fw, w2w, dw = lam[rows, cols], f[rows, cols], w[rows, cols]**2, \
+        stats['d'][rows, cols]
+
+    c0, c1 = X[..., 0], X[..., 1]
+    with np.errstate(all='ignore'):
+        P = X.reshape(-1, npar).copy()
+        P[:, :2] = 0.
+        L = model.evaluate(P, np.repeat(lamw, nwalk, axis=0),
+                           np.repeat(z, nwalk)).reshape(nspec, nwalk, -1)
+        resid = fw[:, None] - c0[..., None] - c1[..., None]*dw[:, None]
+        cross = (w2w[:, None]*resid*L).sum(axis=-1)
+        LL = (w2w[:, None]*L*L).sum(axis=-1)
+        st = {k: v[:, None] for k, v in stats.items() if k != 'd'}
+        cont = (st['sff'] - 2*c0*st['sf'] - 2*c1*st['sfd'] + c0*c0*st['s1'] +
+                2*c0*c1*st['sd'] + c1*c1*st['sdd'])
+        lnp = -0.5*(cont - 2*cross + LL)
+    lnp[bad | ~np.isfinite(lnp)] = -np.inf
+    return lnp
+
+def _chunk_args(start, chunksize, wav, flux, err, mask, z, p0):
+    '''
+    Description
+      data of the chunk of spectra starting at start
+    '''
+    cut = slice(start, start+chunksize)
+    return (wav if wav.ndim == 1 else wav[cut], np.asarray(flux[cut]),
+            None if err is None else np.atleast_2d(err)[cut],
+            None if mask is None else np.atleast_2d(mask)[cut],
+            z[cut], None if p0 is None else p0[cut])
+
+def _map_chunks(func, tasks, nproc):
+    '''
+    Description
+      func(*task) for every task in order, in a pool of nproc
+      processes if nproc > 1, with a bounded number of tasks in flight
+    '''
+    if nproc == 1:
+        return [func(*task) for task in tasks]
+
+    results = []
+    with ProcessPoolExecutor(nproc) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(func, *task))
+            while len(pending) > 2*nproc:
+                results.append(pending.popleft().result())
+        while pending:
+            results.append(pending.popleft().result())
+    return results
+
+def _weights(flux, err, mask):
+    '''
+    Description
+      flux with unused pixels zeroed, and inverse error weights,
+      zero for NaN flux, bad errors and masked pixels
+    '''
+    good = np.isfinite(flux)
+    if err is None:
+        w = good.astype(float)
+    else:
+        err = np.asarray(err, dtype=float)
+        good &= np.isfinite(err) & (err > 0)
+        w = np.where(good, 1./np.where(good, err, 1.), 0.)
+    if mask is not None:
+        w[mask] = 0.
+    return np.where(w > 0, flux, 0.), w
 
-#fitting function using emcee
+def _nearest(lam, center):
+    '''
+    Description
+      pixel nearest to center in each row of a wavelength grid
+    '''
+    lam = np.atleast_2d(lam)
+    if len(lam) == 1:
+        return np.clip(np.searchsorted(lam[0], center), 0, lam.shape[1]-1)
+    return np.abs(lam-center[:, None]).argmin(axis=1)
 
-#fitting function using optimization
@@ -0,0 +1,192 @@
+from functools import lru_cache
+
+import numpy as np
+from scipy import fft, ndimage
+
+def line_search(wav, flux, err=None, widths=(1., 2., 4., 8.), thresh=5.,
+                kind='both', cont_size=None, mask=None, chunksize=1024):
+    '''
+    Description
+      detects emission and absorption lines by matched filtering
+      each continuum subtracted spectrum is convolved with a bank of
+      gaussian kernels by FFTs, batched over a chunk of spectra
+      significance of a line of kernel K centered at each pixel is
+        SNR = conv(d w, K) / sqrt(conv(w, K^2)),  w = 1/err^2
+      and candidates are local maxima of the best SNR over the bank,
+      also the maximum within 2 sigma of their best kernel
+      memory is about 2 x N widths x chunksize x N pixels floats
+
+    Parameters
+      wav: wavelengths, N pixels or N spectra x N pixels
+      flux: N pixels or N spectra x N pixels (may be a memmap)
+      err: flux errors like flux, default None (per-spectrum robust rms
+           of the continuum subtracted flux)
+      widths: gaussian kernel sigmas, pixels
+      thresh: min significance of candidates
+      kind: 'emission', 'absorption' or 'both'
+      cont_size: running median continuum size, pixels,
+                 default None (12 x the widest kernel sigma, min 51)
+      mask: bool array like flux, True marks bad pixels, default None
+      chunksize: N spectra per batch of FFTs
+
+    Returns
+      index: spectrum index of each candidate
+      center: line center, wav units (parabolic peak interpolation)
+      width: gaussian sigma of the best kernel, wav units
+      snr: significance, negative for absorption
+      amp: peak amplitude of the best kernel fit, flux units
+    '''
+    flux = np.atleast_2d(flux)
+    wav = np.asarray(wav, dtype=float)
+    nspec, npix = flux.shape
+    widths = np.asarray(widths, dtype=float)
+    half = int(np.ceil(4*widths.max()))
+    if cont_size is None:
+        cont_size = max(51, 2*int(6*widths.max())+1)
+    nfft = fft.next_fast_len(npix+2*half, real=True)
+    kernels = [_kernel_fft(nfft, float(width)) for width in widths]
+
+    found = []
+    for start in range(0, nspec, chunksize):
+        cut = slice(start, start+chunksize)
+        d, w = _prepare(flux[cut], None if err is None else
+                        np.atleast_2d(err)[cut],
+                        None if mask is None else np.atleast_2d(mask)[cut],
+                        cont_size)
+
+        fdw = fft.rfft(d*w, n=nfft, axis=1)
+        fw = fft.rfft(w, n=nfft, axis=1)
+        snr = np.empty((len(widths),)+d.shape)
+        amp = np.empty_like(snr)
+        for k, (fk, fk2) in enumerate(kernels):
+            num = fft.irfft(fdw*fk, n=nfft, axis=1)[:, :npix]
+            den = fft.irfft(fw*fk2, n=nfft, axis=1)[:, :npix]
+            #round-off leaves tiny values where there is no data
+            den = np.where(den > 1e-12*den.max(initial=0.), den, np.inf)
+            snr[k] = num/np.sqrt(den)
+            amp[k] = num/den
+
+        if kind == 'emission':
+            score = snr
+        elif kind == 'absorption':
+            score = -snr
+        else:
+            score = np.abs(snr)
+        best = score.argmax(axis=0)
+        peak = np.take_along_axis(score, best[None], axis=0)[0]
+
+        #local maxima above threshold, and maxima within +-2 sigma
+        #of their best kernel, so line wings are not candidates
+        left = np.pad(peak[:, :-1], ((0, 0), (1, 0)), constant_values=-np.inf)
+        right = np.pad(peak[:, 1:], ((0, 0), (0, 1)), constant_values=-np.inf)
+        cand = (peak > thresh) & (peak >= left) & (peak > right)
+        for k, width in enumerate(widths):
+            top = ndimage.maximum_filter1d(peak, 2*int(np.ceil(2*width))+1,
+                                           axis=1, mode='constant', cval=0.)
+            cand &= (best != k) | (peak >= top)
+        rows, pix = np.nonzero(cand)
+
+        #parabolic refinement of the peak position
+        y0 = left[rows, pix]
+        y2 = right[rows, pix]
+        y1 = peak[rows, pix]
+        with np.errstate(invalid='ignore'):
+            denom = y0 - 2*y1 + y2
+            shift = np.where(np.isfinite(denom) & (denom < 0),
+                             0.5*(y0-y2)/np.where(denom < 0, denom, -1.), 0.)
+        pos = pix + np.clip(shift, -0.5, 0.5)
+
+        k = best[rows, pix]
+        lam = wav if wav.ndim == 1 else wav[cut]
+        center = _pix_to_wav(lam, rows, pos)
+        dwav = np.abs(_pix_to_wav(lam, rows, pos+0.5) -
+                      _pix_to_wav(lam, rows, pos-0.5))
+        found.append((rows+start, center, widths[k]*dwav,
+                      snr[k, rows, pix], amp[k, rows, pix]))
+
+    if not found:
+        #no spectra, empty results
+        return (np.zeros(0, dtype=np.intp),) + tuple(np.zeros(0) for _ in range(4))
+    index, center, width, snr, amp = [np.concatenate(col) for col
+                                      in zip(*found)]
+    return index, center, width, snr, amp
+
+def continuum(flux, size=51, mask=None):
+    '''
+    Description
+      running median continuum of spectra, bad pixels filled
+      with the spectrum median first
+
+    Parameters
+      flux: N pixels or N spectra x N pixels
+      size: running median size, pixels
+      mask: bool array like flux, True marks bad pixels, default None
+
+    Returns
+      array like flux
+    '''
+    flux = np.array(np.atleast_2d(flux), dtype=float)
+    bad = ~np.isfinite(flux)
+    if mask is not None:
+        bad |= mask
+    flux[bad] = np.nan
+    with np.errstate(invalid='ignore'):
+        fill = np.nan_to_num(np.nanmedian(flux, axis=1))
+    flux[bad] = np.broadcast_to(fill[:, None], flux.shape)[bad]
+    return ndimage.median_filter(flux, size=(1, size), mode='mirror')
+
+def _prepare(flux, err, mask, cont_size):
+    '''
+    Description
+      continuum subtracted flux and inverse variance weights,
+      zero at bad pixels
+    '''
+    flux = np.asarray(flux, dtype=float)
+    good = np.isfinite(flux)
+    if mask is not None:
+        good &= ~mask
+    d = flux - continuum(flux, size=cont_size, mask=~good)
+    if err is None:
+        #robust rms per spectrum
+        with np.errstate(invalid='ignore'):
+            dev = np.where(good, d, np.nan)
+            rms = 1.4826*np.nanmedian(np.abs(dev - np.nanmedian(dev, axis=1,
+                                                                keepdims=True)),
+                                      axis=1, keepdims=True)
+        var = np.broadcast_to(rms**2, flux.shape)
+    else:
+        var = np.asarray(err, dtype=float)**2
+    good &= np.isfinite(var) & (var > 0)
+    w = np.where(good, 1./np.where(good, var, 1.), 0.)
+    return np.where(good, d, 0.), w
+
+@lru_cache(maxsize=32)
+def _kernel_fft(nfft, width):
+    '''
+    Description
+      transforms of a unit peak gaussian kernel and its square,
+      centered on pixel 0 so the filtered spectra are not shifted
+      the 32 most recently used (fft length, width) are cached
+    '''
+    half = int(np.ceil(4*width))
+    x = np.arange(-half, half+1)
+    k = np.exp(-0.5*(x/width)**2)
+    kern = np.zeros(nfft)
+    kern[x % nfft] = k
+    kern2 = np.zeros(nfft)
+    kern2[x % nfft] = k*k
+    return fft.rfft(kern), fft.rfft(kern2)
+
+def _pix_to_wav(wav, rows, pos):
+    '''
+    Description
+      wavelengths at fractional pixel positions, linear between pixels
+    '''
+    npix = wav.shape[-1]
+    i0 = np.clip(np.floor(pos).astype(np.intp), 0, npix-2)
+    frac = pos - i0
+    if wav.ndim == 1:
+        lo, hi = wav[i0], wav[i0+1]
+    else:
+        lo, hi = wav[rows, i0], wav[rows, i0+1]
+    return lo + frac*(hi-lo)
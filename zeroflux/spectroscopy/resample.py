@@ -0,0 +1,286 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+from zeroflux.spectroscopy.specutils import Spectrum, SpectrumBatch
+
+def bin_edges(wav):
+    '''
+    Description
+      pixel edges of a wavelength grid of pixel centers
+      edges sit halfway between centers, outer edges are mirrored
+
+    Parameters
+      wav: increasing pixel center wavelengths
+
+    Returns
+      array of N pixels + 1 edges
+    '''
+    wav = np.asarray(wav, dtype=float)
+    mid = (wav[1:]+wav[:-1])/2
+    return np.concatenate([[2*wav[0]-mid[0]], mid, [2*wav[-1]-mid[-1]]])
+
+def log_grid(wmin, wmax, dloglam=None, R=None):
+    '''
+    Description
+      grid of pixel centers uniform in log wavelength
+
+    Parameters
+      wmin, wmax: wavelength range
+      dloglam: pixel size in natural log wavelength
+      R: resolving power lam/dlam per pixel, used if dloglam is None
+
+    Returns
+      array of pixel center wavelengths
+    '''
+    if dloglam is None:
+        dloglam = np.log1p(1./R)
+    npix = int(np.floor(np.log(wmax/wmin)/dloglam))+1
+    return wmin*np.exp(np.arange(npix)*dloglam)
+
+class Resampler:
+    '''
+    Flux-conserving resampling from one wavelength grid to another
+
+    The bin-overlap weights are one sparse matrix, built once per pair
+    of grids, so resampling many spectra is a sparse matrix product
+    per chunk of spectra. Output flux densities are overlap weighted
+    means of the input pixels, conserving integrated flux, and errors
+    propagate through the squared weights. Masked and NaN input pixels
+    get zero weight, and the weights of each output pixel are
+    renormalized to its valid coverage.
+    '''
+
+    def __init__(self, wav_in, wav_out):
+        '''
+        Parameters
+          wav_in: input pixel centers, increasing
+          wav_out: output pixel centers, increasing
+        '''
+        edges_in = bin_edges(wav_in)
+        edges_out = bin_edges(wav_out)
+        nin = len(edges_in)-1
+        nout = len(edges_out)-1
+
+        #every segment between merged edges lies in one input and one output bin
+        merged = np.union1d(edges_in, edges_out)
+        mid = (merged[1:]+merged[:-1])/2
+        length = np.diff(merged)
+        i = np.searchsorted(edges_in, mid)-1
+        j = np.searchsorted(edges_out, mid)-1
+        inside = (i >= 0) & (i < nin) & (j >= 0) & (j < nout)
+        i, j, length = i[inside], j[inside], length[inside]
+
+        width = np.diff(edges_out)
+        self.weights = sparse.coo_matrix((length/width[j], (j, i)),
+                                         shape=(nout, nin)).tocsr()
+        self.weights2 = self.weights.multiply(self.weights).tocsr()
+        #fraction of each output pixel covered by the input grid
+        self.coverage = np.bincount(j, weights=length, minlength=nout)/width
+        self.wav_in = np.asarray(wav_in, dtype=float)
+        self.wav_out = np.asarray(wav_out, dtype=float)
+
+    def apply(self, flux, err=None, mask=None, fill=np.nan, chunksize=65536,
+              dtype=np.float64, out=None, errout=None, maskout=None):
+        '''
+        Description
+          resamples one spectrum or N spectra, chunksize rows at a time
+          masked and NaN pixels (flux or err) are left out, the output
+          pixels they overlap are means of the remaining valid pixels
+
+        Parameters
+          flux: flux density, N pixels or N spectra x N pixels (may be a memmap)
+          err: errors like flux, default None
+          mask: bool array like flux, True marks bad pixels, default None
+          fill: value of output pixels not fully covered by the input
+                grid, or with no valid input pixels
+          chunksize: N spectra per sparse matrix product
+          dtype: output dtype
+          out, errout: arrays to write resampled flux and errors to
+          maskout: bool array to write the output mask to, True where
+                   output pixels are fill, default None
+
+        Returns
+          flux, or (flux, err) if err is given
+        '''
+        flux = np.asarray(flux)
+        single = flux.ndim == 1
+        flux = np.atleast_2d(flux)
+        nspec = len(flux)
+        nout = self.weights.shape[0]
+        partial = self.coverage < 1.-1e-9
+
+        if out is None:
+            out = np.empty((nspec, nout), dtype=dtype)
+        if err is not None:
+            err = np.atleast_2d(np.asarray(err))
+            if errout is None:
+                errout = np.empty((nspec, nout), dtype=dtype)
+        if mask is not None:
+            mask = np.atleast_2d(np.asarray(mask, dtype=bool))
+        if maskout is not None:
+            maskout = maskout.reshape(nspec, nout)
+
+        for start in range(0, nspec, chunksize):
+            cut = slice(start, start+chunksize)
+            fin = flux[cut]
+            var = None if err is None else np.square(err[cut], dtype=float)
+            bad = ~np.isfinite(fin)
+            if var is not None:
+                bad |= ~np.isfinite(var)
+            if mask is not None:
+                bad |= mask[cut]
+
+            if not bad.any():
+                out[cut] = (self.weights @ fin.T).T
+                if var is not None:
+                    errout[cut] = np.sqrt(self.weights2 @ var.T).T
+                empty = np.broadcast_to(partial, out[cut].shape)
+            else:
+                #valid fraction of each output pixel, for renormalizing
+                good = (~bad).astype(float)
+                cov = (self.weights @ good.T).T
+                empty = partial | (cov < 1e-9)
+                cov[empty] = 1.
+                out[cut] = (self.weights @ np.where(bad, 0., fin).T).T/cov
+                if var is not None:
+                    var = np.where(bad, 0., var)
+                    errout[cut] = np.sqrt(self.weights2 @ var.T).T/cov
+
+            out[cut][empty] = fill
+            if var is not None:
+                errout[cut][empty] = fill
+            if maskout is not None:
+                maskout[cut] = empty
+
+        if single:
+            out = out[0]
+            errout = None if errout is None else errout[0]
+        return out if err is None else (out, errout)
+
+#cached resamplers by pair of grids
+_resamplers = OrderedDict()
+maxresamplers = 32
+
+def get_resampler(wav_in, wav_out):
+    '''
+    Description
+      cached Resampler for a pair of grids, keyed by the grid values
+      the maxresamplers most recently used are kept
+
+    Parameters
+      wav_in: input pixel centers
+      wav_out: output pixel centers
+
+    Returns
+      Resampler
+    '''
+    key = tuple(hashlib.sha1(np.ascontiguousarray(wav, dtype=float)).hexdigest()
+                for wav in (wav_in, wav_out))
+    res = _resamplers.get(key)
+    if res is None:
+        res = Resampler(wav_in, wav_out)
+        _resamplers[key] = res
+        while len(_resamplers) > maxresamplers:
+            _resamplers.popitem(last=False)
+    else:
+        _resamplers.move_to_end(key)
+    return res
+
+def resample(spec, wav_out, flux=None, err=None, mask=None, fill=np.nan,
+             chunksize=65536, dtype=np.float64):
+    '''
+    Description
+      flux-conserving resampling of spectra onto a common grid
+      spectra sharing an input grid share one cached weight matrix;
+      batch rows are grouped by their current wavelength grid
+
+    Parameters
+      spec: Spectrum, SpectrumBatch, or input wavelength grid with flux
+      wav_out: output pixel centers
+      flux: flux density for a wavelength grid spec, N pixels or
+            N spectra x N pixels
+      err: errors like flux, for a wavelength grid spec
+      mask: bool array like flux, True marks bad pixels, for a
+            wavelength grid spec (batches use their own mask)
+      fill: value of output pixels not fully covered by the input,
+            or with no valid (unmasked, finite) input pixels
+      chunksize: N spectra per sparse matrix product
+      dtype: output dtype
+
+    Returns
+      Spectrum or SpectrumBatch on wav_out, same frame and redshift,
+      batches with a mask of the fill pixels, or flux (flux, err if
+      err given) for a wavelength grid spec
+    '''
+    wav_out = np.asarray(wav_out, dtype=float)
+    kwargs = dict(fill=fill, chunksize=chunksize, dtype=dtype)
+
+    if isinstance(spec, Spectrum):
+        res = get_resampler(spec.wav, wav_out)
+        if spec.err is None:
+            return Spectrum(wav_out, res.apply(spec.flux, **kwargs),
+                            zred=spec.zred, frame=spec.frame, copy=False)
+        newflux, newerr = res.apply(spec.flux, err=spec.err, **kwargs)
+        return Spectrum(wav_out, newflux, err=newerr, zred=spec.zred,
+                        frame=spec.frame, copy=False)
+
+    if not isinstance(spec, SpectrumBatch):
+        return get_resampler(spec, wav_out).apply(flux, err=err, mask=mask,
+                                                  **kwargs)
+
+    def rows_of(arr, rows):
+        return None if arr is None else arr[rows]
+
+    nspec = len(spec)
+    newflux = np.empty((nspec, len(wav_out)), dtype=dtype)
+    newerr = None if spec.err is None else np.empty_like(newflux)
+    newmask = np.empty(newflux.shape, dtype=bool)
+    for rows, wav in _grid_groups(spec):
+        res = get_resampler(wav, wav_out)
+        if isinstance(rows, slice):
+            res.apply(spec.flux[rows], err=rows_of(spec.err, rows),
+                      mask=rows_of(spec.mask, rows), out=newflux[rows],
+                      errout=rows_of(newerr, rows), maskout=newmask[rows],
+                      **kwargs)
+            continue
+        #fancy indexed rows, chunked here to bound the copies
+        for start in range(0, len(rows), chunksize):
+            sub = rows[start:start+chunksize]
+            maskout = np.empty((len(sub), len(wav_out)), dtype=bool)
+            result = res.apply(spec.flux[sub], err=rows_of(spec.err, sub),
+                               mask=rows_of(spec.mask, sub), maskout=maskout,
+                               **kwargs)
+            if newerr is None:
+                newflux[sub] = result
+            else:
+                newflux[sub], newerr[sub] = result
+            newmask[sub] = maskout
+
+    return SpectrumBatch(wav_out, newflux, err=newerr, zred=spec.zred,
+                         frame=spec.frame, mask=newmask)
+
+def _grid_groups(batch):
+    '''
+    Description
+      (rows, wavelength grid) for each distinct current grid of a batch
+      rows is a slice when all spectra share one grid
+    '''
+    if batch.shared:
+        return [(slice(None), batch.base_wav*batch.wavscale[0])]
+
+    groups = []
+    if batch.base_wav.ndim == 1:
+        scales, inverse = np.unique(batch.wavscale, return_inverse=True)
+        for k, scale in enumerate(scales):
+            groups.append((np.flatnonzero(inverse == k), batch.base_wav*scale))
+        return groups
+
+    #one grid per row, group identical rows and scales
+    grids, inverse = np.unique(np.column_stack([batch.base_wav, batch.wavscale]),
+                               axis=0, return_inverse=True)
+    for k, grid in enumerate(grids):
+        groups.append((np.flatnonzero(inverse.ravel() == k), grid[:-1]*grid[-1]))
+    return groups
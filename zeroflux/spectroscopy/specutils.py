@@ -1,50 +1,362 @@
+import os
+
 import numpy as np
 
+#linefitting (astropy) and linesearch (scipy) are imported in the
+#methods that use them, so Spectrum alone imports only numpy
+
 class Spectrum:
     '''
     Basic functionality for working with 1D spectrum
     '''
     
-    def __init__(self, wav, flux, err=None, zred=0.0, frame='obs'):
+    def __init__(self, wav, flux, err=None, zred=0.0, frame='obs', copy=True):
 
-        #input properties
-        self.wav = np.array(wav)
-        self.flux = np.array(flux)
-        self.err = np.array(err)
+        #input properties, copy=False keeps views of the inputs
+        asarray = np.array if copy else np.asarray
+        self.wav = asarray(wav)
+        self.flux = asarray(flux)
+        self.err = None if err is None else asarray(err)
         self.zred = zred
         self.frame = frame
 
         #derived properties
-        self.wavdiff = np.diff(wav)
-        if np.all(self.wavdiff[0]==self.wavdiff):
+        self.wavdiff = np.diff(self.wav)
+        if _uniform(self.wavdiff):
             self.dwav = self.wavdiff[0] #dwav wav units per bin 
+        elif _uniform(np.diff(np.log(self.wav))):
+            self.dloglam = np.log(self.wav[1]/self.wav[0]) #dloglam ln(wav) per bin
         else:
             print('warning, non-rectified wavelength scale...')
         
 
     def redshift(self, z=None):
-        if z is None
+        if z is None:
             z = self.zred
 
         #shift wavelengths, update frame
+        #new arrays, so views of shared data are left untouched
         if self.frame == 'obs':
-            self.wav /= (1.+z)
+            self.wav = self.wav/(1.+z)
             self.frame = 'rest'
             
         elif self.frame == 'rest':
-            self.wav *= (1.+z)
+            self.wav = self.wav*(1.+z)
             self.frame='obs'
 
-    def fitline_opt():
-        return
-    
-    def fitline_mcmc():
-        return
-    
-    def linesearch():
-        return
-        
-        
+    def fitline_opt(self, model, window=50., **kwargs):
+        '''
+        Description
+          least-squares fit of emission lines, see linefitting.fit_lines
+          lines are placed at zred in the observed frame
 
-        
-        
+        Parameters
+          model: LineModel, or list of rest wavelengths
+          window: rest frame A fitted beyond the bluest and reddest lines
+          kwargs: passed to fit_lines
+
+        Returns
+          astropy Table row of fitted parameters
+        '''
+        from zeroflux.spectroscopy.linefitting import fit_lines
+        model, data, kw = self._line_window(model, window)
+        return fit_lines(*data, model, **kw, **kwargs)[0]
+
+    def fitline_mcmc(self, model, window=50., **kwargs):
+        '''
+        Description
+          posterior sampling of emission line parameters,
+          see linefitting.sample_lines
+
+        Parameters
+          model: LineModel, or list of rest wavelengths
+          window: rest frame A fitted beyond the bluest and reddest lines
+          kwargs: passed to sample_lines
+
+        Returns
+          astropy Table row of parameter percentiles
+        '''
+        from zeroflux.spectroscopy.linefitting import sample_lines
+        model, data, kw = self._line_window(model, window)
+        return sample_lines(*data, model, **kw, **kwargs)[0]
+
+    def _line_window(self, model, window):
+        '''
+        Description
+          model, (wav, flux) and keywords of the line fitters
+          for the pixels in a window around the lines
+        '''
+        from zeroflux.spectroscopy.linefitting import LineModel
+        if not isinstance(model, LineModel):
+            model = LineModel(model)
+        z = self.zred if self.frame == 'obs' else 0.
+        lo = (model.lines.min()-window)*(1.+z)
+        hi = (model.lines.max()+window)*(1.+z)
+        cut = (self.wav >= lo) & (self.wav <= hi)
+        err = None if self.err is None else self.err[cut]
+        return model, (self.wav[cut], self.flux[cut]), dict(err=err, z=z)
+
+    def linesearch(self, **kwargs):
+        '''
+        Description
+          matched-filter emission and absorption line search,
+          see linesearch.line_search
+
+        Parameters
+          kwargs: passed to line_search
+
+        Returns
+          center, width, snr, amp arrays of line candidates
+        '''
+        from zeroflux.spectroscopy.linesearch import line_search
+        return line_search(self.wav, self.flux, err=self.err, **kwargs)[1:]
+
+
+class SpectrumBatch:
+    '''
+    Many 1D spectra stored as contiguous 2D arrays
+
+    Fluxes (and errors, masks) are N spectra x N pixels arrays,
+    with a shared wavelength axis or one wavelength row per spectrum.
+    Arrays are wrapped, not copied, so memory-mapped data stays on disk.
+    Redshifts scale a per-spectrum wavelength factor instead of
+    rewriting the wavelength arrays.
+    '''
+
+    def __init__(self, wav, flux, err=None, zred=0.0, frame='obs', mask=None):
+        '''
+        Parameters
+          wav: shared wavelengths (N pixels), or N spectra x N pixels
+          flux: N spectra x N pixels
+          err: errors like flux, default None
+          zred: redshift, single value or one per spectrum
+          frame: 'obs' or 'rest', single value or one per spectrum
+          mask: bool array like flux, True marks bad pixels, default None
+        '''
+        self.base_wav = np.asarray(wav)
+        self.flux = np.asarray(flux)
+        self.err = None if err is None else np.asarray(err)
+        self.mask = None if mask is None else np.asarray(mask, dtype=bool)
+
+        nspec = len(self.flux)
+        self.zred = np.array(np.broadcast_to(zred, (nspec,)), dtype=float)
+        self.frame = np.array(np.broadcast_to(frame, (nspec,)), dtype='<U4')
+        #wavelengths of spectrum i are base_wav (row i) x wavscale[i]
+        self.wavscale = np.ones(nspec)
+
+    def __len__(self):
+        return len(self.flux)
+
+    @property
+    def shared(self):
+        '''
+        True if all spectra currently have the same wavelengths
+        '''
+        return self.base_wav.ndim == 1 and np.all(self.wavscale == self.wavscale[0])
+
+    @property
+    def wav(self):
+        '''
+        current wavelengths, 1D if shared, else N spectra x N pixels
+        no copy when no spectrum has been shifted
+        '''
+        if len(self) == 0 or np.all(self.wavscale == 1.):
+            return self.base_wav
+        if self.shared:
+            return self.base_wav*self.wavscale[0]
+        return np.atleast_2d(self.base_wav)*self.wavscale[:, None]
+
+    @property
+    def masked_flux(self):
+        '''
+        flux as a numpy masked array, a view without copies
+        '''
+        return np.ma.MaskedArray(self.flux, mask=self.mask, copy=False)
+
+    def redshift(self, z=None):
+        '''
+        Description
+          shifts spectra between observed and rest frame,
+          like Spectrum.redshift, for every spectrum at once
+          only the per-spectrum wavelength factors change
+
+        Parameters
+          z: redshift(s), default None (use zred)
+        '''
+        z = self.zred if z is None else np.broadcast_to(z, (len(self),))
+        obs = self.frame == 'obs'
+        scale = np.where(obs, self.wavscale/(1.+z), self.wavscale*(1.+z))
+        #round trips back to the stored frame reuse the stored wavelengths
+        scale[np.abs(scale-1.) < 1e-12] = 1.
+        self.wavscale = scale
+        self.frame = np.where(obs, 'rest', 'obs')
+
+    def __getitem__(self, idx):
+        '''
+        Description
+          integer index gives a Spectrum viewing that row
+          slices give a SpectrumBatch of views
+          index arrays and bool masks also work, but numpy copies
+          the selected rows
+        '''
+        if isinstance(idx, (int, np.integer)):
+            return self.spectrum(idx)
+
+        def rows(arr):
+            return None if arr is None else arr[idx]
+        wav = self.base_wav if self.base_wav.ndim == 1 else self.base_wav[idx]
+        sub = SpectrumBatch(wav, self.flux[idx], err=rows(self.err),
+                            zred=self.zred[idx], frame=self.frame[idx],
+                            mask=rows(self.mask))
+        sub.wavscale = self.wavscale[idx]
+        return sub
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.spectrum(i)
+
+    def spectrum(self, i):
+        '''
+        Description
+          Spectrum i, viewing flux and err rows without copies
+
+        Parameters
+          i: spectrum index
+
+        Returns
+          Spectrum
+        '''
+        wav = self.base_wav if self.base_wav.ndim == 1 else self.base_wav[i]
+        if self.wavscale[i] != 1.:
+            wav = wav*self.wavscale[i]
+        err = None if self.err is None else self.err[i]
+        return Spectrum(wav, self.flux[i], err=err, zred=self.zred[i],
+                        frame=self.frame[i], copy=False)
+
+    def fitline_opt(self, model, window=50., **kwargs):
+        '''
+        Description
+          least-squares fits of emission lines to every spectrum,
+          see linefitting.fit_lines
+          lines are placed at each zred in the observed frame;
+          pixels outside each spectrum's window are masked
+
+        Parameters
+          model: LineModel, or list of rest wavelengths
+          window: rest frame A fitted beyond the bluest and reddest lines
+          kwargs: passed to fit_lines
+
+        Returns
+          astropy Table, one row per spectrum
+        '''
+        from zeroflux.spectroscopy.linefitting import fit_lines
+        model, data, kw = self._line_window(model, window)
+        return fit_lines(*data, model, **kw, **kwargs)
+
+    def fitline_mcmc(self, model, window=50., **kwargs):
+        '''
+        Description
+          posterior sampling of emission line parameters of every
+          spectrum, see linefitting.sample_lines
+
+        Parameters
+          model: LineModel, or list of rest wavelengths
+          window: rest frame A fitted beyond the bluest and reddest lines
+          kwargs: passed to sample_lines
+
+        Returns
+          astropy Table, one row per spectrum
+        '''
+        from zeroflux.spectroscopy.linefitting import sample_lines
+        model, data, kw = self._line_window(model, window)
+        return sample_lines(*data, model, **kw, **kwargs)
+
+    def _line_window(self, model, window):
+        '''
+        Description
+          model, (wav, flux) and keywords of the line fitters
+          for the columns spanning all windows around the lines,
+          rows masked beyond their own window
+        '''
+        from zeroflux.spectroscopy.linefitting import LineModel
+        if not isinstance(model, LineModel):
+            model = LineModel(model)
+        z = np.where(self.frame == 'obs', self.zred, 0.)
+        lo = (model.lines.min()-window)*(1.+z)
+        hi = (model.lines.max()+window)*(1.+z)
+
+        wav = self.wav
+        cols = slice(None)
+        if wav.ndim == 1:
+            inside = np.flatnonzero((wav >= lo.min()) & (wav <= hi.max()))
+            cols = slice(inside[0], inside[-1]+1) if len(inside) else slice(0, 0)
+            wav = wav[cols]
+        mask = (wav < lo[:, None]) | (wav > hi[:, None])
+        if self.mask is not None:
+            mask |= self.mask[:, cols]
+        err = None if self.err is None else self.err[:, cols]
+        return model, (wav, self.flux[:, cols]), dict(err=err, z=z, mask=mask)
+
+    def linesearch(self, **kwargs):
+        '''
+        Description
+          matched-filter emission and absorption line search of every
+          spectrum, see linesearch.line_search
+
+        Parameters
+          kwargs: passed to line_search
+
+        Returns
+          index, center, width, snr, amp arrays of line candidates
+        '''
+        from zeroflux.spectroscopy.linesearch import line_search
+        return line_search(self.wav, self.flux, err=self.err, mask=self.mask,
+                           **kwargs)
+
+    def save(self, path):
+        '''
+        Description
+          writes the batch as .npy files in directory path,
+          which load can memory-map
+
+        Parameters
+          path: directory, created if needed
+        '''
+        os.makedirs(path, exist_ok=True)
+        arrays = dict(wav=self.base_wav, flux=self.flux, err=self.err,
+                      mask=self.mask, zred=self.zred, frame=self.frame,
+                      wavscale=self.wavscale)
+        for name, arr in arrays.items():
+            if arr is not None:
+                np.save(os.path.join(path, name+'.npy'), arr)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''
+        Description
+          reads a batch written by save, memory-mapping the arrays
+
+        Parameters
+          path: directory written by save
+          mmap_mode: np.load mmap_mode, default 'r'; None reads to memory
+
+        Returns
+          SpectrumBatch
+        '''
+        def load(name, mmap=mmap_mode):
+            fname = os.path.join(path, name+'.npy')
+            if not os.path.exists(fname):
+                return None
+            return np.load(fname, mmap_mode=mmap)
+
+        batch = cls(load('wav'), load('flux'), err=load('err'),
+                    zred=load('zred', None), frame=load('frame', None),
+                    mask=load('mask'))
+        batch.wavscale = load('wavscale', None)
+        return batch
+
+def _uniform(diff):
+    '''
+    True if all steps equal the first, to round-off
+    '''
+    return np.allclose(diff, diff[0], rtol=1e-6, atol=0)
@@ -0,0 +1,204 @@
+from collections import OrderedDict
+
+import numpy as np
+from scipy import fft
+from astropy.table import Table
+
+from zeroflux.spectroscopy.resample import get_resampler, log_grid, resample
+from zeroflux.spectroscopy.specutils import SpectrumBatch
+
+class TemplateSet:
+    '''
+    Rest frame spectral templates on a log wavelength grid
+
+    In log wavelength a redshift is a constant pixel shift, so the
+    chi2 of a template against a spectrum at every trial redshift is
+    a pair of cross-correlations. Template FFTs are cached per FFT
+    length and start pixel and reused for every spectrum; the
+    maxffts most recently used pairs are kept.
+    '''
+
+    maxffts = 8
+
+    def __init__(self, wav, templates, dloglam=1e-4, names=None):
+        '''
+        Parameters
+          wav: rest frame wavelengths of the templates, A
+          templates: N templates x N wavelengths, flux density
+          dloglam: pixel size in natural log wavelength, shared by
+                   the templates and the resampled spectra
+          names: template names, default None
+        '''
+        logwav = log_grid(wav[0], wav[-1], dloglam=dloglam)
+        self.flux = np.nan_to_num(get_resampler(wav, logwav).apply(
+            np.atleast_2d(templates)))
+        self.loglam0 = np.log(logwav[0])
+        self.dloglam = dloglam
+        self.names = names
+        self._ffts = OrderedDict()
+
+    def __len__(self):
+        return len(self.flux)
+
+    def ffts(self, nfft, start=0):
+        '''
+        Description
+          real FFTs of the templates and squared templates from pixel
+          start on (zero outside the templates), cached, least
+          recently used pairs are evicted past maxffts
+
+        Parameters
+          nfft: FFT length
+          start: first template pixel, may be negative
+
+        Returns
+          (N templates x nfft//2+1, N templates x nfft//2+1)
+        '''
+        key = (nfft, start)
+        pair = self._ffts.get(key)
+        if pair is not None:
+            self._ffts.move_to_end(key)
+            return pair
+
+        seg = np.zeros((len(self), nfft))
+        lo, hi = max(start, 0), min(start+nfft, self.flux.shape[1])
+        if hi > lo:
+            seg[:, lo-start:hi-start] = self.flux[:, lo:hi]
+        pair = (fft.rfft(seg, axis=1), fft.rfft(seg**2, axis=1))
+        self._ffts[key] = pair
+        while len(self._ffts) > self.maxffts:
+            self._ffts.popitem(last=False)
+        return pair
+
+    def grid(self, wmin, wmax):
+        '''
+        Description
+          log wavelength grid aligned with the template pixels,
+          covering wmin to wmax
+
+        Returns
+          n0: index of the first pixel on the template grid
+          wavelengths of the grid
+        '''
+        n0 = int(np.ceil((np.log(wmin)-self.loglam0)/self.dloglam))
+        n1 = int(np.floor((np.log(wmax)-self.loglam0)/self.dloglam))
+        return n0, np.exp(self.loglam0 + self.dloglam*np.arange(n0, n1+1))
+
+def zfind(wav, flux, templates, err=None, mask=None, zmin=0., zmax=1.5,
+          exclude=5, chunksize=256):
+    '''
+    Description
+      redshifts by template cross-correlation
+      spectra are resampled (flux conserving) onto the log wavelength
+      grid of the templates; the chi2 of each template, scaled by a
+      free positive amplitude, at every integer pixel shift is
+        chi2(s) = sum(w d^2) - C1(s)^2/C2(s)
+      with C1 = w d correlated with the template and C2 = w correlated
+      with the squared template, both from batched FFTs per chunk
+      the best shift is refined by a parabola through the chi2 minimum,
+      which also gives the redshift error (delta chi2 = 1)
+
+    Parameters
+      wav: observed wavelengths, N pixels or N spectra x N pixels
+      flux: N pixels or N spectra x N pixels (may be a memmap)
+      templates: TemplateSet
+      err: flux errors like flux, default None (unit weights)
+      mask: bool array like flux, True marks bad pixels, default None
+      zmin, zmax: redshift search range
+      exclude: half-width in pixels around the best redshift excluded
+               when finding the next best, for dchi2
+      chunksize: N spectra per batch of FFTs
+
+    Returns
+      astropy Table, one row per spectrum, with columns
+      z, zerr: redshift and its error
+      chi2: chi2 at the best shift, dof: N good pixels - 1
+      template: index of the best template, amp: its amplitude
+      dchi2: chi2 difference to the best minimum of any template
+             more than exclude pixels away
+    '''
+    flux = np.atleast_2d(flux)
+    wav = np.asarray(wav, dtype=float)
+    nspec = len(flux)
+    dl = templates.dloglam
+    n0, logwav = templates.grid(np.nanmin(wav), np.nanmax(wav))
+    ndata = len(logwav)
+
+    #trial shifts in pixels; spectrum pixel i meets template pixel
+    #n0+i-shift, so only template pixels from n0-max shift are needed
+    #and the correlation is ndata+N shifts-1 long without wrapping
+    shifts = np.arange(int(np.floor(np.log1p(zmin)/dl)),
+                       int(np.ceil(np.log1p(zmax)/dl))+1)
+    nfft = fft.next_fast_len(ndata+len(shifts)-1, real=True)
+    tfft, t2fft = templates.ffts(nfft, start=n0-shifts[-1])
+    #correlation lag of each shift, from the largest shift down to 0
+    top = shifts[-1]-shifts[0]
+
+    cols = {name: [] for name in ('z', 'zerr', 'chi2', 'dof', 'template',
+                                  'amp', 'dchi2')}
+    for start in range(0, nspec, chunksize):
+        cut = slice(start, start+chunksize)
+        batch = SpectrumBatch(wav if wav.ndim == 1 else wav[cut], flux[cut],
+                              err=None if err is None else
+                              np.atleast_2d(err)[cut])
+        if mask is not None:
+            batch.flux = np.where(np.atleast_2d(mask)[cut], np.nan, batch.flux)
+        logspec = resample(batch, logwav)
+
+        good = np.isfinite(logspec.flux)
+        if logspec.err is None:
+            w = good.astype(float)
+        else:
+            good &= np.isfinite(logspec.err) & (logspec.err > 0)
+            w = np.where(good, 1./np.where(good, logspec.err, 1.)**2, 0.)
+        d = np.where(good, logspec.flux, 0.)
+
+        dfft = fft.rfft(w*d, n=nfft, axis=1).conj()
+        wfft = fft.rfft(w, n=nfft, axis=1).conj()
+        wd2 = (w*d*d).sum(axis=1)
+
+        #chi2 decrease C1^2/C2 of every template at every shift,
+        #N templates x N spectra x N shifts, positive amplitudes only
+        gain = np.empty((len(templates), len(d), len(shifts)))
+        c1s = np.empty_like(gain)
+        c2s = np.empty_like(gain)
+        for k in range(len(templates)):
+            c1 = fft.irfft(dfft*tfft[k], n=nfft, axis=1)[:, top::-1]
+            c2 = fft.irfft(wfft*t2fft[k], n=nfft, axis=1)[:, top::-1]
+            #round-off floor where spectrum and template do not overlap
+            np.maximum(c2, 1e-12*np.abs(c2).max(initial=0.)+1e-300, out=c2s[k])
+            np.maximum(c1, 0., out=c1s[k])
+            np.multiply(c1s[k], c1s[k], out=gain[k])
+            gain[k] /= c2s[k]
+
+        best_t = gain.argmax(axis=0)
+        curve = np.take_along_axis(gain, best_t[None], axis=0)[0]
+        rows = np.arange(len(d))
+        ib = curve.argmax(axis=1)
+        tb = best_t[rows, ib]
+        chimin = wd2 - curve[rows, ib]
+
+        #parabola through the best template chi2 around the minimum
+        i0 = np.clip(ib, 1, len(shifts)-2)
+        y0, y1, y2 = [-gain[tb, rows, i0+o] for o in (-1, 0, 1)]
+        curv = y0 - 2*y1 + y2
+        ok = curv > 0
+        offset = np.where(ok, 0.5*(y0-y2)/np.where(ok, curv, 1.), 0.)
+        offset = np.clip(offset + i0 - ib, -1., 1.)
+        s = shifts[ib] + offset
+        serr = np.where(ok, np.sqrt(2./np.where(ok, curv, 1.)), np.nan)
+        z = np.expm1(s*dl)
+
+        #next best minimum away from the best shift
+        away = np.abs(np.arange(len(shifts))[None]-ib[:, None]) > exclude
+        second = wd2 - np.where(away, curve, -np.inf).max(axis=1)
+
+        cols['z'].append(z)
+        cols['zerr'].append((1.+z)*dl*serr)
+        cols['chi2'].append(chimin)
+        cols['dof'].append(good.sum(axis=1)-1)
+        cols['template'].append(tb)
+        cols['amp'].append(c1s[tb, rows, ib]/c2s[tb, rows, ib])
+        cols['dchi2'].append(second-chimin)
+
+    return Table({name: np.concatenate(col) for name, col in cols.items()})